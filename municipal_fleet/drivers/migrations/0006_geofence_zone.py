@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drivers', '0005_driver_photo'),
+        ('fleet', '0009_vehicle_category'),
+        ('tenants', '0002_municipality_fuel_contract_settings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeofenceZone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('zone_type', models.CharField(choices=[('SCHOOL', 'Zona escolar'), ('DEPOT', 'Garagem'), ('FORBIDDEN', 'Área proibida'), ('OTHER', 'Outra')], default='OTHER', max_length=20)),
+                ('polygon', models.JSONField(default=list)),
+                ('alert_on_enter', models.BooleanField(default=True)),
+                ('alert_on_exit', models.BooleanField(default=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('drivers', models.ManyToManyField(blank=True, related_name='geofence_zones', to='drivers.driver')),
+                ('municipality', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='geofence_zones', to='tenants.municipality')),
+                ('vehicles', models.ManyToManyField(blank=True, related_name='geofence_zones', to='fleet.vehicle')),
+            ],
+            options={
+                'ordering': ['name', 'id'],
+            },
+        ),
+    ]
@@ -51,3 +51,31 @@ class DriverGeofence(models.Model):
 
     def __str__(self):
         return f"Geofence {self.driver_id} ({self.radius_m}m)"
+
+
+class GeofenceZone(models.Model):
+    class ZoneType(models.TextChoices):
+        SCHOOL = "SCHOOL", "Zona escolar"
+        DEPOT = "DEPOT", "Garagem"
+        FORBIDDEN = "FORBIDDEN", "Área proibida"
+        OTHER = "OTHER", "Outra"
+
+    municipality = models.ForeignKey("tenants.Municipality", on_delete=models.CASCADE, related_name="geofence_zones")
+    name = models.CharField(max_length=255)
+    zone_type = models.CharField(max_length=20, choices=ZoneType.choices, default=ZoneType.OTHER)
+    # Closed ring of [lat, lng] pairs; the last vertex connects back to the first.
+    polygon = models.JSONField(default=list)
+    # Empty means the zone applies to every driver and vehicle of the municipality.
+    drivers = models.ManyToManyField(Driver, blank=True, related_name="geofence_zones")
+    vehicles = models.ManyToManyField("fleet.Vehicle", blank=True, related_name="geofence_zones")
+    alert_on_enter = models.BooleanField(default=True)
+    alert_on_exit = models.BooleanField(default=True)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["name", "id"]
+
+    def __str__(self):
+        return f"{self.name} ({self.get_zone_type_display()})"
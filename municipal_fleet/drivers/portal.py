@@ -13,4 +13,5 @@ def generate_portal_token(driver: Driver) -> str:
 def resolve_portal_token(token: str) -> Driver:
     signer = signing.TimestampSigner(salt=PORTAL_SALT)
     driver_id = signer.unsign(token, max_age=PORTAL_TOKEN_AGE_SECONDS)
-    return Driver.objects.select_related("municipality").get(id=driver_id, status=Driver.Status.ACTIVE)
+    # The geofence rides along so map payloads built for the driver's pings need no extra query.
+    return Driver.objects.select_related("municipality", "geofence").get(id=driver_id, status=Driver.Status.ACTIVE)
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 from accounts.models import User
-from drivers.models import Driver, DriverGeofence
+from drivers.models import Driver, DriverGeofence, GeofenceZone
 from tenants.utils import resolve_municipality
 
 
@@ -81,3 +81,45 @@ class DriverGeofenceSerializer(serializers.ModelSerializer):
             "updated_at",
         ]
         read_only_fields = ["id", "alert_active", "last_alerted_at", "cleared_at", "created_at", "updated_at"]
+
+
+class GeofenceZoneSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = GeofenceZone
+        fields = "__all__"
+        read_only_fields = ["id", "created_at", "updated_at"]
+        extra_kwargs = {"municipality": {"required": False}}
+
+    def validate_polygon(self, value):
+        if not isinstance(value, list) or len(value) < 3:
+            raise serializers.ValidationError("Informe ao menos 3 vértices [lat, lng].")
+        vertices = []
+        for vertex in value:
+            try:
+                lat, lng = (float(coord) for coord in vertex)
+            except (TypeError, ValueError):
+                raise serializers.ValidationError("Vértice inválido; use [lat, lng].")
+            if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+                raise serializers.ValidationError("Coordenadas fora do intervalo válido.")
+            vertices.append([lat, lng])
+        return vertices
+
+    def validate(self, attrs):
+        request = self.context.get("request")
+        user = getattr(request, "user", None)
+        municipality = attrs.get("municipality", getattr(self.instance, "municipality", None))
+        if user and getattr(user, "role", None) != "SUPERADMIN":
+            if not getattr(user, "municipality", None):
+                raise serializers.ValidationError(
+                    {"municipality": "Usuário precisa estar vinculado a uma prefeitura."}
+                )
+            municipality = user.municipality
+        elif user and getattr(user, "role", None) == "SUPERADMIN":
+            municipality = resolve_municipality(request, municipality)
+            if not municipality:
+                raise serializers.ValidationError({"municipality": "Prefeitura é obrigatória."})
+        attrs["municipality"] = municipality
+        for field in ("drivers", "vehicles"):
+            if any(item.municipality_id != municipality.id for item in attrs.get(field, [])):
+                raise serializers.ValidationError({field: "Itens devem pertencer à mesma prefeitura."})
+        return attrs
@@ -3,6 +3,7 @@ from django.urls import path
 from drivers.views import (
     DriverViewSet,
     DriverGeofenceView,
+    GeofenceZoneViewSet,
     DriverPortalLoginView,
     DriverPortalTripsView,
     DriverPortalAssignmentsView,
@@ -21,9 +22,12 @@ from drivers.views import (
     DriverPortalVehiclesView,
     DriverPortalAvailabilityBlocksView,
     DriverPortalGpsPingView,
+    DriverPortalGpsPingBatchView,
 )
 
 router = DefaultRouter()
+# Registered before the driver routes, whose empty prefix would capture it as a pk.
+router.register(r"geofence-zones", GeofenceZoneViewSet, basename="geofence-zone")
 router.register(r"", DriverViewSet, basename="driver")
 
 urlpatterns = [
@@ -46,5 +50,6 @@ urlpatterns = [
     path("portal/free_trips/<int:free_trip_id>/incidents/", DriverPortalFreeTripIncidentView.as_view(), name="driver-portal-free-trip-incident"),
     path("portal/vehicles/", DriverPortalVehiclesView.as_view(), name="driver-portal-vehicles"),
     path("portal/gps/ping/", DriverPortalGpsPingView.as_view(), name="driver-portal-gps-ping"),
+    path("portal/gps/pings/batch/", DriverPortalGpsPingBatchView.as_view(), name="driver-portal-gps-ping-batch"),
 ]
 urlpatterns += router.urls
@@ -3,10 +3,8 @@ from rest_framework import viewsets, permissions, filters, views, response, exce
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiTypes
 from rest_framework.exceptions import ValidationError
 from django.utils import timezone
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-from drivers.models import Driver
-from drivers.serializers import DriverSerializer, DriverGeofenceSerializer
+from drivers.models import Driver, GeofenceZone
+from drivers.serializers import DriverSerializer, DriverGeofenceSerializer, GeofenceZoneSerializer
 from tenants.mixins import MunicipalityQuerysetMixin
 from accounts.permissions import IsMunicipalityAdminOrReadOnly
 from drivers.portal import generate_portal_token, resolve_portal_token
@@ -14,10 +12,17 @@ from fleet.models import FuelLog, FuelStation, Vehicle, VehicleInspection, Vehic
 from fleet.serializers import FuelLogSerializer, VehicleInspectionSerializer
 from notifications.models import Notification, NotificationDevice
 from notifications.serializers import NotificationSerializer, NotificationDeviceSerializer
-from notifications.services import dispatch_geofence_alert
 from trips.models import Trip, TripIncident, FreeTrip, FreeTripIncident
-from trips.serializers import TripSerializer, TripIncidentSerializer, FreeTripSerializer, FreeTripIncidentSerializer, TripGpsPingSerializer
-from trips.gps import resolve_status, STATUS_LABELS
+from trips.serializers import TripSerializer, TripIncidentSerializer, FreeTripSerializer, FreeTripIncidentSerializer, TripGpsPingSerializer, TripGpsPointSerializer
+from trips.ingestion import (
+    INGESTION_MODE_QUEUE,
+    MAX_BATCH_POINTS,
+    apply_ping_side_effects,
+    enqueue_pings,
+    filter_points,
+    ingest_points,
+    ingestion_mode,
+)
 from transport_planning.models import Assignment
 from scheduling.models import DriverAvailabilityBlock
 
@@ -41,6 +46,14 @@ class DriverViewSet(MunicipalityQuerysetMixin, viewsets.ModelViewSet):
             serializer.save(municipality=municipality)
 
 
+class GeofenceZoneViewSet(MunicipalityQuerysetMixin, viewsets.ModelViewSet):
+    queryset = GeofenceZone.objects.prefetch_related("drivers", "vehicles")
+    serializer_class = GeofenceZoneSerializer
+    permission_classes = [permissions.IsAuthenticated, IsMunicipalityAdminOrReadOnly]
+    filter_backends = [filters.SearchFilter]
+    search_fields = ["name"]
+
+
 class DriverPortalAuthMixin:
     def get_portal_driver(self, request):
         token = request.headers.get("X-Driver-Token") or request.query_params.get("driver_token")
@@ -259,58 +272,58 @@ class DriverPortalGpsPingView(DriverPortalAuthMixin, views.APIView):
         if not trip:
             return response.Response({"detail": "Viagem ativa não encontrada."}, status=status.HTTP_404_NOT_FOUND)
         payload = {
-            "trip": trip.id,
             "lat": request.data.get("lat"),
             "lng": request.data.get("lng"),
             "accuracy": request.data.get("accuracy"),
             "speed": request.data.get("speed"),
             "recorded_at": request.data.get("recorded_at") or timezone.now(),
         }
-        serializer = TripGpsPingSerializer(data=payload)
+        serializer = TripGpsPointSerializer(data=payload)
         serializer.is_valid(raise_exception=True)
-        ping = serializer.save(driver=driver)
-
-        geofence_alert_active = dispatch_geofence_alert(trip, ping)
-        geofence = getattr(driver, "geofence", None)
-        geofence_payload = None
-        if geofence:
-            geofence_payload = {
-                "center_lat": float(geofence.center_lat),
-                "center_lng": float(geofence.center_lng),
-                "radius_m": geofence.radius_m,
-                "is_active": geofence.is_active,
-                "alert_active": geofence.alert_active,
-            }
-
-        channel_layer = get_channel_layer()
-        if channel_layer:
-            status_code = resolve_status(ping, now=timezone.now())
-            async_to_sync(channel_layer.group_send)(
-                "operations_map",
-                {
-                    "type": "gps.ping",
-                    "data": {
-                        "trip_id": trip.id,
-                        "driver_id": driver.id,
-                        "driver_name": driver.name,
-                        "vehicle_id": trip.vehicle_id,
-                        "vehicle_plate": trip.vehicle.license_plate,
-                        "status": status_code,
-                        "status_label": STATUS_LABELS.get(status_code, status_code),
-                        "geofence_alert_active": geofence_alert_active,
-                        "geofence": geofence_payload,
-                        "lat": float(ping.lat),
-                        "lng": float(ping.lng),
-                        "accuracy": ping.accuracy,
-                        "speed": ping.speed,
-                        "recorded_at": ping.recorded_at.isoformat(),
-                    },
-                },
-            )
+        accepted, rejected = filter_points(driver, [serializer.validated_data], trip_id=trip.id)
+        if not accepted:
+            # Acknowledged so the device does not resend a point that will never be stored.
+            return response.Response({"trip_id": trip.id, "accepted": 0, "rejected": rejected}, status=status.HTTP_200_OK)
+        if ingestion_mode() == INGESTION_MODE_QUEUE:
+            enqueue_pings(trip, driver, accepted)
+            return response.Response({"trip_id": trip.id, "queued": 1}, status=status.HTTP_202_ACCEPTED)
+        ping = serializer.save(driver=driver, trip=trip)
+        apply_ping_side_effects(trip, driver, ping)
 
         return response.Response(TripGpsPingSerializer(ping).data, status=status.HTTP_201_CREATED)
 
 
+class DriverPortalGpsPingBatchView(DriverPortalAuthMixin, views.APIView):
+    permission_classes = [permissions.AllowAny]
+
+    @extend_schema(
+        request=OpenApiTypes.OBJECT,
+        responses={201: OpenApiTypes.OBJECT},
+    )
+    def post(self, request):
+        driver = self.get_portal_driver(request)
+        points = request.data.get("points")
+        if not isinstance(points, list) or not points:
+            return response.Response({"detail": "Informe a lista de pontos em 'points'."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(points) > MAX_BATCH_POINTS:
+            return response.Response(
+                {"detail": f"Máximo de {MAX_BATCH_POINTS} pontos por envio."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        trip_id = request.data.get("trip_id")
+        trips_qs = driver.trips.filter(status=Trip.Status.IN_PROGRESS).select_related("vehicle")
+        if trip_id:
+            trips_qs = trips_qs.filter(id=trip_id)
+        trip = trips_qs.first()
+        if not trip:
+            return response.Response({"detail": "Viagem ativa não encontrada."}, status=status.HTTP_404_NOT_FOUND)
+        if not all(isinstance(point, dict) for point in points):
+            return response.Response({"detail": "Pontos inválidos."}, status=status.HTTP_400_BAD_REQUEST)
+        result = ingest_points(trip, driver, points)
+        status_code = status.HTTP_202_ACCEPTED if "queued" in result else status.HTTP_201_CREATED
+        return response.Response(result, status=status_code)
+
+
 class DriverGeofenceView(views.APIView):
     permission_classes = [permissions.IsAuthenticated, IsMunicipalityAdminOrReadOnly]
 
@@ -1,6 +1,8 @@
 from django.urls import path
-from trips.consumers import OperationsMapConsumer
+from trips.consumers import DriverGpsConsumer, OperationsMapConsumer, SchoolMonitorConsumer
 
 websocket_urlpatterns = [
     path("ws/operations/map/", OperationsMapConsumer.as_asgi()),
+    path("ws/drivers/gps/", DriverGpsConsumer.as_asgi()),
+    path("ws/school-monitor/", SchoolMonitorConsumer.as_asgi()),
 ]
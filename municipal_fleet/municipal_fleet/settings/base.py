@@ -136,7 +136,7 @@ REST_FRAMEWORK = {
         "rest_framework.permissions.IsAuthenticated",
     ),
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
-    "PAGE_SIZE": int(os.environ.get("DJANGO_PAGE_SIZE", 10)),
+    "PAGE_SIZE": int(os.environ.get("DJANGO_PAGE_SIZE", "10")),
     "DEFAULT_THROTTLE_CLASSES": [
         "rest_framework.throttling.AnonRateThrottle",
         "rest_framework.throttling.UserRateThrottle",
@@ -181,6 +181,26 @@ else:
         }
     }
 
+# "sync" writes GPS pings inside the request; "queue" stages them for `manage.py flush_gps_queue`.
+GPS_INGESTION_MODE = os.environ.get("GPS_INGESTION_MODE", "sync")
+GPS_QUEUE_FLUSH_BATCH_SIZE = int(os.environ.get("GPS_QUEUE_FLUSH_BATCH_SIZE", "5000"))
+# Ingestion filter: fixes with worse (or zero) accuracy, or implying a faster jump, are dropped.
+GPS_MAX_ACCURACY_M = float(os.environ.get("GPS_MAX_ACCURACY_M", "100"))
+GPS_MAX_SPEED_KMH = float(os.environ.get("GPS_MAX_SPEED_KMH", "180"))
+# Trips are flagged when odometer and GPS distance differ by more than max(MIN_KM, RATIO * GPS km).
+ODOMETER_MISMATCH_MIN_KM = float(os.environ.get("ODOMETER_MISMATCH_MIN_KM", "5"))
+ODOMETER_MISMATCH_RATIO = float(os.environ.get("ODOMETER_MISMATCH_RATIO", "0.2"))
+# Pings are partitioned by month (PostgreSQL); retention archives completed trips older than RETENTION_MONTHS.
+GPS_PARTITION_MONTHS_AHEAD = int(os.environ.get("GPS_PARTITION_MONTHS_AHEAD", "3"))
+GPS_RETENTION_MONTHS = int(os.environ.get("GPS_RETENTION_MONTHS", "12"))
+# Time budget for 2-opt/Or-opt route improvement in trips.routing.optimize_destinations.
+ROUTE_OPTIMIZATION_TIME_BUDGET_MS = int(os.environ.get("ROUTE_OPTIMIZATION_TIME_BUDGET_MS", "200"))
+# "haversine" (straight lines at 35 km/h) or "road_network" (graphs from `manage.py build_road_graph`).
+ROUTING_BACKEND = os.environ.get("ROUTING_BACKEND", "haversine")
+ROAD_GRAPH_DIR = os.environ.get("ROAD_GRAPH_DIR", str(BASE_DIR / "road_graphs"))
+# When > 0, map updates are coalesced and sent by `manage.py broadcast_map_updates` once per tick.
+MAP_BROADCAST_TICK_SECONDS = float(os.environ.get("MAP_BROADCAST_TICK_SECONDS", "0"))
+
 SPECTACULAR_SETTINGS = {
     "TITLE": "Municipal Fleet API",
     "DESCRIPTION": "API REST para gestão de frotas multi-prefeitura.",
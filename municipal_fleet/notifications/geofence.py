@@ -0,0 +1,241 @@
+"""
+Stateful geofence evaluation for the GPS hot path.
+
+The fence of each in-progress trip (the driver's circle or a corridor around
+the assigned route) is cached together with its alert state, so a ping is
+checked with plain math. The database is only touched on exit/return
+transitions and when the cached state is (re)loaded.
+
+Polygon zones (`GeofenceZone`) are kept in a per-municipality grid index held
+in process memory and rebuilt when the municipality's zone version changes.
+"""
+import time
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from drivers.models import DriverGeofence, GeofenceZone
+from notifications.services import (
+    GEOFENCE_COOLDOWN_MINUTES,
+    GEOFENCE_RADIUS_KM,
+    _distance_km,
+    _last_notified_at,
+    _notify_admins,
+)
+from transport_planning.models import Assignment
+from trips.corridor import SegmentIndex
+from trips.zones import PolygonIndex, ZonePolygon
+
+GEOFENCE_STATE_TTL_SECONDS = 10 * 60
+MODE_NONE = "none"
+MODE_CIRCLE = "circle"
+MODE_ROUTE = "route"
+ZONE_STATE_TTL_SECONDS = 12 * 60 * 60
+
+_zone_indexes = {}
+
+
+def state_key(trip_id: int) -> str:
+    return f"geofence:trip:{trip_id}"
+
+
+def invalidate_trip_geofences(trip_ids) -> None:
+    keys = [state_key(trip_id) for trip_id in trip_ids if trip_id]
+    if keys:
+        cache.delete_many(keys)
+
+
+def load_state(trip) -> dict:
+    geofence = DriverGeofence.objects.filter(driver_id=trip.driver_id).first()
+    if geofence:
+        return {
+            "mode": MODE_CIRCLE,
+            "geofence_id": geofence.id,
+            "center": (float(geofence.center_lat), float(geofence.center_lng)),
+            "radius_m": float(geofence.radius_m),
+            "is_active": geofence.is_active,
+            "alert_active": geofence.alert_active,
+        }
+    assignment = (
+        Assignment.objects.filter(generated_trip_id=trip.id).select_related("route").prefetch_related("route__stops").first()
+    )
+    if not assignment:
+        return {"mode": MODE_NONE}
+    # Stops come in route order, so consecutive stops form the planned polyline.
+    points = [(s.lat, s.lng) for s in assignment.route.stops.all() if s.lat is not None and s.lng is not None]
+    corridor = SegmentIndex.from_points(points, float(GEOFENCE_RADIUS_KM) * 1000)
+    if not corridor:
+        return {"mode": MODE_NONE}
+    return {
+        "mode": MODE_ROUTE,
+        "assignment_id": assignment.id,
+        "corridor": corridor,
+        "alerted_until": None,
+    }
+
+
+def evaluate_geofence(trip, ping, now=None) -> bool:
+    """
+    Check a ping against the trip's cached fence and fire exit/return alerts.
+
+    Returns whether the trip is currently flagged as outside its fence, with
+    the same semantics as the original per-ping database evaluation.
+    """
+    now = now or timezone.now()
+    key = state_key(trip.id)
+    state = cache.get(key)
+    if state is None:
+        state = load_state(trip)
+        cache.set(key, state, GEOFENCE_STATE_TTL_SECONDS)
+    if state["mode"] == MODE_CIRCLE:
+        return _evaluate_circle(trip, ping, state, key, now)
+    if state["mode"] == MODE_ROUTE:
+        return _evaluate_route(trip, ping, state, key, now)
+    return False
+
+
+def _evaluate_circle(trip, ping, state, key, now) -> bool:
+    if not state["is_active"]:
+        return False
+    center_lat, center_lng = state["center"]
+    outside = _distance_km(float(ping.lat), float(ping.lng), center_lat, center_lng) * 1000 > state["radius_m"]
+    if outside == state["alert_active"]:
+        return state["alert_active"]
+    geofences = DriverGeofence.objects.filter(id=state["geofence_id"], alert_active=not outside)
+    if outside:
+        changed = geofences.update(alert_active=True, last_alerted_at=now, updated_at=now)
+    else:
+        changed = geofences.update(alert_active=False, cleared_at=now, updated_at=now)
+    state["alert_active"] = outside
+    cache.set(key, state, GEOFENCE_STATE_TTL_SECONDS)
+    if not changed:
+        # Another worker already recorded this transition and notified.
+        return outside
+    metadata = {"trip_id": trip.id, "driver_id": trip.driver_id, "geofence_id": state["geofence_id"]}
+    if outside:
+        event_type = "GEOFENCE_EXIT"
+        title = "Veículo fora do raio"
+        message = f"O veículo {trip.vehicle.license_plate} saiu do raio definido."
+    else:
+        event_type = "GEOFENCE_RETURN"
+        title = "Veículo voltou ao raio"
+        message = f"O veículo {trip.vehicle.license_plate} retornou ao raio definido."
+    _notify_admins(municipality=trip.municipality, event_type=event_type, title=title, message=message, metadata=metadata)
+    return outside
+
+
+def _evaluate_route(trip, ping, state, key, now) -> bool:
+    if state["corridor"].contains(ping.lat, ping.lng):
+        return False
+    alerted_until = state.get("alerted_until")
+    if alerted_until and now.timestamp() < alerted_until:
+        return True
+    cooldown = timedelta(minutes=GEOFENCE_COOLDOWN_MINUTES)
+    metadata = {"trip_id": trip.id, "assignment_id": state["assignment_id"]}
+    last_alerted_at = _last_notified_at("GEOFENCE_EXIT", metadata, cooldown)
+    if last_alerted_at is None:
+        _notify_admins(
+            municipality=trip.municipality,
+            event_type="GEOFENCE_EXIT",
+            title="Veículo fora da rota",
+            message=f"O veículo {trip.vehicle.license_plate} saiu da rota planejada.",
+            metadata=metadata,
+        )
+        last_alerted_at = now
+    state["alerted_until"] = (last_alerted_at + cooldown).timestamp()
+    cache.set(key, state, GEOFENCE_STATE_TTL_SECONDS)
+    return True
+
+
+def zone_version_key(municipality_id: int) -> str:
+    return f"geofence:zones:version:{municipality_id}"
+
+
+def zone_state_key(trip_id: int) -> str:
+    return f"geofence:zones:trip:{trip_id}"
+
+
+def invalidate_zone_index(municipality_id: int) -> None:
+    cache.set(zone_version_key(municipality_id), time.time_ns(), None)
+
+
+def build_zone_index(municipality_id: int) -> PolygonIndex:
+    zones = GeofenceZone.objects.filter(municipality_id=municipality_id, is_active=True).prefetch_related(
+        "drivers", "vehicles"
+    )
+    return PolygonIndex(
+        ZonePolygon(
+            zone.id,
+            zone.polygon,
+            {
+                "name": zone.name,
+                "zone_type": zone.zone_type,
+                "alert_on_enter": zone.alert_on_enter,
+                "alert_on_exit": zone.alert_on_exit,
+                "driver_ids": frozenset(driver.id for driver in zone.drivers.all()),
+                "vehicle_ids": frozenset(vehicle.id for vehicle in zone.vehicles.all()),
+            },
+        )
+        for zone in zones
+    )
+
+
+def zone_index_for(municipality_id: int) -> PolygonIndex:
+    version = cache.get(zone_version_key(municipality_id))
+    if version is None:
+        version = time.time_ns()
+        cache.set(zone_version_key(municipality_id), version, None)
+    cached = _zone_indexes.get(municipality_id)
+    if cached and cached[0] == version:
+        return cached[1]
+    index = build_zone_index(municipality_id)
+    _zone_indexes[municipality_id] = (version, index)
+    return index
+
+
+def _zone_applies(trip, zone: ZonePolygon) -> bool:
+    driver_ids, vehicle_ids = zone.data["driver_ids"], zone.data["vehicle_ids"]
+    if not driver_ids and not vehicle_ids:
+        return True
+    return trip.driver_id in driver_ids or trip.vehicle_id in vehicle_ids
+
+
+def evaluate_zones(trip, ping) -> list:
+    """
+    Fire enter/exit alerts for the polygon zones relevant to the trip.
+
+    The first ping of a trip only records which zones it starts in. Returns the
+    ids of the zones the trip is currently inside.
+    """
+    index = zone_index_for(trip.municipality_id)
+    inside = {zone.zone_id: zone for zone in index.zones_at(ping.lat, ping.lng) if _zone_applies(trip, zone)}
+    key = zone_state_key(trip.id)
+    previous = cache.get(key)
+    if previous is None or previous.keys() != inside.keys():
+        cache.set(key, {zone_id: zone.data["name"] for zone_id, zone in inside.items()}, ZONE_STATE_TTL_SECONDS)
+    if previous is None:
+        return sorted(inside)
+    zones_by_id = {zone.zone_id: zone for zone in index.polygons}
+    for zone_id in inside.keys() - previous.keys():
+        if inside[zone_id].data["alert_on_enter"]:
+            _notify_zone(trip, zone_id, inside[zone_id].data["name"], entered=True)
+    for zone_id in previous.keys() - inside.keys():
+        zone = zones_by_id.get(zone_id)
+        # Zones deleted or deactivated meanwhile do not report an exit.
+        if zone and zone.data["alert_on_exit"]:
+            _notify_zone(trip, zone_id, zone.data["name"], entered=False)
+    return sorted(inside)
+
+
+def _notify_zone(trip, zone_id: int, name: str, entered: bool) -> None:
+    metadata = {"trip_id": trip.id, "driver_id": trip.driver_id, "zone_id": zone_id}
+    if entered:
+        event_type = "GEOFENCE_ZONE_ENTER"
+        title = "Veículo entrou em área monitorada"
+        message = f"O veículo {trip.vehicle.license_plate} entrou na área {name}."
+    else:
+        event_type = "GEOFENCE_ZONE_EXIT"
+        title = "Veículo saiu de área monitorada"
+        message = f"O veículo {trip.vehicle.license_plate} saiu da área {name}."
+    _notify_admins(municipality=trip.municipality, event_type=event_type, title=title, message=message, metadata=metadata)
@@ -40,7 +40,42 @@ def create_notification(
         "channel": channel,
         "metadata": metadata or {},
     }
-    return Notification.objects.create(**payload)
+    notification = Notification.objects.create(**payload)
+    if recipient_driver is not None:
+        push_driver_notification(notification)
+    return notification
+
+
+def driver_channel_group(driver_id: int) -> str:
+    return f"driver_{driver_id}"
+
+
+def push_driver_notification(notification: Notification) -> None:
+    """Deliver a driver notification over the driver's open WebSocket, if any."""
+    from asgiref.sync import async_to_sync
+    from channels.layers import get_channel_layer
+
+    try:
+        channel_layer = get_channel_layer()
+        if not channel_layer:
+            return
+        async_to_sync(channel_layer.group_send)(
+            driver_channel_group(notification.recipient_driver_id),
+            {
+                "type": "driver.notification",
+                "data": {
+                    "id": notification.id,
+                    "event_type": notification.event_type,
+                    "title": notification.title,
+                    "message": notification.message,
+                    "metadata": notification.metadata,
+                    "created_at": notification.created_at.isoformat(),
+                },
+            },
+        )
+    except Exception:  # noqa: BLE001
+        # Realtime delivery is best effort; the notification stays listed in the portal.
+        return
 
 
 def send_email_notification(notification: Notification) -> None:
@@ -66,12 +101,20 @@ def send_email_notification(notification: Notification) -> None:
         notification.save(update_fields=["delivery_error"])
 
 
-def _already_notified(event_type: str, metadata: dict, since: timedelta) -> bool:
+def _notified_since(event_type: str, metadata: dict, since: timedelta):
     cutoff = timezone.now() - since
     qs = Notification.objects.filter(event_type=event_type, created_at__gte=cutoff)
     for key, value in (metadata or {}).items():
         qs = qs.filter(metadata__has_key=key).filter(metadata__contains={key: value})
-    return qs.exists()
+    return qs
+
+
+def _already_notified(event_type: str, metadata: dict, since: timedelta) -> bool:
+    return _notified_since(event_type, metadata, since).exists()
+
+
+def _last_notified_at(event_type: str, metadata: dict, since: timedelta):
+    return _notified_since(event_type, metadata, since).order_by("-created_at").values_list("created_at", flat=True).first()
 
 
 def dispatch_cnh_expiration_alerts():
@@ -171,65 +214,10 @@ def dispatch_trip_reminders():
 
 
 def dispatch_geofence_alert(trip, ping):
-    now = timezone.now()
-    geofence = getattr(trip.driver, "geofence", None)
-    if geofence:
-        if not geofence.is_active:
-            return False
-        distance_km = _distance_km(float(ping.lat), float(ping.lng), float(geofence.center_lat), float(geofence.center_lng))
-        outside = distance_km * 1000 > float(geofence.radius_m)
-        if outside and not geofence.alert_active:
-            geofence.alert_active = True
-            geofence.last_alerted_at = now
-            geofence.save(update_fields=["alert_active", "last_alerted_at", "updated_at"])
-            metadata = {"trip_id": trip.id, "driver_id": trip.driver_id, "geofence_id": geofence.id}
-            title = "Veículo fora do raio"
-            message = f"O veículo {trip.vehicle.license_plate} saiu do raio definido."
-            _notify_admins(
-                municipality=trip.municipality,
-                event_type="GEOFENCE_EXIT",
-                title=title,
-                message=message,
-                metadata=metadata,
-            )
-        if not outside and geofence.alert_active:
-            geofence.alert_active = False
-            geofence.cleared_at = now
-            geofence.save(update_fields=["alert_active", "cleared_at", "updated_at"])
-            metadata = {"trip_id": trip.id, "driver_id": trip.driver_id, "geofence_id": geofence.id}
-            title = "Veículo voltou ao raio"
-            message = f"O veículo {trip.vehicle.license_plate} retornou ao raio definido."
-            _notify_admins(
-                municipality=trip.municipality,
-                event_type="GEOFENCE_RETURN",
-                title=title,
-                message=message,
-                metadata=metadata,
-            )
-        return geofence.alert_active
-
-    assignment = trip.assignments.select_related("route").prefetch_related("route__stops").first()
-    if not assignment:
-        return False
-    stops = [s for s in assignment.route.stops.all() if s.lat is not None and s.lng is not None]
-    if not stops:
-        return False
-    distance = min(_distance_km(float(ping.lat), float(ping.lng), float(s.lat), float(s.lng)) for s in stops)
-    if distance <= float(GEOFENCE_RADIUS_KM):
-        return False
-    metadata = {"trip_id": trip.id, "assignment_id": assignment.id}
-    if _already_notified("GEOFENCE_EXIT", metadata, timedelta(minutes=GEOFENCE_COOLDOWN_MINUTES)):
-        return True
-    title = "Veículo fora da rota"
-    message = f"O veículo {trip.vehicle.license_plate} saiu da rota planejada."
-    _notify_admins(
-        municipality=assignment.municipality,
-        event_type="GEOFENCE_EXIT",
-        title=title,
-        message=message,
-        metadata=metadata,
-    )
-    return True
+    from notifications.geofence import evaluate_geofence, evaluate_zones  # local import to avoid cycles
+
+    evaluate_zones(trip, ping)
+    return evaluate_geofence(trip, ping)
 
 
 def _notify_admins(*, municipality=None, event_type: str, title: str, message: str, metadata: dict):
@@ -0,0 +1,40 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from drivers.models import GeofenceZone
+from notifications.geofence import invalidate_trip_geofences, invalidate_zone_index
+
+
+def _in_progress_trip_ids(**filters):
+    from trips.models import Trip  # local import to avoid cycles
+
+    return list(Trip.objects.filter(status=Trip.Status.IN_PROGRESS, **filters).values_list("id", flat=True))
+
+
+@receiver([post_save, post_delete], sender="drivers.DriverGeofence")
+def reset_driver_geofence_state(sender, instance, **kwargs):
+    invalidate_trip_geofences(_in_progress_trip_ids(driver_id=instance.driver_id))
+
+
+@receiver([post_save, post_delete], sender="transport_planning.RouteStop")
+def reset_route_geofence_state(sender, instance, **kwargs):
+    invalidate_trip_geofences(_in_progress_trip_ids(assignments__route_id=instance.route_id))
+
+
+@receiver([post_save, post_delete], sender="transport_planning.Assignment")
+def reset_assignment_geofence_state(sender, instance, **kwargs):
+    invalidate_trip_geofences([instance.generated_trip_id])
+
+
+@receiver(post_save, sender="trips.Trip")
+def reset_trip_geofence_state(sender, instance, **kwargs):
+    # The driver (and so the fence) can change; new trips may also reuse ids on some backends.
+    invalidate_trip_geofences([instance.id])
+
+
+@receiver([post_save, post_delete], sender=GeofenceZone)
+@receiver(m2m_changed, sender=GeofenceZone.drivers.through)
+@receiver(m2m_changed, sender=GeofenceZone.vehicles.through)
+def refresh_zone_index(sender, instance, **kwargs):
+    # `instance` is the zone, or a driver/vehicle when the relation is edited from its side.
+    invalidate_zone_index(instance.municipality_id)
@@ -0,0 +1,686 @@
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db.models import Sum
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from destinations.models import Destination
+from drivers.models import Driver, DriverGeofence, GeofenceZone
+from drivers.portal import generate_portal_token
+from fleet.models import Vehicle
+from notifications.geofence import evaluate_geofence, evaluate_zones
+from notifications.models import Notification
+from notifications.services import create_notification
+from tenants.models import Municipality
+from transport_planning.models import Assignment, Route, RouteStop, TransportService
+from trips.consumers import CLOSE_TRIP_ENDED, DriverGpsConsumer, SchoolMonitorConsumer
+from trips.eta import DEFAULT_SPEED_KMH, eta_cache_key
+from trips.ingestion import flush_ping_queue, ingest_points, queue_metrics
+from trips.models import (
+    GpsDensityCell,
+    PlannedTrip,
+    StopSegmentSpeed,
+    Trip,
+    TripExecution,
+    TripExecutionStop,
+    TripGpsPing,
+    TripGpsPingQueue,
+    TripGpsStop,
+    TripLastPosition,
+)
+from trips.stops import backfill_trip_stops, stop_state_key
+
+
+class GpsFixtureMixin:
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.muni = Municipality.objects.create(
+            name="Pref GPS",
+            cnpj="44.444.444/0001-44",
+            address="Rua 4",
+            city="Cidade",
+            state="SP",
+            phone="11777770000",
+        )
+        self.driver = Driver.objects.create(
+            municipality=self.muni,
+            name="Motorista GPS",
+            cpf="444.444.444-44",
+            cnh_number="44444",
+            cnh_category="D",
+            cnh_expiration_date="2030-01-01",
+            phone="11777777777",
+        )
+        self.vehicle = Vehicle.objects.create(
+            municipality=self.muni,
+            license_plate="GPS1234",
+            model="Van",
+            brand="Ford",
+            year=2020,
+            max_passengers=10,
+            odometer_current=1000,
+            odometer_initial=900,
+            odometer_monthly_limit=2000,
+        )
+        self.trip = Trip.objects.create(
+            municipality=self.muni,
+            vehicle=self.vehicle,
+            driver=self.driver,
+            origin="A",
+            destination="B",
+            departure_datetime=timezone.now(),
+            return_datetime_expected=timezone.now() + timedelta(hours=1),
+            odometer_start=1000,
+            status=Trip.Status.IN_PROGRESS,
+        )
+        self.token = generate_portal_token(self.driver)
+
+    def _points(self, count, start=None, step_seconds=10):
+        start = start or timezone.now() - timedelta(minutes=10)
+        return [
+            {
+                "lat": f"{-23.550000 - idx * 0.0005:.6f}",
+                "lng": f"{-46.633000 - idx * 0.0005:.6f}",
+                "accuracy": 5.0,
+                "speed": 30.0,
+                "recorded_at": (start + timedelta(seconds=idx * step_seconds)).isoformat(),
+            }
+            for idx in range(count)
+        ]
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class GpsIngestionTests(GpsFixtureMixin, TestCase):
+    def test_batch_ping_inserts_all_points(self):
+        points = self._points(5)
+        resp = self.client.post(
+            "/api/drivers/portal/gps/pings/batch/",
+            {"trip_id": self.trip.id, "points": list(reversed(points))},
+            format="json",
+            HTTP_X_DRIVER_TOKEN=self.token,
+        )
+        self.assertEqual(resp.status_code, 201, resp.data)
+        self.assertEqual(resp.data["accepted"], 5)
+        self.assertEqual(TripGpsPing.objects.filter(trip=self.trip).count(), 5)
+        latest = TripGpsPing.objects.filter(trip=self.trip).first()
+        self.assertEqual(latest.recorded_at, resp.data["last_recorded_at"])
+
+    def test_batch_ping_rejects_whole_batch_on_invalid_point(self):
+        points = self._points(3)
+        points[1]["lat"] = "invalid"
+        resp = self.client.post(
+            "/api/drivers/portal/gps/pings/batch/",
+            {"points": points},
+            format="json",
+            HTTP_X_DRIVER_TOKEN=self.token,
+        )
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(TripGpsPing.objects.exists())
+
+    def test_batch_ping_checks_geofence_against_latest_point(self):
+        DriverGeofence.objects.create(
+            driver=self.driver, center_lat="-23.550000", center_lng="-46.633000", radius_m=100
+        )
+        resp = self.client.post(
+            "/api/drivers/portal/gps/pings/batch/",
+            {"points": self._points(10)},
+            format="json",
+            HTTP_X_DRIVER_TOKEN=self.token,
+        )
+        self.assertEqual(resp.status_code, 201, resp.data)
+        self.assertTrue(resp.data["geofence_alert_active"])
+        self.assertTrue(DriverGeofence.objects.get(driver=self.driver).alert_active)
+
+    def test_density_grid_is_maintained_incrementally_and_served(self):
+        points = self._points(10)
+        for batch in (points[:5], points[5:]):
+            resp = self.client.post(
+                "/api/drivers/portal/gps/pings/batch/",
+                {"trip_id": self.trip.id, "points": batch},
+                format="json",
+                HTTP_X_DRIVER_TOKEN=self.token,
+            )
+            self.assertEqual(resp.status_code, 201, resp.data)
+        def cells():
+            return sorted(GpsDensityCell.objects.values_list("day", "hour", "lat_index", "lng_index", "ping_count"))
+
+        incremental = cells()
+        self.assertEqual(sum(cell[-1] for cell in incremental), 10)
+        self.assertGreater(len(incremental), 1)
+        day = incremental[0][0]
+        call_command("build_gps_heatmap", since=str(day), until=str(day), stdout=StringIO())
+        self.assertEqual(cells(), incremental)
+
+        admin = User.objects.create_user(
+            email="heatmap@gps.com", password="pass123", role=User.Roles.ADMIN_MUNICIPALITY, municipality=self.muni
+        )
+        self.client.force_authenticate(admin)
+        resp = self.client.get(f"/api/trips/heatmap/?start_date={day}&end_date={day}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(sum(cell["count"] for cell in resp.data["cells"]), 10)
+        self.assertEqual(resp.data["max_count"], resp.data["cells"][0]["count"])
+        resp = self.client.get(f"/api/trips/heatmap/?start_date={day}&end_date={day}&bbox=-46.634,-23.551,-46.632,-23.549")
+        self.assertEqual(sum(cell["count"] for cell in resp.data["cells"]), 3)
+        resp = self.client.get(f"/api/trips/heatmap/?start_date={day}&end_date={day}&hours=25")
+        self.assertEqual(resp.status_code, 400)
+        superadmin = User.objects.create_user(email="root@gps.com", password="pass123", role=User.Roles.SUPERADMIN)
+        self.client.force_authenticate(superadmin)
+        resp = self.client.get(f"/api/trips/heatmap/?start_date={day}&end_date={day}&municipality={self.muni.id}")
+        self.assertEqual(sum(cell["count"] for cell in resp.data["cells"]), 10)
+        resp = self.client.get(f"/api/trips/heatmap/?start_date={day}&end_date={day}&municipality=abc")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_last_position_tracks_newest_point_and_feeds_map_state(self):
+        points = self._points(3)
+        resp = self.client.post(
+            "/api/drivers/portal/gps/pings/batch/",
+            {"points": points},
+            format="json",
+            HTTP_X_DRIVER_TOKEN=self.token,
+        )
+        self.assertEqual(resp.status_code, 201, resp.data)
+        stale = dict(points[0], recorded_at=(timezone.now() - timedelta(hours=1)).isoformat())
+        resp = self.client.post("/api/drivers/portal/gps/ping/", stale, format="json", HTTP_X_DRIVER_TOKEN=self.token)
+        self.assertEqual(resp.status_code, 201, resp.data)
+
+        position = TripLastPosition.objects.get(trip=self.trip)
+        self.assertEqual(str(position.lat), points[-1]["lat"])
+
+        admin = User.objects.create_user(
+            email="admin@gps.com",
+            password="pass123",
+            role=User.Roles.ADMIN_MUNICIPALITY,
+            municipality=self.muni,
+        )
+        self.client.force_authenticate(admin)
+        resp = self.client.get("/api/trips/map-state/?include_history=false")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data["drivers"][0]["last_point"]["lat"], float(points[-1]["lat"]))
+
+    def test_filter_drops_inaccurate_duplicate_and_teleporting_points(self):
+        points = self._points(4)
+        points[1]["accuracy"] = 0
+        points[2]["lat"] = "-22.900000"
+        duplicate = dict(points[3])
+        resp = self.client.post(
+            "/api/drivers/portal/gps/pings/batch/",
+            {"points": points + [duplicate]},
+            format="json",
+            HTTP_X_DRIVER_TOKEN=self.token,
+        )
+        self.assertEqual(resp.status_code, 201, resp.data)
+        self.assertEqual(resp.data["accepted"], 2)
+        self.assertEqual(resp.data["rejected"], {"accuracy": 1, "duplicate": 1, "speed": 1})
+
+        resp = self.client.post("/api/drivers/portal/gps/ping/", points[3], format="json", HTTP_X_DRIVER_TOKEN=self.token)
+        self.assertEqual(resp.status_code, 200, resp.data)
+        self.assertEqual(resp.data["rejected"]["duplicate"], 1)
+        self.assertEqual(TripGpsPing.objects.filter(trip=self.trip).count(), 2)
+        self.assertEqual(queue_metrics()["rejected"], {"accuracy": 1, "duplicate": 2, "speed": 1})
+
+    def test_outlier_first_fix_does_not_block_later_fixes(self):
+        points = self._points(5)
+        outlier = dict(points[0], lat="-23.100000", recorded_at=(timezone.now() - timedelta(minutes=11)).isoformat())
+        resp = self.client.post("/api/drivers/portal/gps/ping/", outlier, format="json", HTTP_X_DRIVER_TOKEN=self.token)
+        self.assertEqual(resp.status_code, 201, resp.data)
+        # Each real fix is 50 km away from the outlier; the third consistent one replaces it as the reference.
+        resp = self.client.post(
+            "/api/drivers/portal/gps/pings/batch/", {"points": points}, format="json", HTTP_X_DRIVER_TOKEN=self.token
+        )
+        self.assertEqual((resp.data["accepted"], resp.data["rejected"]["speed"]), (3, 2))
+        resp = self.client.post(
+            "/api/drivers/portal/gps/pings/batch/", {"points": self._points(2, start=timezone.now() - timedelta(minutes=5))},
+            format="json", HTTP_X_DRIVER_TOKEN=self.token,
+        )
+        self.assertEqual(resp.data["accepted"], 2)
+
+    def test_resent_batch_is_not_stored_twice(self):
+        points = self._points(5)
+        for expected in (5, 0):
+            resp = self.client.post(
+                "/api/drivers/portal/gps/pings/batch/", {"points": points}, format="json", HTTP_X_DRIVER_TOKEN=self.token
+            )
+            self.assertEqual(resp.status_code, 201, resp.data)
+            self.assertEqual(resp.data["accepted"], expected)
+        self.assertEqual(resp.data["rejected"]["duplicate"], 5)
+        # A single fix older than the newest one is resent through the one-point endpoint.
+        resp = self.client.post("/api/drivers/portal/gps/ping/", points[1], format="json", HTTP_X_DRIVER_TOKEN=self.token)
+        self.assertEqual(resp.status_code, 200, resp.data)
+        self.assertEqual(resp.data["rejected"]["duplicate"], 1)
+        self.assertEqual(TripGpsPing.objects.filter(trip=self.trip).count(), 5)
+        # Older than the newest stored fix, but new: still accepted.
+        late = dict(points[0], recorded_at=(timezone.now() - timedelta(hours=1)).isoformat())
+        resp = self.client.post(
+            "/api/drivers/portal/gps/pings/batch/", {"points": [late, late]}, format="json", HTTP_X_DRIVER_TOKEN=self.token
+        )
+        self.assertEqual((resp.data["accepted"], resp.data["rejected"]["duplicate"]), (1, 1))
+        self.assertEqual(TripGpsPing.objects.filter(trip=self.trip).count(), 6)
+
+    def test_single_ping_query_budget(self):
+        DriverGeofence.objects.create(
+            driver=self.driver, center_lat="-23.550000", center_lng="-46.633000", radius_m=5000
+        )
+        points = self._points(3)
+        for point in points[:2]:
+            self.client.post("/api/drivers/portal/gps/ping/", point, format="json", HTTP_X_DRIVER_TOKEN=self.token)
+        # Steady state: driver, trip, duplicate check, insert, density upsert, last position.
+        with self.assertNumQueries(6):
+            resp = self.client.post("/api/drivers/portal/gps/ping/", points[2], format="json", HTTP_X_DRIVER_TOKEN=self.token)
+        self.assertEqual(resp.status_code, 201, resp.data)
+        self.assertEqual(GpsDensityCell.objects.filter(municipality=self.muni).aggregate(total=Sum("ping_count"))["total"], 3)
+
+    def test_stops_are_detected_incrementally_and_match_backfill(self):
+        start = timezone.now() - timedelta(minutes=20)
+        parked = [
+            {"lat": "-23.550000", "lng": "-46.633000", "accuracy": 5.0, "speed": 0.0,
+             "recorded_at": (start + timedelta(seconds=idx * 30)).isoformat()}
+            for idx in range(8)
+        ]
+        for chunk in (parked[:3], parked[3:]):
+            resp = self.client.post(
+                "/api/drivers/portal/gps/pings/batch/", {"points": chunk}, format="json", HTTP_X_DRIVER_TOKEN=self.token
+            )
+            self.assertEqual(resp.status_code, 201, resp.data)
+        stop = TripGpsStop.objects.get(trip=self.trip)
+        self.assertIsNone(stop.ended_at)
+
+        leaving = {"lat": "-23.553000", "lng": "-46.633000", "accuracy": 5.0, "speed": 30.0,
+                   "recorded_at": (start + timedelta(seconds=300)).isoformat()}
+        resp = self.client.post("/api/drivers/portal/gps/ping/", leaving, format="json", HTTP_X_DRIVER_TOKEN=self.token)
+        self.assertEqual(resp.status_code, 201, resp.data)
+        stop.refresh_from_db()
+        self.assertEqual(stop.duration_seconds, 210)
+        self.assertEqual(stop.point_count, 8)
+
+        self.assertEqual(backfill_trip_stops(self.trip), 1)
+        rebuilt = TripGpsStop.objects.get(trip=self.trip)
+        self.assertEqual((rebuilt.started_at, rebuilt.ended_at), (stop.started_at, stop.ended_at))
+
+        admin = User.objects.create_user(
+            email="stops@gps.com", password="pass123", role=User.Roles.ADMIN_MUNICIPALITY, municipality=self.muni
+        )
+        self.client.force_authenticate(admin)
+        resp = self.client.get(f"/api/trips/{self.trip.id}/gps/stops/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data["idle_seconds"], 210)
+
+    def test_trip_completed_while_stopped_closes_its_last_stop(self):
+        start = (timezone.now() - timedelta(minutes=20)).replace(microsecond=0)
+        parked = [
+            {"lat": "-23.550000", "lng": "-46.633000", "accuracy": 5.0, "speed": 0.0,
+             "recorded_at": (start + timedelta(seconds=idx * 60)).isoformat()}
+            for idx in range(6)
+        ]
+        for chunk in (parked[:3], parked[3:]):
+            resp = self.client.post(
+                "/api/drivers/portal/gps/pings/batch/", {"points": chunk}, format="json", HTTP_X_DRIVER_TOKEN=self.token
+            )
+            self.assertEqual(resp.status_code, 201, resp.data)
+        # The open stop grows with each batch instead of keeping its opening duration.
+        stop = TripGpsStop.objects.get(trip=self.trip)
+        self.assertEqual((stop.ended_at, stop.duration_seconds, stop.point_count), (None, 300, 6))
+
+        admin = User.objects.create_user(
+            email="closing@gps.com", password="pass123", role=User.Roles.ADMIN_MUNICIPALITY, municipality=self.muni
+        )
+        self.client.force_authenticate(admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.client.patch(
+                f"/api/trips/{self.trip.id}/", {"status": Trip.Status.COMPLETED, "odometer_end": 1050}, format="json"
+            )
+        self.assertEqual(resp.status_code, 200, resp.data)
+        stop.refresh_from_db()
+        self.assertEqual(stop.ended_at, start + timedelta(seconds=300))
+        self.assertEqual(stop.duration_seconds, 300)
+        self.assertIsNone(cache.get(stop_state_key(self.trip.id)))
+
+    @override_settings(GPS_INGESTION_MODE="queue")
+    def test_queue_mode_defers_writes_to_flusher(self):
+        points = self._points(4)
+        resp = self.client.post(
+            "/api/drivers/portal/gps/pings/batch/",
+            {"points": points},
+            format="json",
+            HTTP_X_DRIVER_TOKEN=self.token,
+        )
+        self.assertEqual(resp.status_code, 202, resp.data)
+        later = dict(points[-1], recorded_at=(timezone.now() - timedelta(seconds=5)).isoformat())
+        resp = self.client.post("/api/drivers/portal/gps/ping/", later, format="json", HTTP_X_DRIVER_TOKEN=self.token)
+        self.assertEqual(resp.status_code, 202, resp.data)
+        self.assertFalse(TripGpsPing.objects.exists())
+        self.assertEqual(queue_metrics()["queue_depth"], 5)
+
+        self.assertEqual(flush_ping_queue(), 5)
+        self.assertEqual(TripGpsPing.objects.filter(trip=self.trip).count(), 5)
+        self.assertFalse(TripGpsPingQueue.objects.exists())
+        self.assertEqual(str(TripLastPosition.objects.get(trip=self.trip).lat), later["lat"])
+        metrics = queue_metrics()
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertEqual(metrics["last_flush"]["rows"], 5)
+
+    @override_settings(GPS_INGESTION_MODE="queue")
+    def test_flusher_skips_live_side_effects_of_finished_trips(self):
+        resp = self.client.post(
+            "/api/drivers/portal/gps/pings/batch/", {"points": self._points(3)}, format="json", HTTP_X_DRIVER_TOKEN=self.token
+        )
+        self.assertEqual(resp.status_code, 202, resp.data)
+        Trip.objects.filter(id=self.trip.id).update(status=Trip.Status.COMPLETED)
+        with mock.patch("trips.ingestion.apply_ping_side_effects") as side_effects:
+            self.assertEqual(flush_ping_queue(), 3)
+        side_effects.assert_not_called()
+        self.assertEqual(TripGpsPing.objects.filter(trip=self.trip).count(), 3)
+        self.assertFalse(TripLastPosition.objects.filter(trip=self.trip).exists())
+        self.assertEqual(GpsDensityCell.objects.aggregate(total=Sum("ping_count"))["total"], 3)
+
+
+class GeofenceEngineTests(GpsFixtureMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        User.objects.create_user(
+            email="operator@gps.com",
+            password="pass123",
+            role=User.Roles.OPERATOR,
+            municipality=self.muni,
+        )
+
+    def _ping(self, lat, lng="-46.633000"):
+        return TripGpsPing(trip=self.trip, driver=self.driver, lat=lat, lng=lng, recorded_at=timezone.now())
+
+    def test_circle_checks_skip_database_until_a_transition(self):
+        geofence = DriverGeofence.objects.create(
+            driver=self.driver, center_lat="-23.550000", center_lng="-46.633000", radius_m=100
+        )
+        self.assertFalse(evaluate_geofence(self.trip, self._ping("-23.550100")))
+        with self.assertNumQueries(0):
+            self.assertFalse(evaluate_geofence(self.trip, self._ping("-23.550200")))
+
+        self.assertTrue(evaluate_geofence(self.trip, self._ping("-23.560000")))
+        with self.assertNumQueries(0):
+            self.assertTrue(evaluate_geofence(self.trip, self._ping("-23.561000")))
+        geofence.refresh_from_db()
+        self.assertTrue(geofence.alert_active)
+        self.assertEqual(Notification.objects.filter(event_type="GEOFENCE_EXIT").count(), 1)
+
+        self.assertFalse(evaluate_geofence(self.trip, self._ping("-23.550000")))
+        geofence.refresh_from_db()
+        self.assertFalse(geofence.alert_active)
+        self.assertEqual(Notification.objects.filter(event_type="GEOFENCE_RETURN").count(), 1)
+
+    def test_editing_the_geofence_resets_cached_state(self):
+        geofence = DriverGeofence.objects.create(
+            driver=self.driver, center_lat="-23.550000", center_lng="-46.633000", radius_m=100
+        )
+        self.assertTrue(evaluate_geofence(self.trip, self._ping("-23.560000")))
+        geofence.is_active = False
+        geofence.save()
+        self.assertFalse(evaluate_geofence(self.trip, self._ping("-23.560000")))
+
+    def test_route_mode_alerts_once_per_cooldown(self):
+        service = TransportService.objects.create(
+            municipality=self.muni, name="Escolar", service_type=TransportService.ServiceType.SCHEDULED
+        )
+        route = Route.objects.create(municipality=self.muni, transport_service=service, code="G1", name="Rota GPS")
+        RouteStop.objects.create(
+            municipality=self.muni, route=route, order=1, description="Ponto", lat="-23.550000", lng="-46.633000"
+        )
+        RouteStop.objects.create(
+            municipality=self.muni, route=route, order=2, description="Escola", lat="-23.550000", lng="-46.733000"
+        )
+        Assignment.objects.create(
+            municipality=self.muni,
+            route=route,
+            date=timezone.localdate(),
+            vehicle=self.vehicle,
+            driver=self.driver,
+            generated_trip=self.trip,
+        )
+        # Halfway between two stops ~10 km apart is still on the planned route.
+        self.assertFalse(evaluate_geofence(self.trip, self._ping("-23.551000", lng="-46.683000")))
+        # JSON containment lookups are not available on SQLite.
+        with mock.patch("notifications.geofence._last_notified_at", return_value=None) as last_notified:
+            self.assertTrue(evaluate_geofence(self.trip, self._ping("-23.600000")))
+            with self.assertNumQueries(0):
+                self.assertTrue(evaluate_geofence(self.trip, self._ping("-23.601000")))
+        self.assertEqual(last_notified.call_count, 1)
+        self.assertEqual(Notification.objects.filter(event_type="GEOFENCE_EXIT").count(), 1)
+
+
+class GeofenceZoneTests(GpsFixtureMixin, TestCase):
+    SQUARE = ([-23.54, -46.64], [-23.54, -46.62], [-23.56, -46.62], [-23.56, -46.64])
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_user(
+            email="zones@gps.com",
+            password="pass123",
+            role=User.Roles.ADMIN_MUNICIPALITY,
+            municipality=self.muni,
+        )
+
+    def tearDown(self):
+        # Zone indexes are keyed by municipality id, which the test database reuses.
+        cache.clear()
+
+    def _ping(self, lat, lng):
+        return TripGpsPing(trip=self.trip, driver=self.driver, lat=lat, lng=lng, recorded_at=timezone.now())
+
+    def test_create_zone_validates_polygon(self):
+        self.client.force_authenticate(self.admin)
+        resp = self.client.post(
+            "/api/drivers/geofence-zones/", {"name": "Escola", "polygon": [[-23.5, -46.6]]}, format="json"
+        )
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.post(
+            "/api/drivers/geofence-zones/",
+            {"name": "Escola", "zone_type": "SCHOOL", "polygon": list(self.SQUARE)},
+            format="json",
+        )
+        self.assertEqual(resp.status_code, 201, resp.data)
+        self.assertEqual(resp.data["municipality"], self.muni.id)
+
+    def test_enter_and_exit_events_notify_admins(self):
+        zone = GeofenceZone.objects.create(municipality=self.muni, name="Escola Central", polygon=list(self.SQUARE))
+        self.assertEqual(evaluate_zones(self.trip, self._ping(-23.50, -46.63)), [])
+        self.assertEqual(evaluate_zones(self.trip, self._ping(-23.55, -46.63)), [zone.id])
+        with self.assertNumQueries(0):
+            evaluate_zones(self.trip, self._ping(-23.551, -46.631))
+        evaluate_zones(self.trip, self._ping(-23.50, -46.63))
+        events = list(Notification.objects.filter(recipient_user=self.admin).values_list("event_type", flat=True))
+        self.assertEqual(sorted(events), ["GEOFENCE_ZONE_ENTER", "GEOFENCE_ZONE_EXIT"])
+
+    def test_zone_restricted_to_other_driver_is_ignored(self):
+        other = Driver.objects.create(
+            municipality=self.muni,
+            name="Outro",
+            cpf="999.444.444-44",
+            cnh_number="94444",
+            cnh_category="D",
+            cnh_expiration_date="2030-01-01",
+            phone="11777777700",
+        )
+        zone = GeofenceZone.objects.create(municipality=self.muni, name="Garagem", polygon=list(self.SQUARE))
+        self.assertEqual(evaluate_zones(self.trip, self._ping(-23.55, -46.63)), [zone.id])
+        zone.drivers.add(other)
+        self.assertEqual(evaluate_zones(self.trip, self._ping(-23.55, -46.63)), [])
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class DriverGpsConsumerTests(GpsFixtureMixin, TestCase):
+    def _communicator(self, token=None):
+        return WebsocketCommunicator(
+            DriverGpsConsumer.as_asgi(), f"/ws/drivers/gps/?driver_token={token or self.token}"
+        )
+
+    def test_rejects_invalid_token(self):
+        async def scenario():
+            communicator = self._communicator(token="invalid")
+            connected, _ = await communicator.connect()
+            self.assertFalse(connected)
+
+        async_to_sync(scenario)()
+
+    def test_streams_compact_frames_and_pushes_notifications(self):
+        epoch_ms = int((timezone.now() - timedelta(seconds=30)).timestamp() * 1000)
+
+        async def scenario():
+            communicator = self._communicator()
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            ready = await communicator.receive_json_from()
+            self.assertEqual(ready["payload"]["trip_id"], self.trip.id)
+
+            await communicator.send_json_to({"p": [[-23.55, -46.63, 5, 20, epoch_ms], [-23.551, -46.631, 5, 20, epoch_ms + 5000]]})
+            ack = await communicator.receive_json_from()
+            self.assertEqual(ack["event"], "ack")
+            self.assertEqual(ack["payload"]["accepted"], 2)
+
+            await communicator.send_json_to({"p": ["x", -46.63]})
+            error = await communicator.receive_json_from()
+            self.assertEqual(error["event"], "error")
+
+            await sync_to_async(create_notification)(
+                municipality=self.muni,
+                recipient_driver=self.driver,
+                event_type="TEST",
+                title="Aviso",
+                message="Mensagem",
+                channel=Notification.Channel.PUSH,
+            )
+            pushed = await communicator.receive_json_from()
+            self.assertEqual(pushed["event"], "notification")
+            self.assertEqual(pushed["payload"]["title"], "Aviso")
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(TripGpsPing.objects.filter(trip=self.trip).count(), 2)
+        self.assertEqual(str(TripLastPosition.objects.get(trip=self.trip).lat), "-23.551000")
+
+
+    def test_closes_socket_once_trip_is_completed(self):
+        epoch_ms = int((timezone.now() - timedelta(seconds=30)).timestamp() * 1000)
+
+        async def scenario():
+            communicator = self._communicator()
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()
+            await sync_to_async(Trip.objects.filter(id=self.trip.id).update)(status=Trip.Status.COMPLETED)
+            await communicator.send_json_to({"p": [-23.55, -46.63, 5, 20, epoch_ms]})
+            ended = await communicator.receive_json_from()
+            self.assertEqual(ended["event"], "trip_ended")
+            closed = await communicator.receive_output()
+            self.assertEqual(closed, {"type": "websocket.close", "code": CLOSE_TRIP_ENDED})
+
+        async_to_sync(scenario)()
+        self.assertFalse(TripGpsPing.objects.filter(trip=self.trip).exists())
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class ExecutionStopStampingTests(GpsFixtureMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_user(
+            email="monitor@gps.com", password="pass123", role=User.Roles.ADMIN_MUNICIPALITY, municipality=self.muni
+        )
+        execution = TripExecution.objects.create(
+            municipality=self.muni,
+            module=PlannedTrip.Module.EDUCATION,
+            vehicle=self.vehicle,
+            driver=self.driver,
+            status=TripExecution.Status.IN_PROGRESS,
+            scheduled_departure=timezone.now() - timedelta(minutes=30),
+            scheduled_return=timezone.now() + timedelta(hours=1),
+        )
+        self.stops = [
+            TripExecutionStop.objects.create(
+                trip_execution=execution,
+                order=order,
+                destination=Destination.objects.create(
+                    municipality=self.muni,
+                    name=f"Parada {order}",
+                    address="Rua",
+                    number="1",
+                    district="Centro",
+                    city="Cidade",
+                    state="SP",
+                    postal_code="00000-000",
+                    latitude=lat,
+                    longitude="-46.633000",
+                ),
+            )
+            for order, lat in enumerate(["-23.550000", "-23.560000", "-23.570000"])
+        ]
+
+    def test_pings_stamp_arrivals_and_departures_and_notify_monitor(self):
+        start = timezone.now() - timedelta(minutes=10)
+        lats = ["-23.550000", "-23.552000", "-23.556000", "-23.560000", "-23.570000"]
+        points = [
+            {"lat": lat, "lng": "-46.633000", "accuracy": 5.0, "speed": 30.0, "recorded_at": start + timedelta(seconds=idx * 30)}
+            for idx, lat in enumerate(lats)
+        ]
+
+        async def scenario():
+            communicator = WebsocketCommunicator(SchoolMonitorConsumer.as_asgi(), "/ws/school-monitor/")
+            communicator.scope["user"] = self.admin
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            for point in points:
+                await sync_to_async(ingest_points)(self.trip, self.driver, [point])
+            events = []
+            while not await communicator.receive_nothing():
+                events.append((await communicator.receive_json_from())["payload"])
+            await communicator.disconnect()
+            return events
+
+        events = async_to_sync(scenario)()
+        self.assertEqual(
+            [(event["order"], "arrival_time" in event) for event in events],
+            [(0, True), (0, False), (1, True), (1, False), (2, True)],
+        )
+        for stop in self.stops:
+            stop.refresh_from_db()
+        self.assertEqual(self.stops[0].arrival_time, points[0]["recorded_at"])
+        self.assertEqual(self.stops[0].departure_time, points[1]["recorded_at"])
+        self.assertEqual(self.stops[1].departure_time, points[4]["recorded_at"])
+        self.assertEqual(self.stops[2].arrival_time, points[4]["recorded_at"])
+        self.assertIsNone(self.stops[2].departure_time)
+
+    def test_etas_are_cached_and_segment_speed_is_learned(self):
+        start = timezone.now() - timedelta(minutes=10)
+        lats = ["-23.550000", "-23.552000", "-23.556000", "-23.560000"]
+        points = [
+            {"lat": lat, "lng": "-46.633000", "accuracy": 5.0, "speed": 30.0, "recorded_at": start + timedelta(seconds=idx * 30)}
+            for idx, lat in enumerate(lats)
+        ]
+        for point in points:
+            ingest_points(self.trip, self.driver, [point])
+
+        execution_id = self.stops[0].trip_execution_id
+        learned = StopSegmentSpeed.objects.get(
+            from_destination=self.stops[0].destination, to_destination=self.stops[1].destination
+        )
+        self.assertEqual(learned.samples, 1)
+        # ~1.11 km between departure (30s) and arrival (90s).
+        self.assertAlmostEqual(learned.avg_speed_kmh, 66.7, delta=1)
+
+        payload = cache.get(eta_cache_key(execution_id))
+        self.assertEqual([item["stop_id"] for item in payload["stops"]], [self.stops[2].id])
+        eta_seconds = (timezone.datetime.fromisoformat(payload["stops"][0]["eta"]) - points[3]["recorded_at"]).total_seconds()
+        self.assertAlmostEqual(eta_seconds, 1.112 / DEFAULT_SPEED_KMH * 3600, delta=5)
+
+        self.client.force_authenticate(self.admin)
+        resp = self.client.get("/api/trips/school-monitor/")
+        self.assertEqual(resp.status_code, 200)
+        execution = next(item for item in resp.data["executions"] if item["id"] == execution_id)
+        self.assertEqual(execution["eta_updated_at"], payload["computed_at"])
+        self.assertEqual([stop["eta"] for stop in execution["stops"]], [None, None, payload["stops"][0]["eta"]])
+        resp = self.client.get(f"/api/trips/executions/{execution_id}/eta/")
+        self.assertEqual(resp.data["stops"], payload["stops"])
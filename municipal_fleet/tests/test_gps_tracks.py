@@ -0,0 +1,658 @@
+import asyncio
+import json
+import random
+import time
+from datetime import timedelta
+from io import StringIO
+from itertools import pairwise
+from math import inf
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts.models import User
+from destinations.models import Destination
+from drivers.models import Driver
+from fleet.models import Vehicle
+from tenants.models import Municipality
+from trips import matrix as destination_matrix
+from trips.clustering import cluster_positions
+from trips.corridor import SegmentIndex, _point_segment_distance
+from trips.distance import haversine_track_km, track_distance_km
+from trips.models import DestinationMatrix, Trip, TripGpsPing, TripGpsTrack
+from trips.partitions import (
+    DEFAULT_PARTITION,
+    add_months,
+    apply_retention,
+    ensure_partitions,
+    iter_track,
+    month_start,
+    pack_track,
+    partition_name,
+    unpack_track,
+)
+from trips.polyline import decode_polyline, decode_values, encode_polyline
+from trips.replay import areplay_rows, replay_rows
+from trips.routing import (
+    destinations_matrix,
+    haversine_km,
+    improve_order,
+    nearest_neighbor_order,
+    optimize_destinations,
+    path_length,
+    route_summary,
+)
+from trips.simplify import douglas_peucker_mask, tolerance_for_zoom
+from trips.stops import STOP_CLOSED, STOP_OPENED, StopDetector
+from trips.zones import PolygonIndex, ZonePolygon
+
+
+class SimplifyTests(SimpleTestCase):
+    def test_collinear_points_are_dropped(self):
+        lats = [-23.55 + idx * 0.001 for idx in range(50)]
+        lngs = [-46.63] * 50
+        mask = douglas_peucker_mask(lats, lngs, 5.0)
+        self.assertEqual(mask.sum(), 2)
+
+    def test_corner_is_kept(self):
+        lats = [0.0, 0.0, 0.0, 0.01, 0.02]
+        lngs = [0.0, 0.01, 0.02, 0.02, 0.02]
+        mask = douglas_peucker_mask(lats, lngs, 10.0)
+        self.assertEqual(list(mask), [True, False, True, False, True])
+
+    def test_tolerance_shrinks_with_zoom(self):
+        self.assertGreater(tolerance_for_zoom(10, -23.5), tolerance_for_zoom(16, -23.5))
+
+
+class PolylineTests(SimpleTestCase):
+    def test_matches_reference_encoding(self):
+        encoded = encode_polyline([38.5, 40.7, 43.252], [-120.2, -120.95, -126.453])
+        self.assertEqual(encoded, "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+        self.assertEqual(decode_polyline(encoded), [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)])
+
+
+class DistanceTests(SimpleTestCase):
+    def test_vectorized_haversine_matches_reference(self):
+        # One degree of latitude along a meridian.
+        self.assertAlmostEqual(haversine_track_km([0.0, 1.0], [0.0, 0.0]), 111.195, places=2)
+        self.assertEqual(haversine_track_km([1.0], [1.0]), 0.0)
+
+
+class StopDetectorTests(SimpleTestCase):
+    def test_single_pass_emits_open_and_close(self):
+        detector = StopDetector()
+        events = []
+        # Moving, then ~3 minutes parked with GPS jitter, then moving again.
+        track = [(-23.5400, -46.63, 0), (-23.5450, -46.63, 30)]
+        track += [(-23.5500 + (idx % 2) * 0.0001, -46.63, 60 + idx * 20) for idx in range(10)]
+        track += [(-23.5600, -46.63, 300)]
+        for lat, lng, ts in track:
+            events.extend(event for event, _ in detector.feed(lat, lng, ts))
+        self.assertEqual(events, [STOP_OPENED, STOP_CLOSED])
+        self.assertEqual(detector.finish(), [])
+
+    def test_short_pause_is_not_a_stop(self):
+        detector = StopDetector()
+        for lat, lng, ts in [(-23.55, -46.63, 0), (-23.55, -46.63, 60), (-23.56, -46.63, 90)]:
+            self.assertEqual(detector.feed(lat, lng, ts), [])
+
+
+class CorridorTests(SimpleTestCase):
+    def test_matches_brute_force_along_long_route(self):
+        rng = random.Random(7)
+        points = [(-23.5 + idx * 0.02, -46.6 + rng.uniform(-0.02, 0.02)) for idx in range(40)]
+        index = SegmentIndex.from_points(points, 500)
+        for _ in range(300):
+            lat = rng.uniform(-23.52, -22.7)
+            lng = rng.uniform(-46.64, -46.56)
+            x, y = index._project(lat, lng)
+            expected = min(_point_segment_distance(x, y, *segment) for segment in index.segments)
+            distance = index.distance_m(lat, lng)
+            self.assertEqual(index.contains(lat, lng), expected <= 500)
+            if expected <= 500:
+                self.assertAlmostEqual(distance, expected)
+            else:
+                self.assertTrue(distance > 500 or distance == inf)
+
+    def test_single_point_route(self):
+        index = SegmentIndex.from_points([(-23.55, -46.63)], 500)
+        self.assertTrue(index.contains(-23.553, -46.63))
+        self.assertFalse(index.contains(-23.56, -46.63))
+
+
+class ClusterTests(SimpleTestCase):
+    def test_positions_are_grouped_per_grid_cell_with_status_breakdown(self):
+        now = timezone.now()
+        positions = [
+            SimpleNamespace(trip_id=1, lat="-23.5500", lng="-46.6300", speed=30.0, recorded_at=now),
+            SimpleNamespace(trip_id=2, lat="-23.5510", lng="-46.6310", speed=0.0, recorded_at=now),
+            SimpleNamespace(trip_id=3, lat="-23.5520", lng="-46.6320", speed=30.0, recorded_at=now - timedelta(hours=1)),
+            SimpleNamespace(trip_id=4, lat="-22.9000", lng="-43.2000", speed=30.0, recorded_at=now),
+        ]
+        clusters = cluster_positions(positions, zoom=8, now=now)
+        self.assertEqual([cluster["count"] for cluster in clusters], [3, 1])
+        self.assertEqual(clusters[0]["statuses"], {"IN_ROUTE": 1, "STOPPED": 1, "OFFLINE": 1})
+        self.assertAlmostEqual(clusters[0]["lat"], -23.551)
+        self.assertEqual(clusters[0]["bbox"], [-46.632, -23.552, -46.63, -23.55])
+        self.assertIsNone(clusters[0]["trip_id"])
+        self.assertEqual(clusters[1]["trip_id"], 4)
+        self.assertEqual(len(cluster_positions(positions, zoom=18, now=now)), 4)
+
+
+@override_settings(ROUTE_OPTIMIZATION_TIME_BUDGET_MS=5000)
+class RouteOptimizationTests(SimpleTestCase):
+    def setUp(self):
+        rng = random.Random(7)
+        self.destinations = [
+            SimpleNamespace(id=idx, latitude=-23.5 + rng.random() * 0.2, longitude=-46.6 + rng.random() * 0.2)
+            for idx in range(60)
+        ]
+        self.matrix = destinations_matrix(self.destinations)
+
+    def test_matrix_matches_haversine(self):
+        first, second = self.destinations[:2]
+        expected = haversine_km(first.latitude, first.longitude, second.latitude, second.longitude)
+        self.assertAlmostEqual(self.matrix[0, 1], expected, places=9)
+        self.assertEqual(self.matrix[3, 3], 0)
+
+    def test_local_search_shortens_nearest_neighbor_route(self):
+        greedy = nearest_neighbor_order(self.matrix)
+        improved = improve_order(greedy, self.matrix)
+        self.assertEqual(sorted(improved), list(range(60)))
+        self.assertEqual(improved[0], 0)
+        self.assertLess(path_length(improved, self.matrix), path_length(greedy, self.matrix) * 0.95)
+
+    def test_fixed_depots_keep_their_positions(self):
+        ordered = optimize_destinations(self.destinations, fixed_end=True)
+        self.assertEqual((ordered[0].id, ordered[-1].id), (0, 59))
+        self.assertEqual(sorted(dest.id for dest in ordered), list(range(60)))
+        free = optimize_destinations(self.destinations, fixed_start=False)
+        self.assertEqual(len(free), 60)
+
+
+class DestinationMatrixTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        destination_matrix._matrices.clear()
+        self.muni = Municipality.objects.create(
+            name="Pref Matriz",
+            cnpj="66.666.666/0001-66",
+            address="Rua 6",
+            city="Cidade",
+            state="SP",
+            phone="11555550000",
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.destinations = [
+                Destination.objects.create(
+                    municipality=self.muni,
+                    name=f"Destino {idx}",
+                    address="Rua",
+                    latitude=f"{-23.55 + idx * 0.01:.6f}",
+                    longitude=f"{-46.63 + (idx % 2) * 0.01:.6f}",
+                )
+                for idx in range(5)
+            ]
+
+    def _distance(self, first, second):
+        return haversine_km(
+            float(first.latitude), float(first.longitude), float(second.latitude), float(second.longitude)
+        )
+
+    def test_matrix_follows_destination_changes(self):
+        first, second, third = self.destinations[:3]
+        data = destination_matrix.matrix_for(self.muni.id)
+        self.assertEqual(list(data.destination_ids), [dest.id for dest in self.destinations])
+        self.assertAlmostEqual(float(data.distances[0, 1]), self._distance(first, second), places=3)
+        self.assertAlmostEqual(float(data.durations[0, 1]), self._distance(first, second) / 35 * 60, places=2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.latitude = "-23.600000"
+            second.save()
+        data = destination_matrix.matrix_for(self.muni.id)
+        self.assertEqual(len(data.destination_ids), 5)
+        self.assertAlmostEqual(float(data.distances[2, 1]), self._distance(third, second), places=3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            third.active = False
+            third.save()
+            first.delete()
+        data = destination_matrix.matrix_for(self.muni.id)
+        self.assertEqual(set(data.positions), {second.id, self.destinations[3].id, self.destinations[4].id})
+        self.assertEqual(data.distances.shape, (3, 3))
+
+        # Saves that leave the coordinates and the active flag alone keep the matrix as is.
+        version = DestinationMatrix.objects.get(municipality=self.muni).version
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            second.name = "Destino renomeado"
+            second.latitude = "-23.6"
+            second.save()
+            self.destinations[3].save(update_fields=["name"])
+        self.assertEqual(callbacks, [])
+        self.assertEqual(DestinationMatrix.objects.get(municipality=self.muni).version, version)
+
+        # Another process sees the new version and reloads the stored matrix.
+        destination_matrix._matrices.clear()
+        self.assertEqual(set(destination_matrix.matrix_for(self.muni.id).positions), set(data.positions))
+
+    def test_matrix_rebuilds_when_destinations_bypassed_the_signals(self):
+        first, second = self.destinations[:2]
+        Destination.objects.bulk_create(
+            [
+                Destination(
+                    municipality=self.muni,
+                    name="Destino em lote",
+                    address="Rua",
+                    latitude="-23.500000",
+                    longitude="-46.600000",
+                )
+            ]
+        )
+        with (
+            mock.patch("trips.matrix.compute_matrix", wraps=destination_matrix.compute_matrix) as rebuilt,
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            first.latitude = "-23.610000"
+            first.save()
+        rebuilt.assert_called_once()
+        data = destination_matrix.matrix_for(self.muni.id)
+        self.assertEqual(len(data.destination_ids), 6)
+        self.assertAlmostEqual(float(data.distances[0, 1]), self._distance(first, second), places=3)
+
+        # In sync again: the next move only recomputes the moved row and column.
+        with mock.patch("trips.matrix.compute_matrix") as rebuilt, self.captureOnCommitCallbacks(execute=True):
+            second.latitude = "-23.620000"
+            second.save()
+        rebuilt.assert_not_called()
+        data = destination_matrix.matrix_for(self.muni.id)
+        self.assertAlmostEqual(float(data.distances[0, 1]), self._distance(first, second), places=3)
+
+    def test_routing_reads_cached_matrix(self):
+        ordered = list(reversed(self.destinations))
+        expected = sum(self._distance(prev, curr) for prev, curr in pairwise(ordered))
+        with mock.patch("trips.routing.distance_matrix") as computed:
+            distance_km, minutes = route_summary(ordered)
+            optimized = optimize_destinations(ordered)
+        computed.assert_not_called()
+        self.assertAlmostEqual(distance_km, expected, places=3)
+        self.assertAlmostEqual(minutes, expected / 35 * 60, delta=1)
+        self.assertEqual([dest.id for dest in optimized], [dest.id for dest in ordered])
+
+    def test_command_rebuilds_matrix(self):
+        DestinationMatrix.objects.filter(municipality=self.muni).delete()
+        destination_matrix._matrices.clear()
+        cache.clear()
+        self.assertIsNone(destination_matrix.matrix_for(self.muni.id))
+        call_command("build_destination_matrix", municipality=self.muni.id, stdout=StringIO())
+        self.assertEqual(len(destination_matrix.matrix_for(self.muni.id).destination_ids), 5)
+
+
+class PolygonIndexTests(SimpleTestCase):
+    def test_concave_polygon_and_grid_lookup(self):
+        # U shape: the notch between the arms is outside.
+        u_shape = [(0, 0), (0, 3), (3, 3), (3, 2), (1, 2), (1, 1), (3, 1), (3, 0)]
+        index = PolygonIndex([ZonePolygon(1, [(lat / 100, lng / 100) for lat, lng in u_shape])])
+        self.assertEqual([zone.zone_id for zone in index.zones_at(0.005, 0.015)], [1])
+        self.assertEqual(index.zones_at(0.02, 0.015), [])
+        self.assertEqual(index.zones_at(0.5, 0.5), [])
+
+
+class GpsTrackEndpointTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.muni = Municipality.objects.create(
+            name="Pref Track",
+            cnpj="55.555.555/0001-55",
+            address="Rua 5",
+            city="Cidade",
+            state="SP",
+            phone="11666660000",
+        )
+        self.admin = User.objects.create_user(
+            email="admin@track.com",
+            password="pass123",
+            role=User.Roles.ADMIN_MUNICIPALITY,
+            municipality=self.muni,
+        )
+        self.driver = Driver.objects.create(
+            municipality=self.muni,
+            name="Motorista Track",
+            cpf="555.555.555-55",
+            cnh_number="55555",
+            cnh_category="D",
+            cnh_expiration_date="2030-01-01",
+            phone="11666666666",
+        )
+        self.vehicle = Vehicle.objects.create(
+            municipality=self.muni,
+            license_plate="TRK1234",
+            model="Van",
+            brand="Ford",
+            year=2020,
+            max_passengers=10,
+            odometer_current=1000,
+            odometer_initial=900,
+            odometer_monthly_limit=2000,
+        )
+        self.trip = Trip.objects.create(
+            municipality=self.muni,
+            vehicle=self.vehicle,
+            driver=self.driver,
+            origin="A",
+            destination="B",
+            departure_datetime=timezone.now(),
+            return_datetime_expected=timezone.now() + timedelta(hours=1),
+            odometer_start=1000,
+            status=Trip.Status.IN_PROGRESS,
+        )
+        base = timezone.now() - timedelta(hours=1)
+        TripGpsPing.objects.bulk_create(
+            [
+                TripGpsPing(
+                    trip=self.trip,
+                    driver=self.driver,
+                    lat=f"{-23.550000 + idx * 0.0001:.6f}",
+                    lng="-46.633000",
+                    speed=30.0,
+                    recorded_at=base + timedelta(seconds=idx * 5),
+                )
+                for idx in range(100)
+            ]
+        )
+        self.client.force_authenticate(self.admin)
+
+    def test_gps_history_returns_raw_points_by_default(self):
+        resp = self.client.get(f"/api/trips/{self.trip.id}/gps/history/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.data["points"]), 100)
+
+    def test_gps_history_simplifies_with_tolerance(self):
+        resp = self.client.get(f"/api/trips/{self.trip.id}/gps/history/?tolerance=5")
+        self.assertEqual(resp.status_code, 200)
+        points = resp.data["points"]
+        self.assertEqual(len(points), 2)
+        self.assertAlmostEqual(points[0]["lat"], -23.55)
+
+    def test_simplified_track_is_cached_for_completed_trips(self):
+        self.trip.status = Trip.Status.COMPLETED
+        self.trip.save(update_fields=["status"])
+        resp = self.client.get(f"/api/trips/{self.trip.id}/gps/history/?zoom=12")
+        self.assertEqual(resp.status_code, 200)
+        with self.assertNumQueries(1):
+            cached = self.client.get(f"/api/trips/{self.trip.id}/gps/history/?zoom=12")
+        self.assertEqual(cached.data["points"], resp.data["points"])
+
+    def test_gps_history_polyline_encoding(self):
+        resp = self.client.get(f"/api/trips/{self.trip.id}/gps/history/?encoding=polyline")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data["count"], 100)
+        points = decode_polyline(resp.data["polyline"])
+        self.assertEqual(points[-1], (-23.5401, -46.633))
+        self.assertEqual(decode_values(resp.data["time_offsets"])[-1], 99 * 5)
+        resp = self.client.get(f"/api/trips/{self.trip.id}/gps/history/?encoding=geojson&zoom=12")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_track_distance_is_chunk_independent(self):
+        whole, points = track_distance_km(self.trip.id)
+        chunked, _ = track_distance_km(self.trip.id, chunk_size=7)
+        self.assertEqual(points, 100)
+        self.assertAlmostEqual(whole, chunked, places=9)
+        # 99 steps of 0.0001 degree of latitude, ~11.1 m each.
+        self.assertAlmostEqual(whole, 1.1, places=1)
+
+    def test_completion_stores_gps_distance_and_flags_mismatch(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.client.patch(
+                f"/api/trips/{self.trip.id}/",
+                {"status": Trip.Status.COMPLETED, "odometer_end": 1050},
+                format="json",
+            )
+        self.assertEqual(resp.status_code, 200, resp.data)
+        self.trip.refresh_from_db()
+        self.assertEqual(str(self.trip.gps_distance_km), "1.10")
+        self.assertTrue(self.trip.odometer_mismatch)
+
+    def test_command_processes_pending_completed_trips(self):
+        Trip.objects.filter(id=self.trip.id).update(status=Trip.Status.COMPLETED, odometer_end=1001)
+        call_command("compute_gps_distances", chunk_size=10, stdout=StringIO())
+        self.trip.refresh_from_db()
+        self.assertIsNotNone(self.trip.gps_distance_computed_at)
+        self.assertFalse(self.trip.odometer_mismatch)
+
+    def test_retention_archives_completed_trip_and_history_serves_the_track(self):
+        expected = self.client.get(f"/api/trips/{self.trip.id}/gps/history/?limit=10").data["points"]
+        Trip.objects.filter(id=self.trip.id).update(status=Trip.Status.COMPLETED)
+        later = timezone.now() + timedelta(days=62)
+
+        result = apply_retention(1, now=later, chunk_size=7)
+
+        self.assertEqual(result["archived"], 1)
+        self.assertEqual(result["cutoff"], add_months(month_start(later), -1))
+        self.assertFalse(TripGpsPing.objects.filter(trip=self.trip).exists())
+        track = TripGpsTrack.objects.get(trip=self.trip)
+        self.assertEqual(track.point_count, 100)
+        resp = self.client.get(f"/api/trips/{self.trip.id}/gps/history/?limit=10")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data["points"], expected)
+        self.assertEqual(apply_retention(1, now=later)["archived"], 0)
+
+    def test_retention_keeps_recent_trips_and_expires_unfinished_ones(self):
+        self.assertEqual(apply_retention(1)["expired"], 0)
+        Trip.objects.filter(id=self.trip.id).update(status=Trip.Status.COMPLETED)
+        self.assertEqual(apply_retention(1)["archived"], 0)
+        self.assertEqual(TripGpsPing.objects.filter(trip=self.trip).count(), 100)
+
+        # A trip never finished has its old pings dropped without an archive.
+        Trip.objects.filter(id=self.trip.id).update(status=Trip.Status.IN_PROGRESS)
+        result = apply_retention(1, now=timezone.now() + timedelta(days=62))
+        self.assertEqual((result["archived"], result["expired"]), (0, 100))
+        self.assertFalse(TripGpsTrack.objects.filter(trip=self.trip).exists())
+
+    def test_retention_archives_cancelled_trips(self):
+        Trip.objects.filter(id=self.trip.id).update(status=Trip.Status.CANCELLED)
+        result = apply_retention(1, now=timezone.now() + timedelta(days=62))
+        self.assertEqual((result["archived"], result["expired"]), (1, 0))
+        self.assertEqual(TripGpsTrack.objects.get(trip=self.trip).point_count, 100)
+
+    def test_replay_streams_ndjson(self):
+        resp = self.client.get(f"/api/trips/{self.trip.id}/gps/replay/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.streaming)
+        self.assertEqual(resp["Content-Type"], "application/x-ndjson")
+        events = [json.loads(line) for line in b"".join(resp.streaming_content).splitlines()]
+        self.assertEqual(len(events), 100)
+        self.assertEqual(events[0]["offset_seconds"], 0)
+        self.assertEqual(events[-1]["offset_seconds"], 99 * 5)
+
+    def test_replay_streams_server_sent_events_with_time_compression(self):
+        with mock.patch("trips.replay.time.sleep") as sleep:
+            resp = self.client.get(
+                f"/api/trips/{self.trip.id}/gps/replay/?speed=60", HTTP_ACCEPT="text/event-stream"
+            )
+            body = b"".join(resp.streaming_content).decode()
+        self.assertEqual(resp["Content-Type"], "text/event-stream")
+        self.assertEqual(body.count("event: point\n"), 100)
+        self.assertTrue(body.endswith(f'event: end\ndata: {{"trip_id": {self.trip.id}}}\n\n'))
+        self.assertEqual(sleep.call_count, 99)
+        self.assertAlmostEqual(sleep.call_args.args[0], 5 / 60)
+
+    def test_replay_under_asgi_sends_first_point_before_pausing(self):
+        # Three points 5 s apart replayed at speed 5: two one-second pauses.
+        keep = TripGpsPing.objects.filter(trip=self.trip).order_by("recorded_at").values_list("id", flat=True)[:3]
+        TripGpsPing.objects.filter(trip=self.trip).exclude(id__in=list(keep)).delete()
+        token = str(AccessToken.for_user(self.admin))
+        # The handler would close the connection holding the test transaction.
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": f"/api/trips/{self.trip.id}/gps/replay/",
+            "query_string": b"speed=5",
+            "root_path": "",
+            "headers": [(b"host", b"testserver"), (b"authorization", f"Bearer {token}".encode())],
+            "client": ("127.0.0.1", 50000),
+            "server": ("testserver", 80),
+        }
+
+        async def scenario():
+            # Run in this context so the handler's sync code shares the test's database connection.
+            sent = []
+            requests = [{"type": "http.request", "body": b"", "more_body": False}]
+
+            async def receive():
+                if requests:
+                    return requests.pop()
+                await asyncio.Event().wait()
+
+            async def send(message):
+                sent.append((time.monotonic() - started, message))
+
+            started = time.monotonic()
+            await ASGIHandler()(scope, receive, send)
+            return sent
+
+        sent = async_to_sync(scenario)()
+        (_, start), *bodies = sent
+        self.assertEqual(start["status"], 200)
+        first_at, first = bodies[0]
+        self.assertEqual(json.loads(first["body"])["offset_seconds"], 0)
+        self.assertLess(first_at, 1.0)
+        self.assertGreaterEqual(bodies[-1][0], 2.0)
+        events = [json.loads(line) for line in b"".join(body.get("body", b"") for _, body in bodies).splitlines()]
+        self.assertEqual([event["offset_seconds"] for event in events], [0, 5, 10])
+
+    def test_async_rows_match_sync_rows_across_chunks(self):
+        async def collect(rows):
+            return [row async for row in rows]
+
+        expected = list(replay_rows(self.trip.id))
+        self.assertEqual(async_to_sync(collect)(areplay_rows(self.trip.id, chunk_size=7)), expected)
+        Trip.objects.filter(id=self.trip.id).update(status=Trip.Status.COMPLETED)
+        apply_retention(1, now=timezone.now() + timedelta(days=62))
+        self.assertEqual(len(async_to_sync(collect)(areplay_rows(self.trip.id, chunk_size=7))), 100)
+
+    def test_replay_rejects_invalid_speed(self):
+        resp = self.client.get(f"/api/trips/{self.trip.id}/gps/replay/?speed=0")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_replay_reads_archived_track(self):
+        Trip.objects.filter(id=self.trip.id).update(status=Trip.Status.COMPLETED)
+        apply_retention(1, now=timezone.now() + timedelta(days=62))
+        resp = self.client.get(f"/api/trips/{self.trip.id}/gps/replay/?format=ndjson")
+        self.assertEqual(len(b"".join(resp.streaming_content).splitlines()), 100)
+
+
+class TrackArchiveTests(SimpleTestCase):
+    def test_pack_round_trip(self):
+        base = timezone.now().replace(microsecond=0)
+        rows = [("-23.550000", "-46.633000", 5.0, None, base), ("-23.550100", "-46.633100", None, 12.5, base + timedelta(seconds=5))]
+        blob, count, first_at, last_at = pack_track(iter(rows))
+        self.assertEqual((count, first_at, last_at), (2, rows[0][4], rows[1][4]))
+        unpacked = unpack_track(blob)
+        self.assertEqual([str(row[0]) for row in unpacked], ["-23.550000", "-23.550100"])
+        self.assertEqual([row[2:] for row in unpacked], [row[2:] for row in rows])
+
+    def test_incremental_unpack_across_read_boundaries(self):
+        base = timezone.now().replace(microsecond=0)
+        rows = [(f"-23.{idx:06d}", "-46.633000", None, None, base + timedelta(seconds=idx)) for idx in range(500)]
+        blob, *_ = pack_track(rows)
+        self.assertEqual([row[4] for row in iter_track(blob, read_size=7)], [row[4] for row in rows])
+
+
+@skipUnless(connection.vendor == "postgresql", "ping partitions exist on PostgreSQL only")
+class GpsPartitionTests(TestCase):
+    def setUp(self):
+        self.muni = Municipality.objects.create(
+            name="Pref Particao", cnpj="88.888.888/0001-88", address="Rua", city="Cidade", state="SP", phone="1"
+        )
+        self.driver = Driver.objects.create(
+            municipality=self.muni,
+            name="Motorista Particao",
+            cpf="888.888.888-88",
+            cnh_number="88888",
+            cnh_category="D",
+            cnh_expiration_date="2030-01-01",
+            phone="11888888888",
+        )
+        self.vehicle = Vehicle.objects.create(
+            municipality=self.muni,
+            license_plate="PRT1234",
+            model="Van",
+            brand="Ford",
+            year=2020,
+            max_passengers=10,
+            odometer_current=1000,
+            odometer_initial=900,
+            odometer_monthly_limit=2000,
+        )
+        self.month = month_start(timezone.now())
+
+    def _trip_with_pings(self, status, *recorded_at):
+        trip = Trip.objects.create(
+            municipality=self.muni,
+            vehicle=self.vehicle,
+            driver=self.driver,
+            origin="A",
+            destination="B",
+            departure_datetime=timezone.now(),
+            return_datetime_expected=timezone.now() + timedelta(hours=1),
+            odometer_start=1000,
+            status=status,
+        )
+        for value in recorded_at:
+            TripGpsPing.objects.create(trip=trip, driver=self.driver, lat="-23.55", lng="-46.63", recorded_at=value)
+        # Fire the deferred foreign key checks now; ALTER TABLE refuses tables with pending trigger events.
+        connection.check_constraints()
+        return trip
+
+    def _count(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {table}")
+            return cursor.fetchone()[0]
+
+    def test_new_partition_takes_over_rows_from_the_default_partition(self):
+        month = add_months(self.month, 8)
+        self._trip_with_pings(Trip.Status.PLANNED, month + timedelta(days=2))
+        self.assertEqual(self._count(DEFAULT_PARTITION), 1)
+
+        created = ensure_partitions(months_ahead=8)
+
+        self.assertIn(partition_name(month), created)
+        self.assertEqual(self._count(partition_name(month)), 1)
+        self.assertEqual(self._count(DEFAULT_PARTITION), 0)
+        self.assertEqual(TripGpsPing.objects.count(), 1)
+        self.assertEqual(ensure_partitions(months_ahead=8), [])
+
+    def test_retention_drops_old_partitions_and_default_rows(self):
+        recent = self.month + timedelta(hours=1)
+        completed = self._trip_with_pings(Trip.Status.COMPLETED, recent)
+        cancelled = self._trip_with_pings(Trip.Status.CANCELLED, recent)
+        # Abandoned: still in progress, one ping in a monthly partition and one old enough for the default one.
+        self._trip_with_pings(Trip.Status.IN_PROGRESS, recent, add_months(self.month, -24))
+
+        result = apply_retention(1, now=timezone.now() + timedelta(days=62))
+
+        self.assertEqual(result["archived"], 2)
+        self.assertIn(partition_name(self.month), result["dropped"])
+        self.assertEqual(result["expired"], 1)
+        self.assertEqual(self._count(DEFAULT_PARTITION), 0)
+        self.assertFalse(TripGpsPing.objects.exists())
+        self.assertEqual(
+            set(TripGpsTrack.objects.values_list("trip_id", flat=True)), {completed.id, cancelled.id}
+        )
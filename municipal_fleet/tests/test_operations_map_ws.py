@@ -0,0 +1,263 @@
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from drivers.models import Driver
+from fleet.models import Vehicle
+from tenants.models import Municipality
+from trips.broadcaster import MapUpdateCursor, broadcast_map_batches
+from trips.consumers import OperationsMapConsumer
+from trips.ingestion import apply_ping_side_effects, broadcast_map_ping, tile_for, tile_group
+from trips.models import Trip, TripGpsPing, TripPositionChange
+
+
+def _ping(municipality_id, lat=-23.55, lng=-46.63):
+    return {
+        "trip_id": 1,
+        "municipality_id": municipality_id,
+        "lat": lat,
+        "lng": lng,
+        "recorded_at": (timezone.now() - timedelta(seconds=1)).isoformat(),
+    }
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class OperationsMapConsumerTests(TestCase):
+    def setUp(self):
+        self.muni_a = Municipality.objects.create(
+            name="Pref WS A", cnpj="66.666.666/0001-66", address="Rua", city="A", state="SP", phone="1"
+        )
+        self.muni_b = Municipality.objects.create(
+            name="Pref WS B", cnpj="77.777.777/0001-77", address="Rua", city="B", state="SP", phone="2"
+        )
+        self.operator = User.objects.create_user(
+            email="operator@ws.com",
+            password="pass123",
+            role=User.Roles.OPERATOR,
+            municipality=self.muni_a,
+        )
+
+    async def _connect(self, user):
+        communicator = WebsocketCommunicator(OperationsMapConsumer.as_asgi(), "/ws/operations/map/")
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual(snapshot["event"], "snapshot")
+        return communicator
+
+    def test_operator_only_receives_own_municipality(self):
+        async def scenario():
+            communicator = await self._connect(self.operator)
+            layer = get_channel_layer()
+            for payload in (_ping(self.muni_b.id), _ping(self.muni_a.id)):
+                await layer.group_send(f"operations_map_{payload['municipality_id']}", {"type": "gps.ping", "data": payload})
+            message = await communicator.receive_json_from()
+            self.assertEqual(message["payload"]["municipality_id"], self.muni_a.id)
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_viewport_subscription_filters_by_tile(self):
+        async def scenario():
+            communicator = await self._connect(self.operator)
+            await communicator.send_json_to({"action": "viewport", "bbox": [-46.70, -23.60, -46.60, -23.50]})
+            reply = await communicator.receive_json_from()
+            self.assertEqual(reply["payload"]["mode"], "tiles")
+            layer = get_channel_layer()
+            far = _ping(self.muni_a.id, lat=-22.90, lng=-43.20)
+            near = _ping(self.muni_a.id)
+            for payload in (far, near):
+                await layer.group_send(tile_group(*tile_for(payload["lat"], payload["lng"])), {"type": "gps.ping", "data": payload})
+            message = await communicator.receive_json_from()
+            self.assertEqual(message["payload"]["lat"], near["lat"])
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_broadcast_reaches_viewport_subscribers(self):
+        async def scenario():
+            communicator = await self._connect(self.operator)
+            await communicator.send_json_to({"action": "viewport", "bbox": [-46.70, -23.60, -46.60, -23.50]})
+            await communicator.receive_json_from()
+            await sync_to_async(broadcast_map_ping)(_ping(self.muni_a.id))
+            message = await communicator.receive_json_from()
+            self.assertEqual(message["event"], "gps_ping")
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    @override_settings(MAP_BROADCAST_TICK_SECONDS=1)
+    def test_tick_mode_sends_one_batch_with_newest_point(self):
+        driver = Driver.objects.create(
+            municipality=self.muni_a,
+            name="Motorista WS",
+            cpf="666.666.666-66",
+            cnh_number="66666",
+            cnh_category="D",
+            cnh_expiration_date="2030-01-01",
+            phone="11555555555",
+        )
+        vehicle = Vehicle.objects.create(
+            municipality=self.muni_a,
+            license_plate="WSS1234",
+            model="Van",
+            brand="Ford",
+            year=2020,
+            max_passengers=10,
+            odometer_current=1000,
+            odometer_initial=900,
+            odometer_monthly_limit=2000,
+        )
+        trip = Trip.objects.create(
+            municipality=self.muni_a,
+            vehicle=vehicle,
+            driver=driver,
+            origin="A",
+            destination="B",
+            departure_datetime=timezone.now(),
+            return_datetime_expected=timezone.now() + timedelta(hours=1),
+            odometer_start=1000,
+            status=Trip.Status.IN_PROGRESS,
+        )
+        cursor = MapUpdateCursor()
+
+        async def scenario():
+            communicator = await self._connect(self.operator)
+            for idx in range(3):
+                ping = await sync_to_async(TripGpsPing.objects.create)(
+                    trip=trip,
+                    driver=driver,
+                    lat=f"-23.55{idx}000",
+                    lng="-46.630000",
+                    speed=20.0,
+                    recorded_at=timezone.now() - timedelta(seconds=3 - idx),
+                )
+                await sync_to_async(apply_ping_side_effects)(trip, driver, ping)
+            self.assertTrue(await communicator.receive_nothing())
+            sent = await sync_to_async(broadcast_map_batches)(cursor)
+            self.assertEqual(sent, 1)
+            message = await communicator.receive_json_from()
+            self.assertEqual(message["event"], "gps_batch")
+            self.assertEqual(len(message["payload"]["positions"]), 1)
+            self.assertEqual(message["payload"]["positions"][0]["lat"], -23.552)
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def _in_progress_trip(self, municipality, suffix):
+        driver = Driver.objects.create(
+            municipality=municipality,
+            name=f"Motorista {suffix}",
+            cpf=f"{suffix * 3}.{suffix * 3}.{suffix * 3}-{suffix * 2}",
+            cnh_number=suffix * 5,
+            cnh_category="D",
+            cnh_expiration_date="2030-01-01",
+            phone="11555555555",
+        )
+        vehicle = Vehicle.objects.create(
+            municipality=municipality,
+            license_plate=f"WS{suffix}1234",
+            model="Van",
+            brand="Ford",
+            year=2020,
+            max_passengers=10,
+            odometer_current=1000,
+            odometer_initial=900,
+            odometer_monthly_limit=2000,
+        )
+        trip = Trip.objects.create(
+            municipality=municipality,
+            vehicle=vehicle,
+            driver=driver,
+            origin="A",
+            destination="B",
+            departure_datetime=timezone.now(),
+            return_datetime_expected=timezone.now() + timedelta(hours=1),
+            odometer_start=1000,
+            status=Trip.Status.IN_PROGRESS,
+        )
+        return trip, driver
+
+    @override_settings(MAP_BROADCAST_TICK_SECONDS=1)
+    def test_tick_reaches_each_consumer_as_one_frame(self):
+        superadmin = User.objects.create_user(
+            email="super@ws.com", password="pass123", role=User.Roles.SUPERADMIN
+        )
+        moving = [self._in_progress_trip(self.muni_a, "7"), self._in_progress_trip(self.muni_b, "8")]
+        cursor = MapUpdateCursor()
+
+        async def scenario():
+            admin_socket = await self._connect(superadmin)
+            tile_socket = await self._connect(self.operator)
+            # Two trips in different municipalities; the operator watches tiles covering both of its points.
+            await tile_socket.send_json_to({"action": "viewport", "bbox": [-46.70, -23.60, -46.50, -23.40]})
+            await tile_socket.receive_json_from()
+            for idx, (trip, driver) in enumerate(moving):
+                ping = await sync_to_async(TripGpsPing.objects.create)(
+                    trip=trip,
+                    driver=driver,
+                    lat="-23.550000",
+                    lng=f"-46.{63 - idx * 8}0000",
+                    recorded_at=timezone.now() - timedelta(seconds=1),
+                )
+                await sync_to_async(apply_ping_side_effects)(trip, driver, ping)
+            sent = await sync_to_async(broadcast_map_batches)(cursor)
+            self.assertEqual(sent, 2)
+            message = await admin_socket.receive_json_from()
+            self.assertEqual(len(message["payload"]["positions"]), 2)
+            self.assertTrue(await admin_socket.receive_nothing(timeout=0.3))
+            message = await tile_socket.receive_json_from()
+            self.assertEqual([item["trip_id"] for item in message["payload"]["positions"]], [moving[0][0].id])
+            self.assertTrue(await tile_socket.receive_nothing(timeout=0.3))
+            await admin_socket.disconnect()
+            await tile_socket.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_cursor_picks_up_changes_committed_late(self):
+        cursor = MapUpdateCursor()
+        changes = [TripPositionChange.objects.create(trip_id=trip_id) for trip_id in (11, 12, 13)]
+        # The middle row belongs to a transaction that had not committed at the first tick.
+        late_id = changes[1].id
+        changes[1].delete()
+        self.assertEqual(cursor.advance(), {11, 13})
+        TripPositionChange.objects.create(id=late_id, trip_id=12)
+        self.assertEqual(cursor.advance(), {12})
+        self.assertEqual(cursor.advance(), set())
+
+    def test_http_and_socket_share_bbox_order(self):
+        box = [-46.70, -23.60, -46.60, -23.50]
+        inside, _ = self._in_progress_trip(self.muni_a, "5")
+        outside, _ = self._in_progress_trip(self.muni_a, "4")
+        client = APIClient()
+        client.force_authenticate(self.operator)
+
+        async def scenario():
+            communicator = await self._connect(self.operator)
+            await communicator.send_json_to({"action": "viewport", "bbox": box})
+            await communicator.receive_json_from()
+            for trip, (lat, lng) in ((outside, ("-22.900000", "-43.200000")), (inside, ("-23.550000", "-46.630000"))):
+                ping = await sync_to_async(TripGpsPing.objects.create)(
+                    trip=trip, driver=trip.driver, lat=lat, lng=lng, recorded_at=timezone.now() - timedelta(seconds=1)
+                )
+                await sync_to_async(apply_ping_side_effects)(trip, trip.driver, ping)
+            message = await communicator.receive_json_from()
+            self.assertEqual(message["payload"]["trip_id"], inside.id)
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+        bbox = ",".join(str(value) for value in box)
+        resp = client.get(f"/api/trips/map-state/?bbox={bbox}&zoom=16&include_history=false")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([driver["trip_id"] for driver in resp.data["drivers"]], [inside.id])
@@ -0,0 +1,167 @@
+import random
+import tempfile
+from heapq import heappop, heappush
+from io import BytesIO, StringIO
+from itertools import pairwise
+from math import inf
+from pathlib import Path
+
+import numpy as np
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from destinations.models import Destination
+from tenants.models import Municipality
+from trips import matrix as destination_matrix
+from trips import road_network
+from trips.road_network import RoadGraph, build_edges, read_osm_xml
+from trips.routing import build_route_geometry, haversine_km, optimize_destinations, route_summary
+
+SPACING_DEG = 0.005
+HIGHWAYS = ["primary", "secondary", "residential", "track"]
+
+
+def grid_osm(size, seed=3, extra_ways=(), highways=HIGHWAYS):
+    """OSM XML for a size x size street grid; each street gets a random highway type."""
+    rng = random.Random(seed)
+    lines = ['<?xml version="1.0"?>', '<osm version="0.6">']
+    for row in range(size):
+        for column in range(size):
+            lat, lng = -23.5 - row * SPACING_DEG, -46.6 + column * SPACING_DEG
+            lines.append(f'<node id="{row * size + column + 1}" lat="{lat:.6f}" lon="{lng:.6f}"/>')
+    ways = [[row * size + column + 1 for column in range(size)] for row in range(size)]
+    ways += [[row * size + column + 1 for row in range(size)] for column in range(size)]
+    for way_id, refs in enumerate(ways, start=1):
+        tags = {"highway": rng.choice(highways)}
+        lines.append(_way(way_id, refs, tags))
+    for way_id, (refs, tags) in enumerate(extra_ways, start=len(ways) + 1):
+        lines.append(_way(way_id, refs, tags))
+    lines.append("</osm>")
+    return "\n".join(lines).encode()
+
+
+def _way(way_id, refs, tags):
+    body = "".join(f'<nd ref="{ref}"/>' for ref in refs)
+    body += "".join(f'<tag k="{key}" v="{value}"/>' for key, value in tags.items())
+    return f'<way id="{way_id}">{body}</way>'
+
+
+def graph_from(xml):
+    lats, lngs, edges = build_edges(*read_osm_xml(BytesIO(xml)))
+    return RoadGraph.from_edges(lats, lngs, edges), edges
+
+
+def dijkstra(edges, source, target):
+    outgoing = {}
+    for (u, v), (duration, _) in edges.items():
+        outgoing.setdefault(u, []).append((v, duration))
+    best = {source: 0.0}
+    heap = [(0.0, source)]
+    while heap:
+        cost, node = heappop(heap)
+        if node == target:
+            return cost
+        if cost > best[node]:
+            continue
+        for neighbor, duration in outgoing.get(node, ()):
+            if cost + duration < best.get(neighbor, inf):
+                best[neighbor] = cost + duration
+                heappush(heap, (cost + duration, neighbor))
+    return inf
+
+
+class RoadGraphTests(SimpleTestCase):
+    def test_hierarchy_matches_dijkstra(self):
+        graph, edges = graph_from(grid_osm(8))
+        rng = random.Random(11)
+        nodes = len(graph.lats)
+        pairs = [(rng.randrange(nodes), rng.randrange(nodes)) for _ in range(40)]
+        table = graph.node_table([source for source, _ in pairs], [target for _, target in pairs])
+        for source, target in pairs:
+            duration, distance, path = graph.route(source, target)
+            self.assertAlmostEqual(duration, dijkstra(edges, source, target), places=6)
+            self.assertAlmostEqual(table[(source, target)][0], duration, places=6)
+            self.assertEqual((path[0], path[-1]), (source, target))
+            # The unpacked path is made of road edges whose lengths add up to the distance.
+            self.assertAlmostEqual(sum(edges[pair][1] for pair in pairwise(path)), distance, places=6)
+
+    def test_one_way_and_unpaved_roads(self):
+        # A fast one-way shortcut from node 1 to node 16 on a 4x4 grid.
+        xml = grid_osm(4, extra_ways=[([1, 16], {"highway": "primary", "oneway": "yes"})])
+        graph, _ = graph_from(xml)
+        forward = graph.route(0, 15)
+        backward = graph.route(15, 0)
+        self.assertEqual(forward[2], [0, 15])
+        self.assertGreater(len(backward[2]), 2)
+        self.assertEqual(road_network.way_speed({"highway": "secondary", "surface": "dirt"}), 30.0)
+        self.assertEqual(road_network.way_speed({"highway": "track"}), 12.0)
+        self.assertIsNone(road_network.way_speed({"highway": "footway"}))
+        self.assertIsNone(road_network.way_speed({"highway": "primary", "access": "private"}))
+
+    def test_save_load_and_points_off_the_network(self):
+        graph, _ = graph_from(grid_osm(4))
+        with tempfile.TemporaryDirectory() as directory:
+            path = str(Path(directory) / "1.npz")
+            graph.save(path)
+            loaded = RoadGraph.load(path)
+        self.assertEqual(loaded.route(0, 15)[:2], graph.route(0, 15)[:2])
+        origin, far_away = (-23.5, -46.6), (-22.0, -45.0)
+        distances, durations = loaded.travel_matrix([origin], [origin, far_away, (-23.515, -46.585)])
+        self.assertEqual(distances[0, 0], 0.0)
+        self.assertTrue(np.isnan(durations[0, 1]))
+        self.assertGreaterEqual(distances[0, 2], haversine_km(*origin, -23.515, -46.585))
+
+
+class RoadNetworkBackendTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        destination_matrix._matrices.clear()
+        road_network._graphs.clear()
+        self.graph_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.graph_dir.cleanup)
+        self.muni = Municipality.objects.create(
+            name="Pref Malha",
+            cnpj="77.777.777/0001-77",
+            address="Rua 7",
+            city="Cidade",
+            state="SP",
+            phone="11444440000",
+        )
+        self.extract = Path(self.graph_dir.name) / "extrato.osm"
+        self.extract.write_bytes(grid_osm(6, highways=["residential"]))
+        corners = [(-23.5, -46.6), (-23.5, -46.575), (-23.525, -46.575)]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.destinations = [
+                Destination.objects.create(
+                    municipality=self.muni,
+                    name=f"Destino {idx}",
+                    address="Rua",
+                    latitude=f"{lat:.6f}",
+                    longitude=f"{lng:.6f}",
+                )
+                for idx, (lat, lng) in enumerate(corners)
+            ]
+
+    def test_routes_follow_the_road_graph(self):
+        straight_km, _ = route_summary(self.destinations)
+        with override_settings(ROUTING_BACKEND="road_network", ROAD_GRAPH_DIR=self.graph_dir.name):
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command(
+                    "build_road_graph", str(self.extract), municipality=self.muni.id, stdout=StringIO()
+                )
+            distance_km, minutes = route_summary(self.destinations)
+            geometry = build_route_geometry(self.destinations)
+            ordered = optimize_destinations(self.destinations)
+        # Both legs run along one street, at residential speed (25 km/h) instead of the 35 km/h default.
+        self.assertAlmostEqual(distance_km, straight_km, places=2)
+        self.assertEqual(minutes, int(distance_km / 25 * 60))
+        self.assertGreater(len(geometry), len(self.destinations))
+        self.assertEqual(geometry[0], {"lat": -23.5, "lng": -46.6})
+        self.assertEqual(len(ordered), 3)
+
+    def test_missing_graph_falls_back_to_straight_lines(self):
+        expected = route_summary(self.destinations)
+        with override_settings(ROUTING_BACKEND="road_network", ROAD_GRAPH_DIR=self.graph_dir.name):
+            self.assertEqual(route_summary(self.destinations), expected)
+            self.assertEqual(len(build_route_geometry(self.destinations)), 3)
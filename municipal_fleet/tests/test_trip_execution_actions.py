@@ -124,6 +124,15 @@ class TripExecutionActionsTests(TestCase):
         orders = list(self.execution.stops.order_by("order").values_list("destination_id", flat=True))
         self.assertEqual(orders, [self.dest_a.id, self.dest_c.id, self.dest_b.id])
 
+    def test_optimize_route_keeps_fixed_end_depot(self):
+        self.client.force_authenticate(self.admin)
+        resp = self.client.post(
+            f"/api/trips/executions/{self.execution.id}/optimize-route/", {"fixed_end": True}, format="json"
+        )
+        self.assertEqual(resp.status_code, 200)
+        orders = list(self.execution.stops.order_by("order").values_list("destination_id", flat=True))
+        self.assertEqual(orders, [self.dest_a.id, self.dest_b.id, self.dest_c.id])
+
     def test_optimize_route_without_stops(self):
         self.execution.stops.all().delete()
         self.client.force_authenticate(self.admin)
@@ -6,7 +6,7 @@ from accounts.models import User
 from drivers.models import Driver
 from fleet.models import Vehicle
 from tenants.models import Municipality
-from trips.models import FreeTrip, Trip, TripGpsPing
+from trips.models import FreeTrip, Trip, TripGpsPing, TripLastPosition
 
 
 class FreeTripActionsTests(TestCase):
@@ -130,7 +130,7 @@ class TripMapStateTests(TestCase):
             odometer_initial=1500,
             odometer_monthly_limit=3000,
         )
-        trip = Trip.objects.create(
+        self.trip = trip = Trip.objects.create(
             municipality=self.muni,
             vehicle=self.vehicle,
             driver=self.driver,
@@ -163,3 +163,110 @@ class TripMapStateTests(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(len(resp.data["drivers"]), 1)
         self.assertEqual(resp.data["drivers"][0]["history"], [])
+
+    def test_map_state_filters_superadmin_by_municipality(self):
+        other = Municipality.objects.create(
+            name="Pref C", cnpj="33.333.333/0001-33", address="Rua 3", city="Cidade", state="SP", phone="11777770000"
+        )
+        superadmin = User.objects.create_user(email="root@b.com", password="pass123", role=User.Roles.SUPERADMIN)
+        self.client.force_authenticate(superadmin)
+        resp = self.client.get("/api/trips/map-state/?include_history=false")
+        self.assertEqual(len(resp.data["drivers"]), 1)
+        resp = self.client.get(f"/api/trips/map-state/?include_history=false&municipality={other.id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data["drivers"], [])
+        resp = self.client.get(f"/api/trips/map-state/?include_history=false&municipality={self.muni.id}")
+        self.assertEqual(len(resp.data["drivers"]), 1)
+        resp = self.client.get("/api/trips/map-state/?municipality=abc")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_map_state_history_keeps_newest_points_per_trip(self):
+        base = timezone.now() - timezone.timedelta(minutes=10)
+        for idx in range(5):
+            TripGpsPing.objects.create(
+                trip=self.trip,
+                driver=self.driver,
+                lat=f"-23.55{idx}000",
+                lng="-46.633308",
+                speed=20.0,
+                recorded_at=base + timezone.timedelta(seconds=idx),
+            )
+        self.client.force_authenticate(self.admin)
+        resp = self.client.get("/api/trips/map-state/?history_limit=3")
+        self.assertEqual(resp.status_code, 200)
+        history = resp.data["drivers"][0]["history"]
+        self.assertEqual(len(history), 3)
+        self.assertEqual([point["lat"] for point in history], [-23.553, -23.554, -23.55052])
+
+    def test_map_state_delta_returns_only_changes_and_supports_etag(self):
+        self.client.force_authenticate(self.admin)
+        full = self.client.get("/api/trips/map-state/")
+        self.assertEqual(full.status_code, 200)
+        self.assertIn("ETag", full.headers)
+        cursor = full.data["cursor"]
+        # Pings created directly skip ingestion: record the position and age both stores to before the cursor.
+        TripLastPosition.objects.create(
+            trip=self.trip,
+            municipality=self.muni,
+            driver=self.driver,
+            lat="-23.550520",
+            lng="-46.633308",
+            recorded_at=timezone.now(),
+        )
+        TripLastPosition.objects.filter(trip=self.trip).update(updated_at=timezone.now() - timezone.timedelta(minutes=1))
+        TripGpsPing.objects.filter(trip=self.trip).update(created_at=timezone.now() - timezone.timedelta(minutes=1))
+
+        unchanged = self.client.get(f"/api/trips/map-state/?since={cursor}")
+        self.assertEqual(unchanged.status_code, 200)
+        self.assertEqual(unchanged.data["drivers"], [])
+        self.assertEqual(unchanged.data["active_trip_ids"], [self.trip.id])
+        not_modified = self.client.get(
+            f"/api/trips/map-state/?since={cursor}", HTTP_IF_NONE_MATCH=unchanged.headers["ETag"]
+        )
+        self.assertEqual(not_modified.status_code, 304)
+
+        TripGpsPing.objects.create(
+            trip=self.trip,
+            driver=self.driver,
+            lat="-23.551000",
+            lng="-46.633308",
+            speed=25.0,
+            recorded_at=timezone.now(),
+        )
+        changed = self.client.get(
+            f"/api/trips/map-state/?since={cursor}", HTTP_IF_NONE_MATCH=unchanged.headers["ETag"]
+        )
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(len(changed.data["drivers"]), 1)
+        self.assertEqual([point["lat"] for point in changed.data["drivers"][0]["history"]], [-23.551])
+        self.assertNotEqual(changed.data["cursor"], cursor)
+
+    def test_map_state_clusters_by_bbox_and_zoom(self):
+        TripLastPosition.objects.create(
+            trip=self.trip,
+            municipality=self.muni,
+            driver=self.driver,
+            lat="-23.550520",
+            lng="-46.633308",
+            speed=30.0,
+            recorded_at=timezone.now(),
+        )
+        self.client.force_authenticate(self.admin)
+        resp = self.client.get("/api/trips/map-state/?bbox=-47,-24,-46,-23&zoom=10")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data["mode"], "clusters")
+        self.assertEqual(resp.data["total"], 1)
+        self.assertEqual(resp.data["clusters"][0]["trip_id"], self.trip.id)
+        self.assertEqual(resp.data["clusters"][0]["statuses"]["IN_ROUTE"], 1)
+
+        resp = self.client.get("/api/trips/map-state/?bbox=-46.64,-23.56,-46.62,-23.54&zoom=16&include_history=false")
+        self.assertEqual([driver["trip_id"] for driver in resp.data["drivers"]], [self.trip.id])
+        resp = self.client.get("/api/trips/map-state/?bbox=-44,-22,-43,-21&zoom=16")
+        self.assertEqual(resp.data["drivers"], [])
+        resp = self.client.get("/api/trips/map-state/?bbox=1,2,3&zoom=10")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_map_state_rejects_invalid_cursor(self):
+        self.client.force_authenticate(self.admin)
+        resp = self.client.get("/api/trips/map-state/?since=abc")
+        self.assertEqual(resp.status_code, 400)
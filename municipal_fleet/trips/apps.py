@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class TripsConfig(AppConfig):
     name = "trips"
     default_auto_field = "django.db.models.BigAutoField"
+
+    def ready(self):
+        # Late import to avoid circular dependencies.
+        from trips import signals  # noqa: F401
+        from trips.routing import ROUTING_BACKEND_ROAD_NETWORK
+
+        if getattr(settings, "ROUTING_BACKEND", None) == ROUTING_BACKEND_ROAD_NETWORK:
+            from trips.road_network import preload_road_graphs
+
+            preload_road_graphs()
@@ -0,0 +1,162 @@
+"""
+Arrival/departure stamping of `TripExecutionStop` from the driver's GPS pings.
+
+The driver's in-progress execution itinerary is cached with a cursor at the
+first stop not yet departed. Each ping is compared with that stop and the next
+one only, so matching never rescans the itinerary; the database is written
+only when a stop is stamped. Stamps also train the segment speeds used for the
+live ETAs refreshed on every batch (see trips.eta).
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+
+from trips.eta import record_segment_sample, segment_speeds_for, update_execution_etas
+from trips.models import PlannedTrip, TripExecution, TripExecutionStop
+from trips.routing import haversine_km
+
+ARRIVAL_RADIUS_M = 100
+# Leaving needs a larger radius than arriving so GPS jitter at the stop does not stamp a departure.
+DEPARTURE_RADIUS_M = 150
+ITINERARY_STATE_TTL_SECONDS = 30 * 60
+SCHOOL_MONITOR_GROUP_NAME = "school_monitor"
+
+
+def itinerary_state_key(driver_id: int) -> str:
+    return f"trips:itinerary:{driver_id}"
+
+
+def invalidate_itinerary_state(driver_id: int) -> None:
+    cache.delete(itinerary_state_key(driver_id))
+
+
+def school_monitor_group(municipality_id: int) -> str:
+    return f"{SCHOOL_MONITOR_GROUP_NAME}_{municipality_id}"
+
+
+def load_itinerary_state(driver_id: int) -> dict:
+    execution = (
+        TripExecution.objects.filter(driver_id=driver_id, status=TripExecution.Status.IN_PROGRESS)
+        .order_by("-actual_departure", "-scheduled_departure")
+        .first()
+    )
+    if not execution:
+        return {"execution_id": None}
+    stops = []
+    cursor = 0
+    for stop in execution.stops.select_related("destination").order_by("order"):
+        if stop.departure_time is not None and cursor == len(stops):
+            cursor += 1
+        stops.append(
+            {
+                "id": stop.id,
+                "order": stop.order,
+                "destination_id": stop.destination_id,
+                "lat": float(stop.destination.latitude),
+                "lng": float(stop.destination.longitude),
+                "arrived": stop.arrival_time is not None,
+                "departed_at": stop.departure_time.timestamp() if stop.departure_time else None,
+            }
+        )
+    return {
+        "execution_id": execution.id,
+        "municipality_id": execution.municipality_id,
+        "module": execution.module,
+        "stops": stops,
+        "cursor": cursor,
+        "speeds": segment_speeds_for([stop["destination_id"] for stop in stops]),
+    }
+
+
+def stamp_execution_stops(driver_id: int, pings) -> list:
+    """
+    Advance the driver's itinerary with newly stored pings (oldest first).
+
+    Returns the stamp updates that were written, in order.
+    """
+    key = itinerary_state_key(driver_id)
+    state = cache.get(key)
+    if state is None:
+        state = load_itinerary_state(driver_id)
+        cache.set(key, state, ITINERARY_STATE_TTL_SECONDS)
+    if not state["execution_id"]:
+        return []
+    updates = []
+    for ping in pings:
+        updates.extend(_advance(state, float(ping.lat), float(ping.lng), ping.recorded_at))
+    if updates:
+        cache.set(key, state, ITINERARY_STATE_TTL_SECONDS)
+        for update in updates:
+            _push_update(state, update)
+    if pings:
+        update_execution_etas(state, pings[-1])
+    return updates
+
+
+def _distance_m(stop, lat, lng) -> float:
+    return haversine_km(stop["lat"], stop["lng"], lat, lng) * 1000
+
+
+def _advance(state, lat, lng, recorded_at):
+    stops = state["stops"]
+    cursor = state["cursor"]
+    if cursor >= len(stops):
+        return []
+    updates = []
+    current = stops[cursor]
+    upcoming = stops[cursor + 1] if cursor + 1 < len(stops) else None
+    if upcoming and _distance_m(upcoming, lat, lng) <= ARRIVAL_RADIUS_M:
+        # Reached the next stop: close the current one (if it was visited) and move on.
+        if current["arrived"]:
+            updates.append(_depart(current, recorded_at))
+        state["cursor"] = cursor + 1
+        updates.append(_arrive(state, cursor + 1, recorded_at))
+        return [update for update in updates if update]
+    distance = _distance_m(current, lat, lng)
+    if not current["arrived"] and distance <= ARRIVAL_RADIUS_M:
+        updates.append(_arrive(state, cursor, recorded_at))
+    elif current["arrived"] and distance > DEPARTURE_RADIUS_M:
+        state["cursor"] = cursor + 1
+        updates.append(_depart(current, recorded_at))
+    return [update for update in updates if update]
+
+
+def _arrive(state, index, recorded_at):
+    stop = state["stops"][index]
+    stop["arrived"] = True
+    previous = state["stops"][index - 1] if index > 0 else None
+    if previous and previous["departed_at"]:
+        record_segment_sample(
+            state["municipality_id"], previous, stop, recorded_at.timestamp() - previous["departed_at"], state["speeds"]
+        )
+    return _stamp(stop, "arrival_time", recorded_at)
+
+
+def _depart(stop, recorded_at):
+    stop["departed_at"] = recorded_at.timestamp()
+    return _stamp(stop, "departure_time", recorded_at)
+
+
+def _stamp(stop, field, recorded_at):
+    # Conditional so a stamp set manually (or by another worker) is never overwritten.
+    changed = TripExecutionStop.objects.filter(id=stop["id"], **{f"{field}__isnull": True}).update(
+        **{field: recorded_at}
+    )
+    if not changed:
+        return None
+    return {"stop_id": stop["id"], "order": stop["order"], "destination_id": stop["destination_id"], field: recorded_at}
+
+
+def _push_update(state, update):
+    if state["module"] != PlannedTrip.Module.EDUCATION:
+        return
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        return
+    data = {"execution_id": state["execution_id"], **update}
+    for field in ("arrival_time", "departure_time"):
+        if field in data:
+            data[field] = data[field].isoformat()
+    async_to_sync(channel_layer.group_send)(
+        school_monitor_group(state["municipality_id"]), {"type": "stop.update", "data": data}
+    )
@@ -0,0 +1,95 @@
+"""
+Batched map broadcasts (MAP_BROADCAST_TICK_SECONDS > 0).
+
+Each tick reads the `TripPositionChange` log past an id cursor and sends the
+current position of the changed trips to their municipality and tile groups.
+Ids below the newest one read but not seen yet belong to transactions still
+open; they are looked up again for GAP_RETRY_TICKS ticks, so late commits are
+not skipped the way a timestamp window would skip them.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from trips.ingestion import build_map_payload, municipality_group, tile_for, tile_group
+from trips.models import Trip, TripLastPosition, TripPositionChange
+
+GAP_RETRY_TICKS = 10
+# Wider jumps come from sequence caching or restores, not from open transactions.
+MAX_TRACKED_GAPS = 10000
+CHANGE_LOG_RETENTION = timedelta(minutes=10)
+
+
+class MapUpdateCursor:
+    """Position in the `TripPositionChange` log plus the ids skipped while their transactions were open."""
+
+    def __init__(self, last_id=None):
+        if last_id is None:
+            last_id = TripPositionChange.objects.aggregate(last=Max("id"))["last"] or 0
+        self.last_id = last_id
+        self.gaps = {}
+
+    def advance(self) -> set:
+        """Trip ids changed since the previous call."""
+        rows = list(
+            TripPositionChange.objects.filter(Q(id__gt=self.last_id) | Q(id__in=list(self.gaps))).values_list(
+                "id", "trip_id"
+            )
+        )
+        seen = {row_id for row_id, _ in rows}
+        newest = max(seen | {self.last_id})
+        self.gaps = {gap: ticks - 1 for gap, ticks in self.gaps.items() if gap not in seen and ticks > 1}
+        if newest - self.last_id <= MAX_TRACKED_GAPS:
+            self.gaps.update(
+                {missing: GAP_RETRY_TICKS for missing in range(self.last_id + 1, newest) if missing not in seen}
+            )
+        self.last_id = newest
+        return {trip_id for _, trip_id in rows}
+
+
+def collect_map_updates(trip_ids, now=None):
+    """Current position payloads of the given in-progress trips."""
+    if not trip_ids:
+        return []
+    positions = (
+        TripLastPosition.objects.filter(trip_id__in=trip_ids, trip__status=Trip.Status.IN_PROGRESS)
+        .select_related("trip__vehicle", "driver__geofence")
+        .order_by("trip_id")
+    )
+    now = now or timezone.now()
+    return [
+        build_map_payload(position.trip, position.driver, position, position.geofence_alert_active, now=now)
+        for position in positions
+    ]
+
+
+def broadcast_map_batches(cursor: MapUpdateCursor, now=None):
+    """
+    Send one `gps.batch` message per municipality group and per tile group.
+
+    Consumers subscribed to several of these groups merge them into one frame
+    per tick (see OperationsMapConsumer.gps_batch). Returns the number of
+    positions broadcast.
+    """
+    now = now or timezone.now()
+    TripPositionChange.objects.filter(created_at__lt=now - CHANGE_LOG_RETENTION).delete()
+    updates = collect_map_updates(cursor.advance(), now=now)
+    if not updates:
+        return 0
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        return 0
+    batches = defaultdict(list)
+    for payload in updates:
+        batches[municipality_group(payload["municipality_id"])].append(payload)
+        batches[tile_group(*tile_for(payload["lat"], payload["lng"]))].append(payload)
+    sent_at = now.isoformat()
+    for group, positions in batches.items():
+        async_to_sync(channel_layer.group_send)(
+            group, {"type": "gps.batch", "data": {"positions": positions, "sent_at": sent_at}}
+        )
+    return len(updates)
@@ -0,0 +1,83 @@
+"""
+Server-side clustering of the operations map.
+
+Clusters come from a uniform grid whose cell spans `CLUSTER_CELL_PX` screen
+pixels at the requested zoom, filled in one pass over the last-position rows
+inside the bounding box. The response size therefore depends on the viewport,
+not on the fleet size; past `CLUSTER_MAX_ZOOM` the map gets vehicle payloads.
+"""
+from collections import Counter
+from math import floor
+
+from trips.gps import STATUS_IN_ROUTE, STATUS_OFFLINE, STATUS_STOPPED, resolve_status
+from trips.map_state import OFFLINE_AFTER
+from trips.models import Trip, TripLastPosition
+
+CLUSTER_MAX_ZOOM = 14
+CLUSTER_CELL_PX = 64
+TILE_SIZE_PX = 256
+
+
+def cell_size_deg(zoom: int) -> float:
+    return 360 / 2**zoom * CLUSTER_CELL_PX / TILE_SIZE_PX
+
+
+def positions_in_bbox(user, bbox, municipality_id=None):
+    west, south, east, north = bbox
+    qs = TripLastPosition.objects.filter(
+        trip__status=Trip.Status.IN_PROGRESS,
+        lat__gte=south,
+        lat__lte=north,
+        lng__gte=west,
+        lng__lte=east,
+    )
+    if user.role != "SUPERADMIN":
+        qs = qs.filter(municipality=user.municipality)
+    elif municipality_id:
+        qs = qs.filter(municipality_id=municipality_id)
+    return qs.only("trip_id", "lat", "lng", "speed", "recorded_at")
+
+
+def cluster_positions(positions, zoom: int, now):
+    """Group positions into grid clusters with count, centroid, bounds and status breakdown."""
+    size = cell_size_deg(zoom)
+    cells = {}
+    for position in positions:
+        lat, lng = float(position.lat), float(position.lng)
+        key = (floor(lat / size), floor(lng / size))
+        cell = cells.get(key)
+        if cell is None:
+            cell = cells[key] = {
+                "count": 0,
+                "lat_sum": 0.0,
+                "lng_sum": 0.0,
+                "bbox": [lng, lat, lng, lat],
+                "statuses": Counter(),
+                "trip_id": position.trip_id,
+            }
+        cell["count"] += 1
+        cell["lat_sum"] += lat
+        cell["lng_sum"] += lng
+        bounds = cell["bbox"]
+        bounds[0], bounds[1] = min(bounds[0], lng), min(bounds[1], lat)
+        bounds[2], bounds[3] = max(bounds[2], lng), max(bounds[3], lat)
+        cell["statuses"][resolve_status(position, now=now, offline_after=OFFLINE_AFTER)] += 1
+    clusters = []
+    for cell in cells.values():
+        count = cell["count"]
+        clusters.append(
+            {
+                "lat": round(cell["lat_sum"] / count, 6),
+                "lng": round(cell["lng_sum"] / count, 6),
+                "count": count,
+                "bbox": cell["bbox"],
+                "statuses": {
+                    status: cell["statuses"].get(status, 0)
+                    for status in (STATUS_IN_ROUTE, STATUS_STOPPED, STATUS_OFFLINE)
+                },
+                # Lone vehicles keep their trip so the client can open it directly.
+                "trip_id": cell["trip_id"] if count == 1 else None,
+            }
+        )
+    clusters.sort(key=lambda cluster: (cluster["lat"], cluster["lng"]))
+    return clusters
@@ -1,22 +1,262 @@
+import asyncio
+from datetime import UTC, datetime
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.encoders import JSONEncoder
+
+from drivers.portal import resolve_portal_token
+from notifications.services import driver_channel_group
+from tenants.models import Municipality
+from trips.arrivals import school_monitor_group
+from trips.ingestion import (
+    MAX_BATCH_POINTS,
+    TripNotInProgress,
+    ingest_points,
+    municipality_group,
+    tile_group,
+    tiles_for_bbox,
+)
+from trips.map_state import MAP_ROLES, map_snapshot
+from trips.models import Trip
+
+# Close code sent to the driver app once its trip is completed or cancelled.
+CLOSE_TRIP_ENDED = 4409
+# Batches of one broadcast tick reach a consumer through each of its groups within
+# milliseconds; they are merged for this long and sent as one frame.
+BATCH_COALESCE_SECONDS = 0.1
+
+
+@database_sync_to_async
+def _municipality_ids():
+    return list(Municipality.objects.values_list("id", flat=True))
 
 
 class OperationsMapConsumer(AsyncJsonWebsocketConsumer):
-    group_name = "operations_map"
+    """
+    Live positions for the operations map.
+
+    Operators join their municipality's group; superadmins join every municipality
+    (or the one given by `?municipality=`). Sending
+    `{"action": "viewport", "bbox": [west, south, east, north]}` switches the
+    connection to the map tiles covering that box; `"bbox": null` switches back.
+    """
 
     async def connect(self):
         user = self.scope.get("user")
         if not user or not getattr(user, "is_authenticated", False):
             await self.close()
             return
-        if user.role not in ("SUPERADMIN", "ADMIN_MUNICIPALITY", "OPERATOR"):
+        if user.role not in MAP_ROLES:
+            await self.close()
+            return
+        if user.role == "SUPERADMIN":
+            query_params = parse_qs(self.scope.get("query_string", b"").decode())
+            requested = query_params.get("municipality", [""])[0]
+            self.municipality_ids = [int(requested)] if requested.isdigit() else await _municipality_ids()
+        elif user.municipality_id:
+            self.municipality_ids = [user.municipality_id]
+        else:
             await self.close()
             return
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        self.subscribed_groups = set()
+        self.pending_positions = {}
+        self.pending_sent_at = None
+        self.flush_task = None
+        await self._subscribe({municipality_group(municipality_id) for municipality_id in self.municipality_ids})
         await self.accept()
+        drivers = await database_sync_to_async(map_snapshot)(user)
+        await self.send_json({"event": "snapshot", "payload": {"drivers": drivers}})
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        flush_task = getattr(self, "flush_task", None)
+        if flush_task:
+            flush_task.cancel()
+        await self._subscribe(set())
+
+    async def receive_json(self, content, **kwargs):
+        if content.get("action") != "viewport":
+            return
+        bbox = content.get("bbox")
+        tiles = None
+        if isinstance(bbox, (list, tuple)) and len(bbox) == 4:
+            try:
+                tiles = tiles_for_bbox(*(float(value) for value in bbox))
+            except (TypeError, ValueError):
+                tiles = None
+        if tiles:
+            await self._subscribe({tile_group(x, y) for x, y in tiles})
+            await self.send_json({"event": "viewport", "payload": {"mode": "tiles", "tiles": len(tiles)}})
+            return
+        await self._subscribe({municipality_group(municipality_id) for municipality_id in self.municipality_ids})
+        await self.send_json({"event": "viewport", "payload": {"mode": "municipality"}})
+
+    async def _subscribe(self, groups):
+        current = getattr(self, "subscribed_groups", set())
+        for group in current - groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        for group in groups - current:
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.subscribed_groups = set(groups)
 
     async def gps_ping(self, event):
-        await self.send_json({"event": "gps_ping", "payload": event.get("data", {})})
+        data = event.get("data", {})
+        # Tile groups are shared across tenants; keep other municipalities' vehicles out.
+        if data.get("municipality_id") not in self.municipality_ids:
+            return
+        await self.send_json({"event": "gps_ping", "payload": data})
+
+    async def gps_batch(self, event):
+        data = event.get("data", {})
+        positions = [item for item in data.get("positions", []) if item.get("municipality_id") in self.municipality_ids]
+        if not positions:
+            return
+        # A trip reaches a superadmin through every municipality group and a tile client
+        # through several tiles; buffer per trip so the tick goes out as a single frame.
+        for item in positions:
+            self.pending_positions[item["trip_id"]] = item
+        self.pending_sent_at = data.get("sent_at")
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_batch())
+
+    async def _flush_batch(self):
+        await asyncio.sleep(BATCH_COALESCE_SECONDS)
+        positions = sorted(self.pending_positions.values(), key=lambda item: item["trip_id"])
+        self.pending_positions = {}
+        self.flush_task = None
+        await self.send_json({"event": "gps_batch", "payload": {"positions": positions, "sent_at": self.pending_sent_at}})
+
+    @classmethod
+    async def encode_json(cls, content):
+        return JSONEncoder().encode(content)
+
+
+class SchoolMonitorConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Live arrival/departure stamps of school transport stops.
+
+    Users join their municipality's group; superadmins join every municipality
+    (or the one given by `?municipality=`). Events complement the
+    `/api/trips/school-monitor/` dashboard.
+    """
+
+    async def connect(self):
+        user = self.scope.get("user")
+        if not user or not getattr(user, "is_authenticated", False):
+            await self.close()
+            return
+        if user.role == "SUPERADMIN":
+            query_params = parse_qs(self.scope.get("query_string", b"").decode())
+            requested = query_params.get("municipality", [""])[0]
+            municipality_ids = [int(requested)] if requested.isdigit() else await _municipality_ids()
+        elif user.municipality_id:
+            municipality_ids = [user.municipality_id]
+        else:
+            await self.close()
+            return
+        self.groups_joined = [school_monitor_group(municipality_id) for municipality_id in municipality_ids]
+        for group in self.groups_joined:
+            await self.channel_layer.group_add(group, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        for group in getattr(self, "groups_joined", []):
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def stop_update(self, event):
+        await self.send_json({"event": "stop_update", "payload": event.get("data", {})})
+
+
+class DriverGpsConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Continuous GPS stream from the driver portal.
+
+    The portal token (`?driver_token=`) is resolved once on connect and the
+    driver's in-progress trip (optionally `?trip_id=`) stays bound to the
+    connection. Frames are `{"p": [lat, lng, accuracy, speed, epoch_ms]}` or
+    `{"p": [[...], [...]]}` for several points; each frame is acknowledged with
+    `{"event": "ack", ...}`. Notifications for the driver are pushed on the same socket.
+    Once the trip is no longer in progress the next frame gets a `trip_ended`
+    event and the socket is closed with code 4409.
+    """
+
+    async def connect(self):
+        query_params = parse_qs(self.scope.get("query_string", b"").decode())
+        token = query_params.get("driver_token", [""])[0]
+        trip_id = query_params.get("trip_id", [""])[0]
+        binding = await _bind_driver_trip(token, int(trip_id) if trip_id.isdigit() else None)
+        if not binding:
+            await self.close(code=4403)
+            return
+        self.driver, self.trip = binding
+        self.driver_group = driver_channel_group(self.driver.id)
+        await self.channel_layer.group_add(self.driver_group, self.channel_name)
+        await self.accept()
+        await self.send_json({"event": "ready", "payload": {"driver_id": self.driver.id, "trip_id": self.trip.id}})
+
+    async def disconnect(self, close_code):
+        group = getattr(self, "driver_group", None)
+        if group:
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def receive_json(self, content, **kwargs):
+        frames = content.get("p") if isinstance(content, dict) else None
+        if not isinstance(frames, list) or not frames:
+            await self.send_json({"event": "error", "payload": {"detail": "Frame inválido."}})
+            return
+        if not isinstance(frames[0], list):
+            frames = [frames]
+        if len(frames) > MAX_BATCH_POINTS:
+            await self.send_json({"event": "error", "payload": {"detail": f"Máximo de {MAX_BATCH_POINTS} pontos por frame."}})
+            return
+        try:
+            points = [_decode_frame(frame) for frame in frames]
+            result = await database_sync_to_async(ingest_points)(self.trip, self.driver, points)
+        except (TypeError, ValueError, IndexError, OverflowError):
+            await self.send_json({"event": "error", "payload": {"detail": "Pontos inválidos."}})
+            return
+        except TripNotInProgress as exc:
+            await self.send_json({"event": "trip_ended", "payload": {"trip_id": self.trip.id, "detail": exc.detail}})
+            await self.close(code=CLOSE_TRIP_ENDED)
+            return
+        except ValidationError as exc:
+            await self.send_json({"event": "error", "payload": {"detail": exc.detail}})
+            return
+        await self.send_json({"event": "ack", "payload": result})
+
+    async def driver_notification(self, event):
+        await self.send_json({"event": "notification", "payload": event.get("data", {})})
+
+    @classmethod
+    async def encode_json(cls, content):
+        return JSONEncoder().encode(content)
+
+
+def _decode_frame(frame):
+    lat, lng, accuracy, speed, epoch_ms = (list(frame) + [None] * 5)[:5]
+    return {
+        "lat": round(float(lat), 6),
+        "lng": round(float(lng), 6),
+        "accuracy": accuracy,
+        "speed": speed,
+        "recorded_at": datetime.fromtimestamp(float(epoch_ms) / 1000, tz=UTC) if epoch_ms else None,
+    }
+
+
+@database_sync_to_async
+def _bind_driver_trip(token, trip_id):
+    if not token:
+        return None
+    try:
+        driver = resolve_portal_token(token)
+    except Exception:  # noqa: BLE001
+        return None
+    trips_qs = driver.trips.filter(status=Trip.Status.IN_PROGRESS).select_related("vehicle", "municipality")
+    if trip_id:
+        trips_qs = trips_qs.filter(id=trip_id)
+    trip = trips_qs.first()
+    if not trip:
+        return None
+    return driver, trip
@@ -0,0 +1,75 @@
+from itertools import pairwise
+from math import cos, floor, hypot, inf, radians
+
+EARTH_RADIUS_M = 6371000.0
+
+
+class SegmentIndex:
+    """
+    Uniform grid over the segments of a planned route polyline.
+
+    Points are projected to a local equirectangular plane (metres) centred on
+    the route, which stays well under 1% error for municipal-scale routes.
+    Cells are twice the corridor radius and each segment is registered in the
+    cells it passes through, so a lookup only inspects the 3x3 cells around the
+    ping and the segments found there, regardless of route length.
+    """
+
+    def __init__(self, points, radius_m: float):
+        self.radius_m = float(radius_m)
+        self.cell_m = self.radius_m * 2
+        self.ref_lat = sum(lat for lat, _ in points) / len(points)
+        self.x_scale = EARTH_RADIUS_M * cos(radians(self.ref_lat))
+        coords = [self._project(lat, lng) for lat, lng in points]
+        if len(coords) == 1:
+            coords = coords * 2
+        self.segments = list(pairwise(coords))
+        self.cells = {}
+        for segment_id, (start, end) in enumerate(self.segments):
+            for cell in self._cells_along(start, end):
+                self.cells.setdefault(cell, []).append(segment_id)
+
+    @classmethod
+    def from_points(cls, points, radius_m: float):
+        points = [(float(lat), float(lng)) for lat, lng in points]
+        return cls(points, radius_m) if points else None
+
+    def _project(self, lat: float, lng: float):
+        return radians(lng) * self.x_scale, radians(lat) * EARTH_RADIUS_M
+
+    def _cell(self, x: float, y: float):
+        return floor(x / self.cell_m), floor(y / self.cell_m)
+
+    def _cells_along(self, start, end):
+        # Samples every `radius_m`, so any point within the radius of the
+        # segment is at most 1.5 radius (0.75 cell) from a sampled cell.
+        length = hypot(end[0] - start[0], end[1] - start[1])
+        steps = max(1, int(length // self.radius_m) + 1)
+        return {
+            self._cell(start[0] + (end[0] - start[0]) * step / steps, start[1] + (end[1] - start[1]) * step / steps)
+            for step in range(steps + 1)
+        }
+
+    def distance_m(self, lat: float, lng: float) -> float:
+        """Distance to the polyline, or `inf` when no segment lies within the corridor radius."""
+        x, y = self._project(float(lat), float(lng))
+        cell_x, cell_y = self._cell(x, y)
+        candidates = set()
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                candidates.update(self.cells.get((cell_x + dx, cell_y + dy), ()))
+        best = inf
+        for segment_id in candidates:
+            best = min(best, _point_segment_distance(x, y, *self.segments[segment_id]))
+        return best
+
+    def contains(self, lat: float, lng: float) -> bool:
+        return self.distance_m(lat, lng) <= self.radius_m
+
+
+def _point_segment_distance(x: float, y: float, start, end) -> float:
+    (x1, y1), (x2, y2) = start, end
+    dx, dy = x2 - x1, y2 - y1
+    length_sq = dx * dx + dy * dy
+    t = 0.0 if not length_sq else max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / length_sq))
+    return hypot(x - (x1 + t * dx), y - (y1 + t * dy))
@@ -0,0 +1,79 @@
+from decimal import Decimal
+from itertools import islice
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from trips.models import Trip, TripGpsPing
+
+EARTH_RADIUS_KM = 6371.0
+DISTANCE_CHUNK_SIZE = 50000
+
+
+def haversine_track_km(lats, lngs) -> float:
+    """Sum of great-circle distances between consecutive points, vectorized over the whole array."""
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    lng = np.radians(np.asarray(lngs, dtype=np.float64))
+    if len(lat) < 2:
+        return 0.0
+    dlat = np.diff(lat)
+    dlng = np.diff(lng)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlng / 2) ** 2
+    return float(np.sum(2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))))
+
+
+def track_distance_km(trip_id: int, chunk_size: int = DISTANCE_CHUNK_SIZE):
+    """
+    Distance along a trip's GPS track, streamed in chunks.
+
+    Rows are read with a server-side cursor and only `chunk_size` points are
+    held in memory; the last point of each chunk is carried into the next one
+    so the segment between chunks is counted. Returns `(distance_km, points)`.
+    """
+    rows = (
+        TripGpsPing.objects.filter(trip_id=trip_id)
+        .order_by("recorded_at", "id")
+        .values_list("lat", "lng")
+        .iterator(chunk_size=chunk_size)
+    )
+    total = 0.0
+    points = 0
+    carry = None
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        points += len(chunk)
+        coords = np.array(chunk, dtype=np.float64)
+        if carry is not None:
+            coords = np.vstack([carry, coords])
+        total += haversine_track_km(coords[:, 0], coords[:, 1])
+        carry = coords[-1:]
+    return total, points
+
+
+def is_odometer_mismatch(odometer_km, gps_km) -> bool:
+    if odometer_km is None or gps_km is None:
+        return False
+    tolerance_km = max(
+        float(getattr(settings, "ODOMETER_MISMATCH_MIN_KM", 5)),
+        float(gps_km) * float(getattr(settings, "ODOMETER_MISMATCH_RATIO", 0.2)),
+    )
+    return abs(float(odometer_km) - float(gps_km)) > tolerance_km
+
+
+def update_trip_gps_distance(trip: Trip, chunk_size: int = DISTANCE_CHUNK_SIZE):
+    """Store the GPS distance of a trip and flag it when the odometer disagrees."""
+    distance_km, points = track_distance_km(trip.id, chunk_size=chunk_size)
+    gps_km = Decimal(f"{distance_km:.2f}") if points >= 2 else None
+    odometer_km = trip.odometer_end - trip.odometer_start if trip.odometer_end is not None else None
+    trip.gps_distance_km = gps_km
+    trip.gps_distance_computed_at = timezone.now()
+    trip.odometer_mismatch = is_odometer_mismatch(odometer_km, gps_km)
+    Trip.objects.filter(id=trip.id).update(
+        gps_distance_km=trip.gps_distance_km,
+        gps_distance_computed_at=trip.gps_distance_computed_at,
+        odometer_mismatch=trip.odometer_mismatch,
+    )
+    return trip.gps_distance_km
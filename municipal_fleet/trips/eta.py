@@ -0,0 +1,108 @@
+"""
+Live ETAs for the remaining stops of running trip executions.
+
+Segment speeds are learned whenever GPS stamping records a departure from one
+stop and the arrival at the next (see trips.arrivals). They are loaded once
+with the cached itinerary, so each ping only walks the remaining stops with
+plain math and stores the result in the cache for O(1) dashboard reads.
+"""
+from datetime import UTC, datetime
+from itertools import pairwise
+
+from django.core.cache import cache
+from django.db.models import F
+
+from trips.models import StopSegmentSpeed
+from trips.routing import DEFAULT_SPEED_KMH, haversine_km
+
+MIN_SAMPLE_SPEED_KMH = 3.0
+MAX_SAMPLE_SPEED_KMH = 120.0
+# Weight of a new sample in the exponential moving average.
+SPEED_SMOOTHING = 0.3
+ETA_CACHE_SECONDS = 15 * 60
+
+
+def eta_cache_key(execution_id: int) -> str:
+    return f"trips:eta:{execution_id}"
+
+
+def segment_speeds_for(destination_ids) -> dict:
+    pairs = set(pairwise(destination_ids))
+    if not pairs:
+        return {}
+    rows = StopSegmentSpeed.objects.filter(
+        from_destination_id__in={pair[0] for pair in pairs}, to_destination_id__in={pair[1] for pair in pairs}
+    ).values_list("from_destination_id", "to_destination_id", "avg_speed_kmh")
+    return {(from_id, to_id): speed for from_id, to_id, speed in rows if (from_id, to_id) in pairs}
+
+
+def record_segment_sample(municipality_id, from_stop, to_stop, seconds: float, speeds: dict):
+    """Fold one observed stop-to-stop travel time into the learned segment speed."""
+    if seconds <= 0 or from_stop["destination_id"] == to_stop["destination_id"]:
+        return
+    distance_km = haversine_km(from_stop["lat"], from_stop["lng"], to_stop["lat"], to_stop["lng"])
+    speed = distance_km / (seconds / 3600)
+    if not MIN_SAMPLE_SPEED_KMH <= speed <= MAX_SAMPLE_SPEED_KMH:
+        return
+    key = (from_stop["destination_id"], to_stop["destination_id"])
+    updated = StopSegmentSpeed.objects.filter(from_destination_id=key[0], to_destination_id=key[1]).update(
+        avg_speed_kmh=F("avg_speed_kmh") * (1 - SPEED_SMOOTHING) + speed * SPEED_SMOOTHING,
+        samples=F("samples") + 1,
+    )
+    if not updated:
+        StopSegmentSpeed.objects.get_or_create(
+            from_destination_id=key[0],
+            to_destination_id=key[1],
+            defaults={"municipality_id": municipality_id, "avg_speed_kmh": speed, "samples": 1},
+        )
+    previous = speeds.get(key)
+    speeds[key] = speed if previous is None else previous * (1 - SPEED_SMOOTHING) + speed * SPEED_SMOOTHING
+
+
+def compute_etas(state, lat: float, lng: float, recorded_at):
+    """ETA for every stop not yet reached, walking the remaining stops from the current position."""
+    stops = state["stops"]
+    cursor = state["cursor"]
+    if cursor < len(stops) and stops[cursor]["arrived"]:
+        cursor += 1
+    speeds = state.get("speeds", {})
+    timestamp = recorded_at.timestamp()
+    position = (lat, lng)
+    previous = stops[cursor - 1] if cursor > 0 else None
+    distance_total = 0.0
+    etas = []
+    for stop in stops[cursor:]:
+        distance_km = haversine_km(position[0], position[1], stop["lat"], stop["lng"])
+        speed = DEFAULT_SPEED_KMH
+        if previous:
+            speed = speeds.get((previous["destination_id"], stop["destination_id"]), DEFAULT_SPEED_KMH)
+        timestamp += distance_km / speed * 3600
+        distance_total += distance_km
+        etas.append(
+            {
+                "stop_id": stop["id"],
+                "order": stop["order"],
+                "eta": datetime.fromtimestamp(timestamp, tz=UTC).isoformat(),
+                "distance_km": round(distance_total, 2),
+            }
+        )
+        position = (stop["lat"], stop["lng"])
+        previous = stop
+    return etas
+
+
+def update_execution_etas(state, ping) -> dict:
+    payload = {
+        "execution_id": state["execution_id"],
+        "computed_at": ping.recorded_at.isoformat(),
+        "position": {"lat": float(ping.lat), "lng": float(ping.lng)},
+        "stops": compute_etas(state, float(ping.lat), float(ping.lng), ping.recorded_at),
+    }
+    cache.set(eta_cache_key(state["execution_id"]), payload, ETA_CACHE_SECONDS)
+    return payload
+
+
+def cached_etas(execution_ids) -> dict:
+    """Latest ETA payload per execution id, straight from the cache."""
+    keys = {eta_cache_key(execution_id): execution_id for execution_id in execution_ids}
+    return {keys[key]: value for key, value in cache.get_many(list(keys)).items()}
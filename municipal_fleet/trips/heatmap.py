@@ -0,0 +1,139 @@
+"""
+GPS density grid for the operations heatmap.
+
+Pings are counted per uniform lat/lng grid cell, local day and hour of day and
+municipality. Ingestion adds each stored batch with a single INSERT ... ON
+CONFLICT increment (SQLite and PostgreSQL share the syntax), so a month-long
+heatmap is read from the aggregated cells instead of the raw pings.
+"""
+from collections import Counter
+from decimal import Decimal
+from math import floor
+
+from django.db import connection, transaction
+from django.db.models import Count, F, Sum, Value
+from django.db.models.functions import ExtractHour, Floor, TruncDate
+from django.utils import timezone
+
+from trips.models import GpsDensityCell, TripGpsPing
+
+# ~220 m of latitude; a municipality fits in a few thousand cells. Decimal so the
+# database rebuild and the incremental path floor coordinates identically.
+CELL_DEG = Decimal("0.002")
+MAX_CELLS = 20000
+# Cells per upsert statement; keeps the bound parameters well under SQLite's limit.
+UPSERT_CHUNK = 1000
+
+
+def cell_index(value) -> int:
+    return floor(Decimal(str(value)) / CELL_DEG)
+
+
+def cell_center(index: int) -> float:
+    return float((index + Decimal("0.5")) * CELL_DEG)
+
+
+def density_counts(pings) -> Counter:
+    counts = Counter()
+    for ping in pings:
+        local = timezone.localtime(ping.recorded_at)
+        counts[(local.date(), local.hour, cell_index(ping.lat), cell_index(ping.lng))] += 1
+    return counts
+
+
+def record_density(municipality_id: int, pings) -> None:
+    """Add newly stored pings to the density grid, one upsert per chunk of distinct cells."""
+    counts = list(density_counts(pings).items())
+    table = GpsDensityCell._meta.db_table
+    for start in range(0, len(counts), UPSERT_CHUNK):
+        chunk = counts[start : start + UPSERT_CHUNK]
+        params = []
+        for (day, hour, lat_index, lng_index), count in chunk:
+            params += [municipality_id, connection.ops.adapt_datefield_value(day), hour, lat_index, lng_index, count]
+        rows = ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(chunk))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (municipality_id, day, hour, lat_index, lng_index, ping_count) VALUES {rows} "
+                "ON CONFLICT (municipality_id, day, hour, lat_index, lng_index) "
+                f"DO UPDATE SET ping_count = {table}.ping_count + excluded.ping_count",
+                params,
+            )
+
+
+def rebuild_density(start_date, end_date, municipality_id=None) -> int:
+    """Recompute the cells of a local date range from the stored pings, grouped in the database."""
+    tz = timezone.get_current_timezone()
+    cells = GpsDensityCell.objects.filter(day__gte=start_date, day__lte=end_date)
+    pings = TripGpsPing.objects.annotate(day=TruncDate("recorded_at", tzinfo=tz)).filter(
+        day__gte=start_date, day__lte=end_date
+    )
+    if municipality_id:
+        cells = cells.filter(municipality_id=municipality_id)
+        pings = pings.filter(trip__municipality_id=municipality_id)
+    rows = (
+        pings.annotate(
+            hour=ExtractHour("recorded_at", tzinfo=tz),
+            lat_index=Floor(F("lat") / Value(CELL_DEG)),
+            lng_index=Floor(F("lng") / Value(CELL_DEG)),
+        )
+        .values("trip__municipality_id", "day", "hour", "lat_index", "lng_index")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    # Readers never see the range empty, and a failed rebuild keeps the old cells.
+    with transaction.atomic():
+        cells.delete()
+        created = GpsDensityCell.objects.bulk_create(
+            (
+                GpsDensityCell(
+                    municipality_id=row["trip__municipality_id"],
+                    day=row["day"],
+                    hour=row["hour"],
+                    lat_index=int(row["lat_index"]),
+                    lng_index=int(row["lng_index"]),
+                    ping_count=row["count"],
+                )
+                for row in rows.iterator(chunk_size=5000)
+            ),
+            batch_size=1000,
+        )
+    return len(created)
+
+
+def parse_hours(value: str) -> list:
+    """Hours of day from "7-9" (inclusive range) or "7,12,18". Raises ValueError."""
+    hours = set()
+    for part in value.split(","):
+        start, _, end = part.partition("-")
+        first, last = int(start), int(end or start)
+        if not 0 <= first <= last <= 23:
+            raise ValueError(value)
+        hours.update(range(first, last + 1))
+    return sorted(hours)
+
+
+def heatmap_cells(municipality_id, start_date, end_date, bbox=None, hours=None):
+    """
+    Ping counts per cell over a date range, optionally limited to a bounding box and hours of day.
+
+    `bbox` is `(west, south, east, north)`. Returns `(cells, truncated)`, densest first.
+    """
+    qs = GpsDensityCell.objects.filter(municipality_id=municipality_id, day__gte=start_date, day__lte=end_date)
+    if bbox:
+        west, south, east, north = bbox
+        qs = qs.filter(
+            lat_index__gte=cell_index(south),
+            lat_index__lte=cell_index(north),
+            lng_index__gte=cell_index(west),
+            lng_index__lte=cell_index(east),
+        )
+    if hours:
+        qs = qs.filter(hour__in=hours)
+    rows = list(
+        qs.values("lat_index", "lng_index").annotate(count=Sum("ping_count")).order_by("-count")[: MAX_CELLS + 1]
+    )
+    cells = [
+        {"lat": cell_center(row["lat_index"]), "lng": cell_center(row["lng_index"]), "count": row["count"]}
+        for row in rows[:MAX_CELLS]
+    ]
+    return cells, len(rows) > MAX_CELLS
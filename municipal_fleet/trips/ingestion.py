@@ -0,0 +1,393 @@
+import math
+import time
+from contextlib import nullcontext
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import exceptions, status
+
+from trips.arrivals import stamp_execution_stops
+from trips.gps import STATUS_LABELS, resolve_status
+from trips.heatmap import record_density
+from trips.models import Trip, TripGpsPing, TripGpsPingQueue, TripLastPosition, TripPositionChange
+from trips.routing import haversine_km
+from trips.stops import update_trip_stops
+
+MAP_GROUP_NAME = "operations_map"
+# Slippy-map zoom used for viewport subscriptions (~10 km tiles at the equator).
+MAP_TILE_ZOOM = 12
+MAX_VIEWPORT_TILES = 64
+MAX_BATCH_POINTS = 500
+INGESTION_MODE_SYNC = "sync"
+INGESTION_MODE_QUEUE = "queue"
+FLUSH_METRICS_CACHE_KEY = "trips:gps-queue:last-flush"
+PING_FIELDS = ("lat", "lng", "accuracy", "speed", "recorded_at")
+REJECT_ACCURACY = "accuracy"
+REJECT_DUPLICATE = "duplicate"
+REJECT_SPEED = "speed"
+REJECT_REASONS = (REJECT_ACCURACY, REJECT_DUPLICATE, REJECT_SPEED)
+LAST_ACCEPTED_TTL_SECONDS = 6 * 60 * 60
+# Consecutive speed rejections that agree with each other and replace the newest accepted fix,
+# which was then the outlier (e.g. a bad first fix after the app starts).
+OUTLIER_RESET_FIXES = 3
+
+
+class TripNotInProgress(exceptions.APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "A viagem não está mais em andamento."
+    default_code = "trip_not_in_progress"
+
+
+def geofence_payload(geofence):
+    if not geofence:
+        return None
+    return {
+        "center_lat": float(geofence.center_lat),
+        "center_lng": float(geofence.center_lng),
+        "radius_m": geofence.radius_m,
+        "is_active": geofence.is_active,
+        "alert_active": geofence.alert_active,
+    }
+
+
+def build_map_payload(trip, driver, ping, geofence_alert_active, now=None):
+    status_code = resolve_status(ping, now=now or timezone.now())
+    return {
+        "trip_id": trip.id,
+        "municipality_id": trip.municipality_id,
+        "driver_id": driver.id,
+        "driver_name": driver.name,
+        "vehicle_id": trip.vehicle_id,
+        "vehicle_plate": trip.vehicle.license_plate,
+        "status": status_code,
+        "status_label": STATUS_LABELS.get(status_code, status_code),
+        "geofence_alert_active": geofence_alert_active,
+        "geofence": geofence_payload(getattr(driver, "geofence", None)),
+        "lat": float(ping.lat),
+        "lng": float(ping.lng),
+        "accuracy": ping.accuracy,
+        "speed": ping.speed,
+        "recorded_at": ping.recorded_at.isoformat(),
+    }
+
+
+def municipality_group(municipality_id):
+    return f"{MAP_GROUP_NAME}_{municipality_id}"
+
+
+def tile_for(lat, lng, zoom=MAP_TILE_ZOOM):
+    scale = 2**zoom
+    lat = max(min(float(lat), 85.0511), -85.0511)
+    x = int((float(lng) + 180.0) / 360.0 * scale)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * scale)
+    return min(max(x, 0), scale - 1), min(max(y, 0), scale - 1)
+
+
+def tile_group(x, y, zoom=MAP_TILE_ZOOM):
+    return f"{MAP_GROUP_NAME}_tile_{zoom}_{x}_{y}"
+
+
+def tiles_for_bbox(west, south, east, north, zoom=MAP_TILE_ZOOM):
+    """Tile coordinates covering a bounding box, or None when it spans more than MAX_VIEWPORT_TILES."""
+    min_x, min_y = tile_for(north, west, zoom)
+    max_x, max_y = tile_for(south, east, zoom)
+    if min_x > max_x or min_y > max_y:
+        return None
+    if (max_x - min_x + 1) * (max_y - min_y + 1) > MAX_VIEWPORT_TILES:
+        return None
+    return [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+
+def broadcast_map_ping(payload):
+    """Send a position update to its municipality group and to the group of the tile it falls in."""
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        return
+    event = {"type": "gps.ping", "data": payload}
+    async_to_sync(channel_layer.group_send)(municipality_group(payload["municipality_id"]), event)
+    async_to_sync(channel_layer.group_send)(tile_group(*tile_for(payload["lat"], payload["lng"])), event)
+
+
+def record_last_position(trip, ping, geofence_alert_active=False):
+    """Upsert the trip's last known position, ignoring points older than the stored one."""
+    values = {
+        "geofence_alert_active": bool(geofence_alert_active),
+        "driver_id": ping.driver_id,
+        "lat": ping.lat,
+        "lng": ping.lng,
+        "accuracy": ping.accuracy,
+        "speed": ping.speed,
+        "recorded_at": ping.recorded_at,
+    }
+    tick = map_broadcast_tick()
+    # The change log row must commit together with the position it announces.
+    with transaction.atomic() if tick else nullcontext():
+        updated = TripLastPosition.objects.filter(trip_id=trip.id, recorded_at__lte=ping.recorded_at).update(
+            updated_at=timezone.now(), **values
+        )
+        if not updated:
+            _, updated = TripLastPosition.objects.get_or_create(
+                trip_id=trip.id, defaults={"municipality_id": trip.municipality_id, **values}
+            )
+        if updated and tick:
+            TripPositionChange.objects.create(trip_id=trip.id)
+
+
+def apply_ping_side_effects(trip, driver, ping, now=None, batch=None):
+    """
+    Last position, geofence and map broadcast for the newest accepted ping of a trip.
+
+    `batch` holds every ping stored with it (oldest first) for the stop detector,
+    execution stop stamping and the density grid; it defaults to the single ping.
+    """
+    from notifications.services import dispatch_geofence_alert  # local import to avoid cycles
+
+    update_trip_stops(trip.id, batch or [ping])
+    stamp_execution_stops(trip.driver_id, batch or [ping])
+    record_density(trip.municipality_id, batch or [ping])
+    geofence_alert_active = dispatch_geofence_alert(trip, ping)
+    record_last_position(trip, ping, geofence_alert_active=geofence_alert_active)
+    if not map_broadcast_tick():
+        broadcast_map_ping(build_map_payload(trip, driver, ping, geofence_alert_active, now=now))
+    return geofence_alert_active
+
+
+def map_broadcast_tick():
+    """Seconds between coalesced map broadcasts; 0 broadcasts every ping as it arrives."""
+    return float(getattr(settings, "MAP_BROADCAST_TICK_SECONDS", 0) or 0)
+
+
+def ingestion_mode():
+    return getattr(settings, "GPS_INGESTION_MODE", INGESTION_MODE_SYNC)
+
+
+def enqueue_pings(trip, driver, validated_points):
+    """Stage validated points for the background flusher instead of writing TripGpsPing rows."""
+    rows = [
+        TripGpsPingQueue(trip_id=trip.id, driver_id=driver.id, **{field: attrs.get(field) for field in PING_FIELDS})
+        for attrs in validated_points
+    ]
+    TripGpsPingQueue.objects.bulk_create(rows)
+    return len(rows)
+
+
+def _filter_state_key(driver_id):
+    return f"trips:gps-filter:state:{driver_id}"
+
+
+def _rejected_counter_key(reason):
+    return f"trips:gps-filter:rejected:{reason}"
+
+
+def filter_points(driver, validated_points, trip_id=None):
+    """
+    Drop inaccurate, duplicate and teleporting fixes from validated points.
+
+    Points are checked oldest first against the driver's newest accepted fix,
+    which is kept in the cache between requests; fixes older than it are not
+    speed-checked. `OUTLIER_RESET_FIXES` consecutive speed rejections that are
+    consistent with each other replace that fix, so a bad anchor cannot block
+    the driver. With `trip_id`, fixes whose timestamp is already stored or
+    queued for the trip count as duplicates too. Returns the accepted points
+    (sorted by `recorded_at`) and a per-reason count of rejections.
+    """
+    max_accuracy = float(getattr(settings, "GPS_MAX_ACCURACY_M", 100))
+    max_speed_mps = float(getattr(settings, "GPS_MAX_SPEED_KMH", 180)) / 3.6
+    key = _filter_state_key(driver.id)
+    stored = cache.get(key) or (None, [])
+    last, suspects = stored
+    accepted = []
+    rejected = dict.fromkeys(REJECT_REASONS, 0)
+    for attrs in sorted(validated_points, key=lambda item: item["recorded_at"]):
+        lat, lng = float(attrs["lat"]), float(attrs["lng"])
+        accuracy = attrs.get("accuracy")
+        timestamp = attrs["recorded_at"].timestamp()
+        if accuracy is not None and not 0 < accuracy <= max_accuracy:
+            rejected[REJECT_ACCURACY] += 1
+            continue
+        elapsed = timestamp - last[2] if last else None
+        if elapsed == 0:
+            rejected[REJECT_DUPLICATE] += 1
+            continue
+        if elapsed is not None and elapsed < 0:
+            # Late (offline-buffered) fixes are kept but cannot be judged against newer ones.
+            accepted.append(attrs)
+            continue
+        fix = (lat, lng, timestamp)
+        if elapsed is not None and _too_fast(last, fix, accuracy, max_speed_mps):
+            if suspects and not _too_fast(suspects[-1], fix, accuracy, max_speed_mps):
+                suspects = [*suspects, fix]
+            else:
+                suspects = [fix]
+            if len(suspects) < OUTLIER_RESET_FIXES:
+                rejected[REJECT_SPEED] += 1
+                continue
+        suspects = []
+        last = fix
+        accepted.append(attrs)
+    if trip_id is not None and accepted:
+        accepted = _drop_stored_duplicates(trip_id, accepted, rejected)
+    if (last, suspects) != stored:
+        cache.set(key, (last, suspects), LAST_ACCEPTED_TTL_SECONDS)
+    _count_rejections(rejected)
+    return accepted, rejected
+
+
+def _too_fast(origin, fix, accuracy, max_speed_mps):
+    """Whether reaching `fix` from `origin` needs more than the maximum speed."""
+    elapsed = fix[2] - origin[2]
+    # The fix's own accuracy is tolerated as jitter before judging the speed.
+    distance_m = haversine_km(origin[0], origin[1], fix[0], fix[1]) * 1000 - (accuracy or 0)
+    return elapsed <= 0 or distance_m > max_speed_mps * elapsed
+
+
+def _drop_stored_duplicates(trip_id, points, rejected):
+    """Remove fixes already stored or queued for the trip, e.g. from a batch resent after a lost response."""
+    timestamps = [attrs["recorded_at"] for attrs in points]
+    stored = TripGpsPing.objects.filter(trip_id=trip_id, recorded_at__in=timestamps).order_by()
+    queued = TripGpsPingQueue.objects.filter(trip_id=trip_id, recorded_at__in=timestamps).order_by()
+    seen = set(stored.values_list("recorded_at", flat=True).union(queued.values_list("recorded_at", flat=True)))
+    unique = []
+    for attrs in points:
+        if attrs["recorded_at"] in seen:
+            rejected[REJECT_DUPLICATE] += 1
+            continue
+        seen.add(attrs["recorded_at"])
+        unique.append(attrs)
+    return unique
+
+
+def _count_rejections(rejected):
+    for reason, count in rejected.items():
+        if not count:
+            continue
+        key = _rejected_counter_key(reason)
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key, count)
+        except ValueError:
+            # Evicted between add and incr; start over from this batch.
+            cache.set(key, count, None)
+
+
+def rejection_counters():
+    values = cache.get_many([_rejected_counter_key(reason) for reason in REJECT_REASONS])
+    return {reason: values.get(_rejected_counter_key(reason), 0) for reason in REJECT_REASONS}
+
+
+def ingest_points(trip, driver, raw_points, now=None):
+    """
+    Validate and store a batch of raw points for an in-progress trip.
+
+    The trip status is read again for every batch, so a trip completed or
+    cancelled meanwhile raises `TripNotInProgress` instead of collecting
+    points. Raises `ValidationError` if any point is invalid. Points dropped by
+    `filter_points` are reported under `rejected`. Side effects run once,
+    against the newest accepted point; in queue mode they are left to the flusher.
+    """
+    from trips.serializers import TripGpsPointSerializer  # local import to avoid cycles
+
+    if not Trip.objects.filter(id=trip.id, status=Trip.Status.IN_PROGRESS).exists():
+        raise TripNotInProgress()
+    now = now or timezone.now()
+    payload = [
+        {
+            "lat": point.get("lat"),
+            "lng": point.get("lng"),
+            "accuracy": point.get("accuracy"),
+            "speed": point.get("speed"),
+            "recorded_at": point.get("recorded_at") or now,
+        }
+        for point in raw_points
+    ]
+    serializer = TripGpsPointSerializer(data=payload, many=True)
+    serializer.is_valid(raise_exception=True)
+    accepted, rejected = filter_points(driver, serializer.validated_data, trip_id=trip.id)
+    if ingestion_mode() == INGESTION_MODE_QUEUE:
+        queued = enqueue_pings(trip, driver, accepted) if accepted else 0
+        return {"trip_id": trip.id, "queued": queued, "rejected": rejected}
+    if not accepted:
+        return {
+            "trip_id": trip.id,
+            "accepted": 0,
+            "rejected": rejected,
+            "last_recorded_at": None,
+            "geofence_alert_active": None,
+        }
+    pings = [TripGpsPing(trip=trip, driver=driver, **attrs) for attrs in accepted]
+    TripGpsPing.objects.bulk_create(pings)
+    latest = pings[-1]
+    geofence_alert_active = apply_ping_side_effects(trip, driver, latest, now=now, batch=pings)
+    return {
+        "trip_id": trip.id,
+        "accepted": len(pings),
+        "rejected": rejected,
+        "last_recorded_at": latest.recorded_at,
+        "geofence_alert_active": geofence_alert_active,
+    }
+
+
+def flush_ping_queue(batch_size=None):
+    """
+    Move one batch of staged pings into TripGpsPing and run side effects once per trip.
+
+    Returns the number of pings flushed.
+    """
+    batch_size = batch_size or getattr(settings, "GPS_QUEUE_FLUSH_BATCH_SIZE", 5000)
+    started = time.monotonic()
+    with transaction.atomic():
+        queued = list(TripGpsPingQueue.objects.select_for_update(skip_locked=True).order_by("id")[:batch_size])
+        if not queued:
+            return 0
+        pings = [
+            TripGpsPing(trip_id=row.trip_id, driver_id=row.driver_id, **{field: getattr(row, field) for field in PING_FIELDS})
+            for row in queued
+        ]
+        TripGpsPing.objects.bulk_create(pings, batch_size=1000)
+        TripGpsPingQueue.objects.filter(id__in=[row.id for row in queued]).delete()
+
+    pings_by_trip = {}
+    for ping in pings:
+        pings_by_trip.setdefault(ping.trip_id, []).append(ping)
+    trips = Trip.objects.select_related("driver__geofence", "vehicle", "municipality").in_bulk(list(pings_by_trip))
+    now = timezone.now()
+    for trip_id, trip_pings in pings_by_trip.items():
+        trip = trips.get(trip_id)
+        if not trip:
+            continue
+        if trip.status != Trip.Status.IN_PROGRESS:
+            # Pings queued before the trip ended are still history, but must not reopen
+            # stops, alert, move the last position or reappear on the live map.
+            record_density(trip.municipality_id, trip_pings)
+            continue
+        trip_pings.sort(key=lambda item: item.recorded_at)
+        apply_ping_side_effects(trip, trip.driver, trip_pings[-1], now=now, batch=trip_pings)
+
+    cache.set(
+        FLUSH_METRICS_CACHE_KEY,
+        {
+            "flushed_at": now.isoformat(),
+            "rows": len(pings),
+            "trips": len(pings_by_trip),
+            "duration_ms": round((time.monotonic() - started) * 1000, 2),
+            "max_wait_seconds": round((now - min(row.enqueued_at for row in queued)).total_seconds(), 3),
+        },
+        None,
+    )
+    return len(pings)
+
+
+def queue_metrics():
+    oldest = TripGpsPingQueue.objects.order_by("id").values_list("enqueued_at", flat=True).first()
+    return {
+        "mode": ingestion_mode(),
+        "queue_depth": TripGpsPingQueue.objects.count(),
+        "oldest_enqueued_at": oldest,
+        "lag_seconds": round((timezone.now() - oldest).total_seconds(), 3) if oldest else 0.0,
+        "last_flush": cache.get(FLUSH_METRICS_CACHE_KEY),
+        "rejected": rejection_counters(),
+    }
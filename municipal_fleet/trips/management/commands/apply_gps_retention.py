@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from trips.partitions import ARCHIVE_CHUNK_SIZE, apply_retention
+
+
+class Command(BaseCommand):
+    help = (
+        "Arquiva em trilhas compactadas os pings GPS antigos de viagens concluídas ou canceladas, "
+        "expira os de viagens não finalizadas e remove as partições liberadas."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months",
+            type=int,
+            default=getattr(settings, "GPS_RETENTION_MONTHS", 12),
+            help="Meses completos de pings brutos mantidos.",
+        )
+        parser.add_argument("--chunk-size", type=int, default=ARCHIVE_CHUNK_SIZE, help="Pings lidos por lote.")
+
+    def handle(self, *args, **options):
+        if options["months"] < 1:
+            raise CommandError("--months deve ser maior ou igual a 1.")
+        result = apply_retention(options["months"], chunk_size=options["chunk_size"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Corte: {result['cutoff']:%Y-%m-%d}. Viagens arquivadas: {result['archived']} "
+                f"(pings removidos: {result['deleted']}, pings expirados: {result['expired']}, "
+                f"partições removidas: {len(result['dropped'])})"
+            )
+        )
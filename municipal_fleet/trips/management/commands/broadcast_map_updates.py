@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from trips.broadcaster import MapUpdateCursor, broadcast_map_batches
+from trips.ingestion import map_broadcast_tick
+
+
+class Command(BaseCommand):
+    help = "Envia ao mapa de operações as posições alteradas a cada tick (MAP_BROADCAST_TICK_SECONDS)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tick", type=float, default=None, help="Intervalo em segundos entre envios.")
+
+    def handle(self, *args, **options):
+        tick = options["tick"] or map_broadcast_tick() or 1.0
+        cursor = MapUpdateCursor()
+        self.stdout.write(f"Transmitindo atualizações do mapa a cada {tick:g}s.")
+        while True:
+            started = time.monotonic()
+            broadcast_map_batches(cursor)
+            time.sleep(max(0.0, tick - (time.monotonic() - started)))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from tenants.models import Municipality
+from trips.matrix import build_destination_matrix
+
+
+class Command(BaseCommand):
+    help = "Recalcula a matriz de distâncias/tempos entre os destinos ativos de cada município."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--municipality", type=int, help="Somente este município.")
+
+    def handle(self, *args, **options):
+        municipalities = Municipality.objects.order_by("id").values_list("id", flat=True)
+        if options["municipality"]:
+            municipalities = municipalities.filter(id=options["municipality"])
+        for municipality_id in municipalities:
+            data = build_destination_matrix(municipality_id)
+            self.stdout.write(f"Município {municipality_id}: {len(data.destination_ids)} destinos")
+        self.stdout.write(self.style.SUCCESS("Matrizes atualizadas."))
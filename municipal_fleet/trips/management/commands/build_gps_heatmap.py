@@ -0,0 +1,24 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from trips.heatmap import rebuild_density
+
+
+class Command(BaseCommand):
+    help = "Recalcula a grade de densidade (mapa de calor) a partir dos pings GPS armazenados."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", type=str, help="Data inicial AAAA-MM-DD (padrão: 30 dias atrás).")
+        parser.add_argument("--until", type=str, help="Data final AAAA-MM-DD (padrão: hoje).")
+        parser.add_argument("--municipality", type=int, help="Somente este município.")
+
+    def handle(self, *args, **options):
+        try:
+            until = date.fromisoformat(options["until"]) if options["until"] else timezone.localdate()
+            since = date.fromisoformat(options["since"]) if options["since"] else until - timedelta(days=30)
+        except ValueError as exc:
+            raise CommandError("Data inválida; use AAAA-MM-DD.") from exc
+        cells = rebuild_density(since, until, municipality_id=options["municipality"])
+        self.stdout.write(self.style.SUCCESS(f"Células geradas: {cells} ({since} a {until})"))
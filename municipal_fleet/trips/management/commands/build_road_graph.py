@@ -0,0 +1,41 @@
+import os
+import time
+from xml.etree import ElementTree
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from tenants.models import Municipality
+from trips.matrix import build_destination_matrix
+from trips.road_network import build_road_graph, graph_path
+
+
+class Command(BaseCommand):
+    help = "Gera o grafo viário (hierarquia de contração) de um município a partir de um extrato OSM local."
+
+    def add_arguments(self, parser):
+        parser.add_argument("extract", type=str, help="Arquivo .osm, .osm.bz2, .osm.gz ou .osm.pbf.")
+        parser.add_argument("--municipality", type=int, required=True, help="Município atendido pelo extrato.")
+
+    def handle(self, *args, **options):
+        municipality_id = options["municipality"]
+        if not Municipality.objects.filter(id=municipality_id).exists():
+            raise CommandError("Município não encontrado.")
+        started = time.monotonic()
+        try:
+            graph = build_road_graph(options["extract"])
+        except (ImproperlyConfigured, OSError, ElementTree.ParseError) as exc:
+            raise CommandError(f"Não foi possível ler o extrato: {exc}") from exc
+        if not len(graph.lats):
+            raise CommandError("Nenhuma via trafegável encontrada no extrato.")
+        os.makedirs(str(settings.ROAD_GRAPH_DIR), exist_ok=True)
+        graph.save(graph_path(municipality_id))
+        # The destination matrix is recomputed so cached routes follow the new graph.
+        build_destination_matrix(municipality_id)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Grafo salvo: {len(graph.lats)} nós, {graph.edge_count} arestas "
+                f"({time.monotonic() - started:.1f}s)"
+            )
+        )
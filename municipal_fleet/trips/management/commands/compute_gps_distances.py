@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from trips.distance import DISTANCE_CHUNK_SIZE, update_trip_gps_distance
+from trips.models import Trip
+
+
+class Command(BaseCommand):
+    help = "Calcula a distância percorrida pelo GPS das viagens concluídas e sinaliza divergências com o odômetro."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--trip", type=int, action="append", help="ID da viagem (pode repetir).")
+        parser.add_argument("--all", action="store_true", help="Recalcula também viagens já processadas.")
+        parser.add_argument("--chunk-size", type=int, default=DISTANCE_CHUNK_SIZE, help="Pings lidos por lote.")
+
+    def handle(self, *args, **options):
+        qs = Trip.objects.filter(status=Trip.Status.COMPLETED)
+        if options["trip"]:
+            qs = Trip.objects.filter(id__in=options["trip"])
+        elif not options["all"]:
+            qs = qs.filter(gps_distance_computed_at__isnull=True)
+        processed = 0
+        mismatches = 0
+        for trip in qs.only("id", "odometer_start", "odometer_end").order_by("id").iterator(chunk_size=500):
+            update_trip_gps_distance(trip, chunk_size=options["chunk_size"])
+            processed += 1
+            mismatches += trip.odometer_mismatch
+        self.stdout.write(self.style.SUCCESS(f"Viagens processadas: {processed} (divergências: {mismatches})"))
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from trips.partitions import ensure_partitions, is_partitioned
+
+
+class Command(BaseCommand):
+    help = "Cria antecipadamente as partições mensais da tabela de pings GPS (PostgreSQL)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months-ahead",
+            type=int,
+            default=getattr(settings, "GPS_PARTITION_MONTHS_AHEAD", 3),
+            help="Quantidade de meses futuros com partição garantida.",
+        )
+
+    def handle(self, *args, **options):
+        if not is_partitioned():
+            self.stdout.write("Tabela de pings GPS não é particionada neste banco; nada a fazer.")
+            return
+        created = ensure_partitions(options["months_ahead"])
+        self.stdout.write(self.style.SUCCESS(f"Partições criadas: {len(created)}"))
+        for name in created:
+            self.stdout.write(f"  {name}")
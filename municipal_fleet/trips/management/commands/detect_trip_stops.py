@@ -0,0 +1,32 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from trips.models import Trip
+from trips.stops import BACKFILL_CHUNK_SIZE, backfill_trip_stops
+
+
+class Command(BaseCommand):
+    help = "Reconstrói as paradas (tempo parado) das viagens a partir do histórico de GPS."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--trip", type=int, action="append", help="ID da viagem (pode repetir).")
+        parser.add_argument("--since", type=str, help="Somente viagens com saída a partir de AAAA-MM-DD.")
+        parser.add_argument("--chunk-size", type=int, default=BACKFILL_CHUNK_SIZE, help="Pings lidos por lote.")
+
+    def handle(self, *args, **options):
+        qs = Trip.objects.filter(gps_pings__isnull=False).distinct()
+        if options["trip"]:
+            qs = qs.filter(id__in=options["trip"])
+        if options["since"]:
+            try:
+                since = date.fromisoformat(options["since"])
+            except ValueError as exc:
+                raise CommandError("Data inválida em --since; use AAAA-MM-DD.") from exc
+            qs = qs.filter(departure_datetime__date__gte=since)
+        trips = 0
+        stops = 0
+        for trip in qs.only("id", "status").order_by("id").iterator(chunk_size=500):
+            stops += backfill_trip_stops(trip, chunk_size=options["chunk_size"])
+            trips += 1
+        self.stdout.write(self.style.SUCCESS(f"Viagens processadas: {trips} (paradas: {stops})"))
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from trips.ingestion import flush_ping_queue
+
+
+class Command(BaseCommand):
+    help = "Grava em lote os pings de GPS enfileirados (modo GPS_INGESTION_MODE=queue)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None, help="Pings por lote.")
+        parser.add_argument("--interval", type=float, default=1.0, help="Segundos de espera quando a fila está vazia.")
+        parser.add_argument("--once", action="store_true", help="Esvazia a fila uma vez e encerra.")
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            flushed = flush_ping_queue(batch_size=options["batch_size"])
+            total += flushed
+            if flushed:
+                continue
+            if options["once"]:
+                break
+            time.sleep(options["interval"])
+        self.stdout.write(self.style.SUCCESS(f"Pings gravados: {total}"))
@@ -0,0 +1,183 @@
+import hashlib
+import json
+from datetime import UTC, datetime, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+from drivers.models import DriverGeofence
+from trips.gps import STATUS_LABELS, resolve_status
+from trips.ingestion import geofence_payload
+from trips.models import Trip, TripGpsPing, TripLastPosition
+from trips.simplify import simplify_rows
+
+MAP_ROLES = ("SUPERADMIN", "ADMIN_MUNICIPALITY", "OPERATOR")
+OFFLINE_AFTER = timedelta(minutes=2)
+# Delta queries look back a little before the cursor so rows committed by
+# transactions still open at snapshot time are not missed; clients dedupe.
+CURSOR_OVERLAP = timedelta(seconds=2)
+# Late pings are only picked up by deltas when recorded at most this long before the cursor.
+DELTA_LATE_POINT_WINDOW = timedelta(minutes=10)
+
+
+def parse_bbox(value: str):
+    """`west,south,east,north` query value (GeoJSON order) as a tuple of floats. Raises ValueError."""
+    bbox = tuple(float(part) for part in value.split(","))
+    if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        raise ValueError(value)
+    return bbox
+
+
+def active_trips_for(user, municipality_id=None):
+    """In-progress trips the user sees; `municipality_id` narrows a superadmin's view to one municipality."""
+    trip_qs = Trip.objects.filter(status=Trip.Status.IN_PROGRESS).select_related("driver", "vehicle")
+    if user.role != "SUPERADMIN":
+        trip_qs = trip_qs.filter(municipality=user.municipality)
+    elif municipality_id:
+        trip_qs = trip_qs.filter(municipality_id=municipality_id)
+    return trip_qs
+
+
+def last_positions_for(trip_ids):
+    return {position.trip_id: position for position in TripLastPosition.objects.filter(trip_id__in=trip_ids)}
+
+
+def point_payload(point):
+    return {
+        "lat": float(point.lat),
+        "lng": float(point.lng),
+        "accuracy": point.accuracy,
+        "speed": point.speed,
+        "recorded_at": point.recorded_at,
+    }
+
+
+def load_history(trip_ids, limit, tolerance=None, zoom=None):
+    """
+    Newest `limit` pings per trip, oldest first.
+
+    The per-trip cut is done by ROW_NUMBER() in the database and rows stream as
+    tuples, so memory stays bounded by `limit * len(trip_ids)`. When `tolerance`
+    or `zoom` is given each track is simplified before serialization.
+    """
+    rows = (
+        TripGpsPing.objects.filter(trip_id__in=trip_ids)
+        .annotate(
+            row_number=Window(
+                expression=RowNumber(),
+                partition_by=[F("trip_id")],
+                order_by=[F("recorded_at").desc(), F("id").desc()],
+            )
+        )
+        .filter(row_number__lte=limit)
+        .order_by("trip_id", "recorded_at", "id")
+        .values_list("trip_id", "lat", "lng", "accuracy", "speed", "recorded_at")
+    )
+    rows_by_trip = {}
+    for trip_id, *point in rows.iterator(chunk_size=2000):
+        rows_by_trip.setdefault(trip_id, []).append(point)
+    return {
+        trip_id: [
+            {"lat": float(lat), "lng": float(lng), "accuracy": accuracy, "speed": speed, "recorded_at": recorded_at}
+            for lat, lng, accuracy, speed, recorded_at in simplify_rows(points, tolerance=tolerance, zoom=zoom)
+        ]
+        for trip_id, points in rows_by_trip.items()
+    }
+
+
+def build_driver_payloads(trips, history_by_trip=None, now=None, positions=None):
+    """Map entries for the given in-progress trips, read from the last-position store."""
+    now = now or timezone.now()
+    history_by_trip = history_by_trip or {}
+    latest_by_trip = positions if positions is not None else last_positions_for([trip.id for trip in trips])
+    geofence_qs = DriverGeofence.objects.filter(driver_id__in=[trip.driver_id for trip in trips])
+    geofence_by_driver = {geofence.driver_id: geofence for geofence in geofence_qs}
+    drivers_payload = []
+    for trip in trips:
+        position = latest_by_trip.get(trip.id)
+        status_code = resolve_status(position, now=now, offline_after=OFFLINE_AFTER)
+        drivers_payload.append(
+            {
+                "trip_id": trip.id,
+                "driver_id": trip.driver_id,
+                "driver_name": trip.driver.name,
+                "vehicle_id": trip.vehicle_id,
+                "vehicle_plate": trip.vehicle.license_plate,
+                "status": status_code,
+                "status_label": STATUS_LABELS.get(status_code, status_code),
+                "geofence": geofence_payload(geofence_by_driver.get(trip.driver_id)),
+                "last_point": point_payload(position) if position else None,
+                "history": history_by_trip.get(trip.id, []),
+            }
+        )
+    return drivers_payload
+
+
+def map_snapshot(user):
+    """Current map state without history, used to bootstrap WebSocket clients."""
+    return build_driver_payloads(list(active_trips_for(user)))
+
+
+def encode_cursor(moment: datetime) -> str:
+    return str(int(moment.timestamp() * 1_000_000))
+
+
+def parse_cursor(value: str) -> datetime:
+    """Opaque `since` cursor back to a datetime. Raises ValueError."""
+    return datetime.fromtimestamp(int(value) / 1_000_000, tz=UTC)
+
+
+def load_history_since(trip_ids, since: datetime):
+    """Pings stored after `since`, oldest first per trip."""
+    rows = (
+        TripGpsPing.objects.filter(
+            trip_id__in=trip_ids,
+            recorded_at__gt=since - DELTA_LATE_POINT_WINDOW,
+            created_at__gt=since - CURSOR_OVERLAP,
+        )
+        .order_by("trip_id", "recorded_at", "id")
+        .values_list("trip_id", "lat", "lng", "accuracy", "speed", "recorded_at")
+    )
+    history = {}
+    for trip_id, lat, lng, accuracy, speed, recorded_at in rows.iterator(chunk_size=2000):
+        history.setdefault(trip_id, []).append(
+            {"lat": float(lat), "lng": float(lng), "accuracy": accuracy, "speed": speed, "recorded_at": recorded_at}
+        )
+    return history
+
+
+def build_map_delta(trips, since: datetime, include_history=True, now=None):
+    """
+    Map entries for the trips that changed after `since`.
+
+    A trip is included when its last position moved, when it has new pings,
+    when its online/offline status flipped in the meantime, or while it has no
+    position yet. `active_trip_ids` lets clients drop trips that ended.
+    """
+    now = now or timezone.now()
+    trip_ids = [trip.id for trip in trips]
+    positions = last_positions_for(trip_ids)
+    history_by_trip = load_history_since(trip_ids, since) if include_history else {}
+    changed_after = since - CURSOR_OVERLAP
+    offline_from, offline_to = since - OFFLINE_AFTER, now - OFFLINE_AFTER
+    changed = []
+    for trip in trips:
+        position = positions.get(trip.id)
+        if (
+            position is None
+            or trip.id in history_by_trip
+            or position.updated_at > changed_after
+            or offline_from < position.recorded_at <= offline_to
+        ):
+            changed.append(trip)
+    return {
+        "drivers": build_driver_payloads(changed, history_by_trip, now=now, positions=positions),
+        "active_trip_ids": trip_ids,
+    }
+
+
+def payload_etag(payload) -> str:
+    body = json.dumps(payload, cls=DjangoJSONEncoder, sort_keys=True)
+    return f'"{hashlib.md5(body.encode(), usedforsecurity=False).hexdigest()}"'
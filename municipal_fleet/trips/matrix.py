@@ -0,0 +1,215 @@
+"""
+Persistent distance/duration matrix between each municipality's destinations.
+
+The matrix is stored as float32 arrays in `DestinationMatrix` and kept in
+process memory, checked against a version number in the cache, so routing
+slices it with NumPy instead of routing every pair per request. Entries come
+from `trips.routing.travel_matrices` (road graph or straight lines).
+Saving, moving, deactivating or deleting a `Destination` updates only its row
+and column (see trips.signals); the matrix is rebuilt fully by
+`build_destination_matrix`, or when a save finds destinations added or removed
+without passing through the signals.
+"""
+import numpy as np
+from django.core.cache import cache
+from django.db import transaction
+
+from destinations.models import Destination
+from trips.models import DestinationMatrix
+from trips.routing import destination_points, municipality_of, travel_matrices
+
+_matrices = {}
+
+
+class MatrixData:
+    __slots__ = ("coordinates", "destination_ids", "distances", "durations", "positions")
+
+    def __init__(self, destination_ids, coordinates, distances, durations):
+        self.destination_ids = destination_ids
+        self.coordinates = coordinates
+        self.distances = distances
+        self.durations = durations
+        self.positions = {int(destination_id): idx for idx, destination_id in enumerate(destination_ids)}
+
+    @classmethod
+    def empty(cls):
+        return cls(
+            np.zeros(0, dtype=np.int64),
+            np.zeros((0, 2), dtype=np.float64),
+            np.zeros((0, 0), dtype=np.float32),
+            np.zeros((0, 0), dtype=np.float32),
+        )
+
+    @classmethod
+    def from_row(cls, row: DestinationMatrix):
+        destination_ids = np.frombuffer(bytes(row.destination_ids), dtype=np.int64)
+        size = len(destination_ids)
+        return cls(
+            destination_ids,
+            np.frombuffer(bytes(row.coordinates), dtype=np.float64).reshape(size, 2),
+            np.frombuffer(bytes(row.distances), dtype=np.float32).reshape(size, size),
+            np.frombuffer(bytes(row.durations), dtype=np.float32).reshape(size, size),
+        )
+
+    def fields(self) -> dict:
+        return {
+            "destination_ids": self.destination_ids.astype(np.int64).tobytes(),
+            "coordinates": self.coordinates.astype(np.float64).tobytes(),
+            "distances": self.distances.astype(np.float32).tobytes(),
+            "durations": self.durations.astype(np.float32).tobytes(),
+        }
+
+    def submatrices(self, destination_ids, points=None):
+        """`(distances, durations)` for the given ids in order, or None if one is missing or has moved."""
+        try:
+            index = [self.positions[destination_id] for destination_id in destination_ids]
+        except KeyError:
+            return None
+        # Catches moves that skipped the signals (e.g. queryset.update()).
+        if points is not None and not np.allclose(self.coordinates[index], points, rtol=0, atol=1e-6):
+            return None
+        grid = np.ix_(index, index)
+        return self.distances[grid].astype(np.float64), self.durations[grid].astype(np.float64)
+
+    def with_destination(self, destination_id: int, lat: float, lng: float, municipality_id=None):
+        """Copy with the destination's row and column added or replaced."""
+        position = self.positions.get(destination_id)
+        destination_ids = self.destination_ids
+        coordinates = self.coordinates
+        distances = self.distances
+        durations = self.durations
+        if position is None:
+            position = len(destination_ids)
+            destination_ids = np.append(destination_ids, np.int64(destination_id))
+            coordinates = np.vstack([coordinates, [[lat, lng]]])
+            distances = np.pad(distances, ((0, 1), (0, 1)))
+            durations = np.pad(durations, ((0, 1), (0, 1)))
+        else:
+            coordinates = coordinates.copy()
+            distances = distances.copy()
+            durations = durations.copy()
+        coordinates[position] = (lat, lng)
+        # Routes can differ by direction (one-way streets), so the row and the column are computed apart.
+        out_distances, out_durations = travel_matrices([(lat, lng)], coordinates, municipality_id)
+        in_distances, in_durations = travel_matrices(coordinates, [(lat, lng)], municipality_id)
+        distances[position, :] = out_distances[0]
+        distances[:, position] = in_distances[:, 0]
+        durations[position, :] = out_durations[0]
+        durations[:, position] = in_durations[:, 0]
+        return MatrixData(destination_ids, coordinates, distances, durations)
+
+    def without_destination(self, destination_id: int):
+        position = self.positions.get(destination_id)
+        if position is None:
+            return self
+        keep = np.arange(len(self.destination_ids)) != position
+        return MatrixData(
+            self.destination_ids[keep],
+            self.coordinates[keep],
+            self.distances[np.ix_(keep, keep)],
+            self.durations[np.ix_(keep, keep)],
+        )
+
+
+def matrix_version_key(municipality_id: int) -> str:
+    return f"trips:destination-matrix:version:{municipality_id}"
+
+
+def compute_matrix(destinations, municipality_id=None) -> MatrixData:
+    destinations = list(destinations)
+    if not destinations:
+        return MatrixData.empty()
+    coordinates = np.array(
+        [(float(dest.latitude), float(dest.longitude)) for dest in destinations], dtype=np.float64
+    ).reshape(len(destinations), 2)
+    distances, durations = travel_matrices(coordinates, coordinates, municipality_id)
+    return MatrixData(
+        np.array([dest.id for dest in destinations], dtype=np.int64),
+        coordinates,
+        distances.astype(np.float32),
+        durations.astype(np.float32),
+    )
+
+
+def _locked_row(municipality_id: int) -> DestinationMatrix:
+    """The municipality row locked for update, created empty first so concurrent writers queue on it."""
+    DestinationMatrix.objects.get_or_create(municipality_id=municipality_id, defaults=MatrixData.empty().fields())
+    return DestinationMatrix.objects.select_for_update().get(municipality_id=municipality_id)
+
+
+def _store(municipality_id: int, data: MatrixData, row: DestinationMatrix) -> MatrixData:
+    for field, value in data.fields().items():
+        setattr(row, field, value)
+    row.version += 1
+    row.save()
+    cache.set(matrix_version_key(municipality_id), row.version, None)
+    _matrices[municipality_id] = (row.version, data)
+    return data
+
+
+def _active_destinations(municipality_id: int):
+    return Destination.objects.filter(municipality_id=municipality_id, active=True).only("id", "latitude", "longitude")
+
+
+def build_destination_matrix(municipality_id: int) -> MatrixData:
+    with transaction.atomic():
+        row = _locked_row(municipality_id)
+        data = compute_matrix(_active_destinations(municipality_id).order_by("id"), municipality_id)
+        return _store(municipality_id, data, row)
+
+
+def update_destination_matrix(destination: Destination) -> None:
+    """Apply one destination's create/move/deactivation to its municipality matrix."""
+    municipality_id = destination.municipality_id
+    with transaction.atomic():
+        row = _locked_row(municipality_id)
+        data = MatrixData.from_row(row)
+        others = set(_active_destinations(municipality_id).exclude(id=destination.id).values_list("id", flat=True))
+        if others != set(data.positions) - {destination.id}:
+            # Destinations were added or removed behind the signals (bulk writes, no build yet):
+            # patching one row and column would keep the rest stale, so rebuild fully.
+            data = compute_matrix(_active_destinations(municipality_id).order_by("id"), municipality_id)
+        elif destination.active:
+            data = data.with_destination(
+                destination.id,
+                float(destination.latitude),
+                float(destination.longitude),
+                municipality_id,
+            )
+        else:
+            data = data.without_destination(destination.id)
+        _store(municipality_id, data, row)
+
+
+def remove_destination_from_matrix(municipality_id: int, destination_id: int) -> None:
+    with transaction.atomic():
+        row = DestinationMatrix.objects.select_for_update().filter(municipality_id=municipality_id).first()
+        if row is None:
+            return
+        _store(municipality_id, MatrixData.from_row(row).without_destination(destination_id), row)
+
+
+def matrix_for(municipality_id: int):
+    """The municipality matrix from process memory, reloaded when its version changed; None if not built."""
+    version = cache.get(matrix_version_key(municipality_id))
+    cached = _matrices.get(municipality_id)
+    if cached and version is not None and cached[0] == version:
+        return cached[1]
+    row = DestinationMatrix.objects.filter(municipality_id=municipality_id).first()
+    if row is None:
+        return None
+    data = MatrixData.from_row(row)
+    cache.set(matrix_version_key(municipality_id), row.version, None)
+    _matrices[municipality_id] = (row.version, data)
+    return data
+
+
+def cached_submatrices(destinations):
+    """`(distances, durations)` for saved destinations of one municipality, or None when not covered."""
+    municipality_id = municipality_of(destinations)
+    if municipality_id is None:
+        return None
+    data = matrix_for(municipality_id)
+    if data is None:
+        return None
+    return data.submatrices([dest.id for dest in destinations], destination_points(destinations))
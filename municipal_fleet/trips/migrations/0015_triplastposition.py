@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_last_positions(apps, schema_editor):
+    Trip = apps.get_model("trips", "Trip")
+    TripGpsPing = apps.get_model("trips", "TripGpsPing")
+    TripLastPosition = apps.get_model("trips", "TripLastPosition")
+    for trip in Trip.objects.filter(status="IN_PROGRESS").only("id", "municipality_id"):
+        ping = TripGpsPing.objects.filter(trip_id=trip.id).order_by("-recorded_at", "-id").first()
+        if not ping:
+            continue
+        TripLastPosition.objects.create(
+            trip_id=trip.id,
+            municipality_id=trip.municipality_id,
+            driver_id=ping.driver_id,
+            lat=ping.lat,
+            lng=ping.lng,
+            accuracy=ping.accuracy,
+            speed=ping.speed,
+            recorded_at=ping.recorded_at,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drivers', '0005_driver_photo'),
+        ('tenants', '0002_municipality_fuel_contract_settings'),
+        ('trips', '0014_serviceorder_trip_service_order'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TripLastPosition',
+            fields=[
+                ('trip', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='last_position', serialize=False, to='trips.trip')),
+                ('lat', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('lng', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('accuracy', models.FloatField(blank=True, null=True)),
+                ('speed', models.FloatField(blank=True, null=True)),
+                ('recorded_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('driver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trip_last_positions', to='drivers.driver')),
+                ('municipality', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trip_last_positions', to='tenants.municipality')),
+            ],
+            options={
+                'ordering': ['-recorded_at'],
+            },
+        ),
+        migrations.RunPython(backfill_last_positions, migrations.RunPython.noop),
+    ]
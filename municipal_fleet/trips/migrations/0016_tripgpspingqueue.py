@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drivers', '0005_driver_photo'),
+        ('trips', '0015_triplastposition'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TripGpsPingQueue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lat', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('lng', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('accuracy', models.FloatField(blank=True, null=True)),
+                ('speed', models.FloatField(blank=True, null=True)),
+                ('recorded_at', models.DateTimeField()),
+                ('enqueued_at', models.DateTimeField(auto_now_add=True)),
+                ('driver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='queued_gps_pings', to='drivers.driver')),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='queued_gps_pings', to='trips.trip')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0016_tripgpspingqueue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='triplastposition',
+            name='geofence_alert_active',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='triplastposition',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0017_triplastposition_geofence_alert'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='gps_distance_computed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='gps_distance_km',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='odometer_mismatch',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0018_trip_gps_distance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TripGpsStop',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lat', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('lng', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('started_at', models.DateTimeField()),
+                ('ended_at', models.DateTimeField(blank=True, null=True)),
+                ('duration_seconds', models.PositiveIntegerField(default=0)),
+                ('point_count', models.PositiveIntegerField(default=0)),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='gps_stops', to='trips.trip')),
+            ],
+            options={
+                'ordering': ['trip', 'started_at'],
+                'indexes': [models.Index(fields=['trip', 'started_at'], name='trips_tripg_trip_id_e18cd4_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('destinations', '0001_initial'),
+        ('tenants', '0002_municipality_fuel_contract_settings'),
+        ('trips', '0019_tripgpsstop'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StopSegmentSpeed',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('avg_speed_kmh', models.FloatField()),
+                ('samples', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('from_destination', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outgoing_segment_speeds', to='destinations.destination')),
+                ('municipality', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stop_segment_speeds', to='tenants.municipality')),
+                ('to_destination', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='incoming_segment_speeds', to='destinations.destination')),
+            ],
+            options={
+                'unique_together': {('from_destination', 'to_destination')},
+            },
+        ),
+    ]
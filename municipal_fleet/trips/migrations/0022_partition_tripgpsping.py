@@ -0,0 +1,96 @@
+from datetime import UTC, datetime
+
+from django.db import migrations
+from django.utils import timezone
+
+# The table layout and helpers are frozen here so later changes to trips.partitions cannot alter this migration.
+PING_TABLE = "trips_tripgpsping"
+DEFAULT_PARTITION = f"{PING_TABLE}_default"
+COLUMNS = "id, lat, lng, accuracy, speed, recorded_at, created_at, driver_id, trip_id"
+MONTHS_AHEAD = 3
+
+
+def month_start(value):
+    value = value.astimezone(UTC)
+    return datetime(value.year, value.month, 1, tzinfo=UTC)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=UTC)
+
+
+def create_partition_sql(month):
+    return (
+        f"CREATE TABLE IF NOT EXISTS {PING_TABLE}_p{month:%Y%m} PARTITION OF {PING_TABLE} "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    )
+
+
+def partition_ping_table(apps, schema_editor):
+    """Rebuild the ping table as a monthly range-partitioned table (PostgreSQL only)."""
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    legacy = f"{PING_TABLE}_legacy"
+    sequence = f"{PING_TABLE}_part_id_seq"
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = %s",
+            [PING_TABLE],
+        )
+        if cursor.fetchone():
+            return
+        cursor.execute(f"SELECT min(recorded_at), coalesce(max(id), 0) FROM {PING_TABLE}")
+        oldest, max_id = cursor.fetchone()
+        cursor.execute(f"ALTER TABLE {PING_TABLE} RENAME TO {legacy}")
+        cursor.execute(f"CREATE SEQUENCE {sequence}")
+        cursor.execute(
+            f"""
+            CREATE TABLE {PING_TABLE} (
+                id bigint NOT NULL DEFAULT nextval('{sequence}'),
+                lat numeric(9, 6) NOT NULL,
+                lng numeric(9, 6) NOT NULL,
+                accuracy double precision NULL,
+                speed double precision NULL,
+                recorded_at timestamp with time zone NOT NULL,
+                created_at timestamp with time zone NOT NULL,
+                driver_id bigint NOT NULL,
+                trip_id bigint NOT NULL,
+                CONSTRAINT {PING_TABLE}_part_pkey PRIMARY KEY (id, recorded_at)
+            ) PARTITION BY RANGE (recorded_at)
+            """
+        )
+        cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {PING_TABLE}.id")
+        cursor.execute(f"SELECT setval('{sequence}', %s, %s)", [max(max_id, 1), max_id > 0])
+        now = timezone.now()
+        month = month_start(oldest or now)
+        last = add_months(month_start(now), MONTHS_AHEAD)
+        while month <= last:
+            cursor.execute(create_partition_sql(month))
+            month = add_months(month, 1)
+        cursor.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {PING_TABLE} DEFAULT")
+        cursor.execute(f"INSERT INTO {PING_TABLE} ({COLUMNS}) SELECT {COLUMNS} FROM {legacy}")
+        cursor.execute(f"DROP TABLE {legacy}")
+        cursor.execute(f"CREATE INDEX trips_tripg_trip_id_86e071_idx ON {PING_TABLE} (trip_id, recorded_at)")
+        cursor.execute(f"CREATE INDEX trips_tripg_driver__b455e8_idx ON {PING_TABLE} (driver_id, recorded_at)")
+        cursor.execute(
+            f"ALTER TABLE {PING_TABLE} ADD CONSTRAINT {PING_TABLE}_trip_id_fk_trips_trip_id "
+            "FOREIGN KEY (trip_id) REFERENCES trips_trip (id) DEFERRABLE INITIALLY DEFERRED"
+        )
+        cursor.execute(
+            f"ALTER TABLE {PING_TABLE} ADD CONSTRAINT {PING_TABLE}_driver_id_fk_drivers_driver_id "
+            "FOREIGN KEY (driver_id) REFERENCES drivers_driver (id) DEFERRABLE INITIALLY DEFERRED"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("drivers", "0006_geofence_zone"),
+        ("trips", "0021_tripgpstrack"),
+    ]
+
+    operations = [
+        # The partitioned layout is kept on rollback; the model state does not change.
+        migrations.RunPython(partition_ping_table, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0002_municipality_fuel_contract_settings'),
+        ('trips', '0022_partition_tripgpsping'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GpsDensityCell',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('hour', models.PositiveSmallIntegerField()),
+                ('lat_index', models.IntegerField()),
+                ('lng_index', models.IntegerField()),
+                ('ping_count', models.PositiveIntegerField(default=0)),
+                ('municipality', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='gps_density_cells', to='tenants.municipality')),
+            ],
+            options={
+                'unique_together': {('municipality', 'day', 'hour', 'lat_index', 'lng_index')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tenants', '0002_municipality_fuel_contract_settings'),
+        ('trips', '0023_gpsdensitycell'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DestinationMatrix',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('destination_ids', models.BinaryField()),
+                ('coordinates', models.BinaryField()),
+                ('distances', models.BinaryField()),
+                ('durations', models.BinaryField()),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('municipality', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='destination_matrix', to='tenants.municipality')),
+            ],
+        ),
+    ]
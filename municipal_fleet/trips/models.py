@@ -76,6 +76,10 @@ class Trip(models.Model):
     stops_description = models.TextField(blank=True)
     status = models.CharField(max_length=20, choices=Status.choices, default=Status.PLANNED)
     notes = models.TextField(blank=True)
+    # Distance driven according to the GPS track (see trips.distance), cross-checked against the odometer.
+    gps_distance_km = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    gps_distance_computed_at = models.DateTimeField(null=True, blank=True)
+    odometer_mismatch = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -87,6 +91,7 @@ class Trip(models.Model):
 
 
 class TripGpsPing(models.Model):
+    # On PostgreSQL the table is range-partitioned by month on `recorded_at` (see trips.partitions).
     trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name="gps_pings")
     driver = models.ForeignKey("drivers.Driver", on_delete=models.CASCADE, related_name="gps_pings")
     lat = models.DecimalField(max_digits=9, decimal_places=6)
@@ -107,6 +112,114 @@ class TripGpsPing(models.Model):
         return f"GPS {self.driver_id} @ {self.recorded_at:%Y-%m-%d %H:%M:%S}"
 
 
+class TripGpsPingQueue(models.Model):
+    """Staging rows for write-behind ingestion, drained in bulk by `flush_gps_queue`."""
+
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name="queued_gps_pings")
+    driver = models.ForeignKey("drivers.Driver", on_delete=models.CASCADE, related_name="queued_gps_pings")
+    lat = models.DecimalField(max_digits=9, decimal_places=6)
+    lng = models.DecimalField(max_digits=9, decimal_places=6)
+    accuracy = models.FloatField(null=True, blank=True)
+    speed = models.FloatField(null=True, blank=True)
+    recorded_at = models.DateTimeField()
+    enqueued_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return f"GPS pendente {self.driver_id} @ {self.recorded_at:%Y-%m-%d %H:%M:%S}"
+
+
+class TripLastPosition(models.Model):
+    """Latest accepted GPS point per trip, kept in sync by ingestion for the operations map."""
+
+    trip = models.OneToOneField(Trip, on_delete=models.CASCADE, primary_key=True, related_name="last_position")
+    municipality = models.ForeignKey(
+        "tenants.Municipality", on_delete=models.CASCADE, related_name="trip_last_positions"
+    )
+    driver = models.ForeignKey("drivers.Driver", on_delete=models.CASCADE, related_name="trip_last_positions")
+    lat = models.DecimalField(max_digits=9, decimal_places=6)
+    lng = models.DecimalField(max_digits=9, decimal_places=6)
+    accuracy = models.FloatField(null=True, blank=True)
+    speed = models.FloatField(null=True, blank=True)
+    recorded_at = models.DateTimeField()
+    geofence_alert_active = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        ordering = ["-recorded_at"]
+
+    def __str__(self):
+        return f"Última posição {self.trip_id} @ {self.recorded_at:%Y-%m-%d %H:%M:%S}"
+
+
+class TripPositionChange(models.Model):
+    """
+    Log of last-position updates read by the batched map broadcaster (see trips.broadcaster).
+
+    Written in the same transaction as the `TripLastPosition` update, so its id
+    works as a cursor that does not skip rows committed late.
+    """
+
+    trip_id = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"Posição alterada {self.trip_id} #{self.id}"
+
+
+class TripGpsStop(models.Model):
+    """Place where a trip stood still, detected from its GPS pings (see trips.stops)."""
+
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name="gps_stops")
+    lat = models.DecimalField(max_digits=9, decimal_places=6)
+    lng = models.DecimalField(max_digits=9, decimal_places=6)
+    started_at = models.DateTimeField()
+    # Null while the vehicle is still stopped.
+    ended_at = models.DateTimeField(null=True, blank=True)
+    duration_seconds = models.PositiveIntegerField(default=0)
+    point_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["trip", "started_at"]
+        indexes = [models.Index(fields=["trip", "started_at"])]
+
+    def __str__(self):
+        return f"Parada {self.trip_id} @ {self.started_at:%Y-%m-%d %H:%M:%S}"
+
+
+class TripGpsTrack(models.Model):
+    """Compressed copy of a completed trip's pings, kept after retention drops the raw rows."""
+
+    trip = models.OneToOneField(Trip, on_delete=models.CASCADE, related_name="gps_track")
+    point_count = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    ended_at = models.DateTimeField(null=True, blank=True)
+    data = models.BinaryField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Trilha arquivada {self.trip_id} ({self.point_count} pontos)"
+
+
+class GpsDensityCell(models.Model):
+    """Ping count per grid cell, local day and hour of day, maintained by ingestion (see trips.heatmap)."""
+
+    municipality = models.ForeignKey("tenants.Municipality", on_delete=models.CASCADE, related_name="gps_density_cells")
+    day = models.DateField()
+    hour = models.PositiveSmallIntegerField()
+    lat_index = models.IntegerField()
+    lng_index = models.IntegerField()
+    ping_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("municipality", "day", "hour", "lat_index", "lng_index")
+
+    def __str__(self):
+        return f"Célula {self.lat_index}/{self.lng_index} {self.day} {self.hour}h: {self.ping_count}"
+
+
 class TripIncident(models.Model):
     municipality = models.ForeignKey("tenants.Municipality", on_delete=models.CASCADE, related_name="trip_incidents")
     trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name="incidents")
@@ -321,6 +434,46 @@ class TripExecutionStop(models.Model):
         return f"{self.trip_execution_id} #{self.order}"
 
 
+class StopSegmentSpeed(models.Model):
+    """Average speed observed between two consecutive execution stops, learned from GPS stamps."""
+
+    municipality = models.ForeignKey("tenants.Municipality", on_delete=models.CASCADE, related_name="stop_segment_speeds")
+    from_destination = models.ForeignKey(
+        "destinations.Destination", on_delete=models.CASCADE, related_name="outgoing_segment_speeds"
+    )
+    to_destination = models.ForeignKey(
+        "destinations.Destination", on_delete=models.CASCADE, related_name="incoming_segment_speeds"
+    )
+    avg_speed_kmh = models.FloatField()
+    samples = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("from_destination", "to_destination")
+
+    def __str__(self):
+        return f"{self.from_destination_id} -> {self.to_destination_id}: {self.avg_speed_kmh:.1f} km/h"
+
+
+class DestinationMatrix(models.Model):
+    """Distance/duration matrix between a municipality's active destinations (see trips.matrix)."""
+
+    municipality = models.OneToOneField(
+        "tenants.Municipality", on_delete=models.CASCADE, related_name="destination_matrix"
+    )
+    # int64 destination ids and float64 (lat, lng) pairs, one per matrix row.
+    destination_ids = models.BinaryField()
+    coordinates = models.BinaryField()
+    # float32 n x n arrays: kilometers and minutes.
+    distances = models.BinaryField()
+    durations = models.BinaryField()
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Matriz de destinos {self.municipality_id} (v{self.version})"
+
+
 class TripManifest(models.Model):
     trip_execution = models.OneToOneField(TripExecution, on_delete=models.CASCADE, related_name="manifest")
     total_passengers = models.PositiveIntegerField(default=0)
@@ -0,0 +1,260 @@
+"""
+Monthly partitions and retention for `TripGpsPing`.
+
+On PostgreSQL the ping table is range-partitioned by `recorded_at`, one
+partition per UTC month plus a default partition that catches pings outside
+them. Creating a month whose pings already landed in the default partition
+moves those rows into the new partition.
+
+Retention compacts the pings of finished (completed or cancelled) trips older
+than the cutoff into one zlib-compressed `TripGpsTrack` blob per trip. Raw pings
+of trips never finished expire at the cutoff without an archive. Old partitions
+are then detached and dropped instead of deleting their rows, and old rows in
+the default partition are deleted. Other databases keep a plain table, where
+the same rows are deleted.
+"""
+import json
+import zlib
+from datetime import UTC, datetime
+from decimal import Decimal
+from itertools import islice
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from trips.models import Trip, TripGpsPing, TripGpsTrack
+
+PING_TABLE = TripGpsPing._meta.db_table
+DEFAULT_PARTITION = f"{PING_TABLE}_default"
+PING_COLUMNS = ", ".join(field.column for field in TripGpsPing._meta.concrete_fields)
+ARCHIVE_CHUNK_SIZE = 5000
+# Trips whose track is archived by retention; pings of any other trip just expire.
+FINISHED_STATUSES = (Trip.Status.COMPLETED, Trip.Status.CANCELLED)
+# Rows of `p` that retention must not remove: finished trips whose archive is missing.
+UNARCHIVED_FINISHED_SQL = (
+    f"p.trip_id IN (SELECT t.id FROM {Trip._meta.db_table} t WHERE t.status IN (%s, %s) "
+    f"AND NOT EXISTS (SELECT 1 FROM {TripGpsTrack._meta.db_table} a WHERE a.trip_id = t.id))"
+)
+
+
+def month_start(value: datetime) -> datetime:
+    value = value.astimezone(UTC)
+    return datetime(value.year, value.month, 1, tzinfo=UTC)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=UTC)
+
+
+def partition_name(month: datetime) -> str:
+    return f"{PING_TABLE}_p{month:%Y%m}"
+
+
+def create_partition_sql(month: datetime) -> str:
+    return (
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF {PING_TABLE} "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    )
+
+
+def is_partitioned() -> bool:
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = %s",
+            [PING_TABLE],
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions():
+    """Monthly partitions as `(month, table_name)`, oldest first (the default partition is skipped)."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits i "
+            "JOIN pg_class parent ON parent.oid = i.inhparent JOIN pg_class child ON child.oid = i.inhrelid "
+            "WHERE parent.relname = %s",
+            [PING_TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    prefix = f"{PING_TABLE}_p"
+    partitions = []
+    for name in names:
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and len(suffix) == 6 and suffix.isdigit():
+            partitions.append((datetime(int(suffix[:4]), int(suffix[4:]), 1, tzinfo=UTC), name))
+    return sorted(partitions)
+
+
+def ensure_partitions(months_ahead: int = 3, now=None):
+    """Create the partitions from the current month up to `months_ahead` months later. Returns new names."""
+    if not is_partitioned():
+        return []
+    current = month_start(now or timezone.now())
+    existing = {name for _, name in list_partitions()}
+    created = []
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        if partition_name(month) in existing:
+            continue
+        _create_partition(month)
+        created.append(partition_name(month))
+    return created
+
+
+def _create_partition(month: datetime) -> None:
+    """
+    Create one monthly partition, taking over its rows from the default partition.
+
+    PostgreSQL refuses a new partition while the default one holds rows of its
+    range, so those are moved with the default partition detached.
+    """
+    bounds = [month, add_months(month, 1)]
+    in_range = "recorded_at >= %s AND recorded_at < %s"
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_range} LIMIT 1", bounds)
+        if cursor.fetchone() is None:
+            cursor.execute(create_partition_sql(month))
+            return
+        cursor.execute(f"ALTER TABLE {PING_TABLE} DETACH PARTITION {DEFAULT_PARTITION}")
+        cursor.execute(create_partition_sql(month))
+        cursor.execute(
+            f"INSERT INTO {partition_name(month)} ({PING_COLUMNS}) "
+            f"SELECT {PING_COLUMNS} FROM {DEFAULT_PARTITION} WHERE {in_range}",
+            bounds,
+        )
+        cursor.execute(f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_range}", bounds)
+        cursor.execute(f"ALTER TABLE {PING_TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT")
+
+
+def pack_track(rows) -> tuple:
+    """Compress `(lat, lng, accuracy, speed, recorded_at)` rows; returns `(blob, count, first_at, last_at)`."""
+    compressor = zlib.compressobj(9)
+    parts = []
+    count = 0
+    first_at = last_at = None
+    for lat, lng, accuracy, speed, recorded_at in rows:
+        line = json.dumps([str(lat), str(lng), accuracy, speed, recorded_at.timestamp()], separators=(",", ":"))
+        parts.append(compressor.compress(line.encode() + b"\n"))
+        first_at = first_at or recorded_at
+        last_at = recorded_at
+        count += 1
+    parts.append(compressor.flush())
+    return b"".join(parts), count, first_at, last_at
+
+
+def iter_track(blob, read_size: int = 64 * 1024):
+    """Decompress a packed track incrementally, yielding one row at a time."""
+    blob = bytes(blob)
+    decompressor = zlib.decompressobj()
+    pending = b""
+    for offset in range(0, len(blob), read_size):
+        pending += decompressor.decompress(blob[offset:offset + read_size])
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield _unpack_row(line)
+    pending += decompressor.flush()
+    for line in pending.splitlines():
+        yield _unpack_row(line)
+
+
+def _unpack_row(line):
+    lat, lng, accuracy, speed, timestamp = json.loads(line)
+    return Decimal(lat), Decimal(lng), accuracy, speed, datetime.fromtimestamp(timestamp, tz=UTC)
+
+
+def unpack_track(blob) -> list:
+    return list(iter_track(blob))
+
+
+def archived_track_rows(trip_id: int):
+    """Rows of an archived trip in the same shape as the ping queries, or None when not archived."""
+    blob = TripGpsTrack.objects.filter(trip_id=trip_id).values_list("data", flat=True).first()
+    if blob is None:
+        return None
+    return unpack_track(blob)
+
+
+def archive_trip_track(trip_id: int, chunk_size: int = ARCHIVE_CHUNK_SIZE) -> TripGpsTrack:
+    rows = (
+        TripGpsPing.objects.filter(trip_id=trip_id)
+        .order_by("recorded_at", "id")
+        .values_list("lat", "lng", "accuracy", "speed", "recorded_at")
+        .iterator(chunk_size=chunk_size)
+    )
+    blob, count, first_at, last_at = pack_track(rows)
+    track, _ = TripGpsTrack.objects.update_or_create(
+        trip_id=trip_id,
+        defaults={"data": blob, "point_count": count, "started_at": first_at, "ended_at": last_at},
+    )
+    return track
+
+
+def _drop_partition(name: str) -> bool:
+    """Drop a partition unless a finished trip in it is still missing its archive."""
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT 1 FROM {name} p WHERE {UNARCHIVED_FINISHED_SQL} LIMIT 1", FINISHED_STATUSES)
+        if cursor.fetchone():
+            return False
+        cursor.execute(f"ALTER TABLE {PING_TABLE} DETACH PARTITION {name}")
+        cursor.execute(f"DROP TABLE {name}")
+    return True
+
+
+def _expire_default_rows(cutoff: datetime) -> int:
+    """Delete the default partition's rows older than the cutoff, as dropping a partition would."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {DEFAULT_PARTITION} p WHERE p.recorded_at < %s AND NOT {UNARCHIVED_FINISHED_SQL}",
+            [cutoff, *FINISHED_STATUSES],
+        )
+        return cursor.rowcount
+
+
+def apply_retention(months: int, now=None, chunk_size: int = ARCHIVE_CHUNK_SIZE) -> dict:
+    """
+    Archive finished trips with pings older than `months` full months and drop what is no longer needed.
+
+    Raw pings from the cutoff onwards are deleted per trip right after its track
+    is archived; older ones go away with their partition. Pings of trips that
+    were never finished expire at the cutoff. Returns counters.
+    """
+    cutoff = add_months(month_start(now or timezone.now()), -months)
+    partitioned = is_partitioned()
+    trip_ids = (
+        Trip.objects.filter(
+            status__in=FINISHED_STATUSES,
+            gps_track__isnull=True,
+            id__in=TripGpsPing.objects.filter(recorded_at__lt=cutoff).values("trip_id"),
+        )
+        .order_by("id")
+        .values_list("id", flat=True)
+        .iterator(chunk_size=chunk_size)
+    )
+    archived = 0
+    deleted = 0
+    while True:
+        chunk = list(islice(trip_ids, chunk_size))
+        if not chunk:
+            break
+        for trip_id in chunk:
+            with transaction.atomic():
+                archive_trip_track(trip_id, chunk_size=chunk_size)
+                raw = TripGpsPing.objects.filter(trip_id=trip_id)
+                if partitioned:
+                    raw = raw.filter(recorded_at__gte=cutoff)
+                deleted += raw.delete()[0]
+            archived += 1
+    dropped = []
+    if partitioned:
+        for month, name in list_partitions():
+            if add_months(month, 1) <= cutoff and _drop_partition(name):
+                dropped.append(name)
+        expired = _expire_default_rows(cutoff)
+    else:
+        expired = (
+            TripGpsPing.objects.filter(recorded_at__lt=cutoff).exclude(trip__status__in=FINISHED_STATUSES).delete()[0]
+        )
+    return {"archived": archived, "deleted": deleted, "expired": expired, "dropped": dropped, "cutoff": cutoff}
@@ -0,0 +1,178 @@
+"""
+Streaming replay of a trip's GPS track as NDJSON or server-sent events.
+
+Pings are read with a server-side cursor (or decompressed incrementally from
+an archived track) and written out as they are read, so the first points reach
+the client right away and server memory does not grow with the track length.
+With a `speed` factor the stream is paced by the recorded time between points.
+
+Under ASGI the `a`-prefixed variants build an async iterator instead: points
+are fetched chunk by chunk in a worker thread and pauses are `asyncio.sleep`,
+so a slow replay holds no thread while it waits. The sync generators remain
+for WSGI.
+"""
+import asyncio
+import json
+import time
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.db.models import Q
+from rest_framework import renderers
+
+from trips.models import TripGpsPing, TripGpsTrack
+from trips.partitions import iter_track
+
+REPLAY_CHUNK_SIZE = 2000
+MAX_REPLAY_SPEED = 3600.0
+# Long stops are shortened so a paced replay never stalls for minutes.
+MAX_REPLAY_PAUSE_SECONDS = 5.0
+
+
+class NDJSONRenderer(renderers.BaseRenderer):
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Only error responses go through the renderer; the replay itself is streamed.
+        return json.dumps(data, default=str).encode()
+
+
+class EventStreamRenderer(NDJSONRenderer):
+    media_type = "text/event-stream"
+    format = "sse"
+
+
+def parse_speed(value):
+    """Time compression factor from the query string; None means no pacing. Raises ValueError."""
+    if value in (None, ""):
+        return None
+    speed = float(value)
+    if not 0 < speed <= MAX_REPLAY_SPEED:
+        raise ValueError(value)
+    return speed
+
+
+def replay_rows(trip_id: int, chunk_size: int = REPLAY_CHUNK_SIZE):
+    blob = TripGpsTrack.objects.filter(trip_id=trip_id).values_list("data", flat=True).first()
+    if blob is not None:
+        return iter_track(blob)
+    return (
+        TripGpsPing.objects.filter(trip_id=trip_id)
+        .order_by("recorded_at", "id")
+        .values_list("lat", "lng", "accuracy", "speed", "recorded_at")
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def _archived_blob(trip_id: int):
+    return TripGpsTrack.objects.filter(trip_id=trip_id).values_list("data", flat=True).first()
+
+
+def _ping_chunk(trip_id: int, after, chunk_size: int) -> list:
+    """The next pings after the `(recorded_at, id)` key; each chunk is its own short query."""
+    qs = TripGpsPing.objects.filter(trip_id=trip_id)
+    if after is not None:
+        recorded_at, ping_id = after
+        qs = qs.filter(Q(recorded_at__gt=recorded_at) | Q(recorded_at=recorded_at, id__gt=ping_id))
+    return list(
+        qs.order_by("recorded_at", "id").values_list("lat", "lng", "accuracy", "speed", "recorded_at", "id")[:chunk_size]
+    )
+
+
+async def areplay_rows(trip_id: int, chunk_size: int = REPLAY_CHUNK_SIZE):
+    """Async counterpart of `replay_rows`; each chunk is read in a worker thread."""
+    blob = await sync_to_async(_archived_blob)(trip_id)
+    if blob is not None:
+        rows = iter_track(blob)
+        while chunk := await sync_to_async(list)(islice(rows, chunk_size)):
+            for row in chunk:
+                yield row
+        return
+    after = None
+    while True:
+        chunk = await sync_to_async(_ping_chunk)(trip_id, after, chunk_size)
+        for *row, _ in chunk:
+            yield tuple(row)
+        if len(chunk) < chunk_size:
+            return
+        after = chunk[-1][4:]
+
+
+def _pause(previous_at, recorded_at, speed):
+    if not speed or previous_at is None:
+        return 0
+    return min((recorded_at - previous_at).total_seconds() / speed, MAX_REPLAY_PAUSE_SECONDS)
+
+
+def _event(row, started_at):
+    lat, lng, accuracy, point_speed, recorded_at = row
+    return {
+        "lat": float(lat),
+        "lng": float(lng),
+        "accuracy": accuracy,
+        "speed": point_speed,
+        "recorded_at": recorded_at.isoformat(),
+        "offset_seconds": (recorded_at - started_at).total_seconds(),
+    }
+
+
+def replay_events(rows, speed=None, sleep=None):
+    """Point payloads with their offset from the first point, paced by `speed` when given."""
+    sleep = sleep or time.sleep
+    started_at = previous_at = None
+    for row in rows:
+        recorded_at = row[4]
+        started_at = started_at or recorded_at
+        pause = _pause(previous_at, recorded_at, speed)
+        if pause > 0:
+            sleep(pause)
+        previous_at = recorded_at
+        yield _event(row, started_at)
+
+
+async def areplay_events(rows, speed=None, sleep=None):
+    """Async counterpart of `replay_events` over `areplay_rows`."""
+    sleep = sleep or asyncio.sleep
+    started_at = previous_at = None
+    async for row in rows:
+        recorded_at = row[4]
+        started_at = started_at or recorded_at
+        pause = _pause(previous_at, recorded_at, speed)
+        if pause > 0:
+            await sleep(pause)
+        previous_at = recorded_at
+        yield _event(row, started_at)
+
+
+def _sse_point(index, event):
+    return f"id: {index}\nevent: point\ndata: {json.dumps(event)}\n\n"
+
+
+def _sse_end(trip_id):
+    # Clients reconnecting after the end would restart the replay, so the stream announces its end.
+    return f"event: end\ndata: {json.dumps({'trip_id': trip_id})}\n\n"
+
+
+def format_ndjson(events):
+    for event in events:
+        yield json.dumps(event) + "\n"
+
+
+def format_sse(events, trip_id: int):
+    for index, event in enumerate(events):
+        yield _sse_point(index, event)
+    yield _sse_end(trip_id)
+
+
+async def aformat_ndjson(events):
+    async for event in events:
+        yield json.dumps(event) + "\n"
+
+
+async def aformat_sse(events, trip_id: int):
+    index = 0
+    async for event in events:
+        yield _sse_point(index, event)
+        index += 1
+    yield _sse_end(trip_id)
@@ -0,0 +1,457 @@
+"""
+Offline road-network routing from a local OpenStreetMap extract.
+
+`build_road_graph` reads the drivable ways of an .osm/.osm.pbf extract into a
+directed graph weighted by travel time (speed per highway type, slower on
+unpaved surfaces, one-way streets respected) and contracts it into a
+contraction hierarchy. The result is saved per municipality as a compressed
+NumPy file (`ROAD_GRAPH_DIR/<id>.npz`) and loaded once per process. Queries
+only run upward searches in the hierarchy, so they settle a few hundred nodes
+instead of the whole network; many-to-many tables reuse one search per point.
+"""
+import bz2
+import gzip
+import os
+from heapq import heapify, heappop, heappush
+from itertools import pairwise
+from math import inf
+from xml.etree import ElementTree
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from trips.routing import DEFAULT_SPEED_KMH, distances_from, haversine_km
+
+ROAD_SPEEDS_KMH = {
+    "motorway": 90,
+    "motorway_link": 50,
+    "trunk": 80,
+    "trunk_link": 40,
+    "primary": 60,
+    "primary_link": 40,
+    "secondary": 50,
+    "secondary_link": 35,
+    "tertiary": 40,
+    "tertiary_link": 30,
+    "unclassified": 30,
+    "road": 30,
+    "residential": 25,
+    "track": 20,
+    "service": 15,
+    "living_street": 10,
+}
+UNPAVED_SURFACES = {
+    "unpaved", "dirt", "earth", "ground", "gravel", "fine_gravel", "compacted", "sand", "mud", "grass",
+}
+UNPAVED_SPEED_FACTOR = 0.6
+# Points farther than this from every road node are routed in a straight line.
+MAX_SNAP_KM = 1.0
+# Witness searches stop early; a missed witness only adds a redundant shortcut.
+WITNESS_SETTLE_LIMIT = 60
+
+_graphs = {}
+
+
+def way_speed(tags: dict):
+    """Travel speed (km/h) for a way's tags, or None when cars cannot use it."""
+    speed = ROAD_SPEEDS_KMH.get(tags.get("highway"))
+    if speed is None or tags.get("area") == "yes":
+        return None
+    if tags.get("access") in ("no", "private") or tags.get("motor_vehicle") in ("no", "private"):
+        return None
+    if tags.get("surface") in UNPAVED_SURFACES or tags.get("highway") == "track" and "surface" not in tags:
+        speed *= UNPAVED_SPEED_FACTOR
+    maxspeed = tags.get("maxspeed", "")
+    if maxspeed.isdigit():
+        speed = min(speed, int(maxspeed))
+    return float(speed)
+
+
+def way_direction(tags: dict) -> int:
+    """1 for one-way along the node order, -1 against it, 0 for both directions."""
+    oneway = tags.get("oneway")
+    if oneway in ("yes", "true", "1"):
+        return 1
+    if oneway == "-1":
+        return -1
+    if oneway != "no" and (tags.get("highway") == "motorway" or tags.get("junction") == "roundabout"):
+        return 1
+    return 0
+
+
+def routable_way(refs, tags):
+    speed = way_speed(tags)
+    if speed is None or len(refs) < 2:
+        return None
+    return refs, speed, way_direction(tags)
+
+
+def read_osm_xml(source):
+    """`(nodes, ways)` from OSM XML: nodes as `{id: (lat, lng)}`, ways as `(refs, speed_kmh, direction)`."""
+    nodes, ways = {}, []
+    for _, element in ElementTree.iterparse(source, events=("end",)):
+        if element.tag == "node":
+            nodes[int(element.get("id"))] = (float(element.get("lat")), float(element.get("lon")))
+        elif element.tag == "way":
+            tags = {tag.get("k"): tag.get("v") for tag in element.iter("tag")}
+            way = routable_way([int(nd.get("ref")) for nd in element.iter("nd")], tags)
+            if way:
+                ways.append(way)
+        else:
+            continue
+        element.clear()
+    return nodes, ways
+
+
+def read_osm_pbf(path: str):
+    try:
+        import osmium
+    except ImportError as exc:
+        raise ImproperlyConfigured("Leitura de arquivos .pbf requer o pacote 'osmium' (pyosmium).") from exc
+
+    class WayHandler(osmium.SimpleHandler):
+        def __init__(self):
+            super().__init__()
+            self.nodes, self.ways = {}, []
+
+        def way(self, way):
+            refs = [node.ref for node in way.nodes]
+            routable = routable_way(refs, {tag.k: tag.v for tag in way.tags})
+            if routable:
+                self.ways.append(routable)
+                for node in way.nodes:
+                    self.nodes[node.ref] = (node.location.lat, node.location.lon)
+
+    handler = WayHandler()
+    handler.apply_file(path, locations=True)
+    return handler.nodes, handler.ways
+
+
+def read_osm(path: str):
+    if path.endswith(".pbf"):
+        return read_osm_pbf(path)
+    opener = bz2.open if path.endswith(".bz2") else gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as source:
+        return read_osm_xml(source)
+
+
+def build_edges(nodes: dict, ways):
+    """Compact node arrays and the fastest directed edge per node pair: `{(u, v): (seconds, km)}`."""
+    index, lats, lngs, edges = {}, [], [], {}
+
+    def node_index(ref):
+        if ref not in index:
+            index[ref] = len(lats)
+            lats.append(nodes[ref][0])
+            lngs.append(nodes[ref][1])
+        return index[ref]
+
+    for refs, speed, direction in ways:
+        for first, second in pairwise(refs):
+            if first == second or first not in nodes or second not in nodes:
+                continue
+            u, v = node_index(first), node_index(second)
+            distance = haversine_km(*nodes[first], *nodes[second])
+            duration = distance / speed * 3600
+            for pair in ((u, v),) * (direction >= 0) + ((v, u),) * (direction <= 0):
+                if duration < edges.get(pair, (inf,))[0]:
+                    edges[pair] = (duration, distance)
+    return np.array(lats, dtype=np.float64), np.array(lngs, dtype=np.float64), edges
+
+
+def _witness_search(outgoing, source, skipped, max_cost, targets):
+    """Bounded Dijkstra from `source` that avoids `skipped`; returns the tentative durations found."""
+    durations = {source: 0.0}
+    heap = [(0.0, source)]
+    remaining = set(targets)
+    settled = 0
+    while heap and remaining and settled < WITNESS_SETTLE_LIMIT:
+        cost, current = heappop(heap)
+        if cost > durations[current]:
+            continue
+        if cost > max_cost:
+            break
+        settled += 1
+        remaining.discard(current)
+        for neighbor, duration in outgoing[current].items():
+            candidate = cost + duration
+            if neighbor != skipped and candidate < durations.get(neighbor, inf):
+                durations[neighbor] = candidate
+                heappush(heap, (candidate, neighbor))
+    return durations
+
+
+def contract_graph(node_count: int, edges: dict):
+    """
+    Contraction hierarchy over `edges`.
+
+    Nodes are contracted in lazily updated edge-difference order; returns the
+    node ranks and every overlay edge as `{(u, v): (seconds, km, middle)}`,
+    where `middle` is the contracted node a shortcut stands for (-1 for roads).
+    """
+    overlay = {pair: (duration, distance, -1) for pair, (duration, distance) in edges.items()}
+    outgoing = [{} for _ in range(node_count)]
+    incoming = [{} for _ in range(node_count)]
+    for (u, v), (duration, _) in edges.items():
+        outgoing[u][v] = duration
+        incoming[v][u] = duration
+    rank = np.full(node_count, -1, dtype=np.int64)
+    contracted_neighbors = [0] * node_count
+
+    def shortcuts(node):
+        found = []
+        for source, in_duration in incoming[node].items():
+            targets = {target: in_duration + out for target, out in outgoing[node].items() if target != source}
+            if not targets:
+                continue
+            witnesses = _witness_search(outgoing, source, node, max(targets.values()), targets)
+            found.extend(
+                (source, target, via) for target, via in targets.items() if witnesses.get(target, inf) > via
+            )
+        return found
+
+    def priority(node):
+        edge_difference = len(shortcuts(node)) - len(incoming[node]) - len(outgoing[node])
+        return edge_difference + contracted_neighbors[node]
+
+    heap = [(priority(node), node) for node in range(node_count)]
+    heapify(heap)
+    order = 0
+    while heap:
+        _, node = heappop(heap)
+        current = priority(node)
+        if heap and current > heap[0][0]:
+            heappush(heap, (current, node))
+            continue
+        for source, target, via in shortcuts(node):
+            if via < outgoing[source].get(target, inf):
+                distance = overlay[(source, node)][1] + overlay[(node, target)][1]
+                overlay[(source, target)] = (via, distance, node)
+                outgoing[source][target] = via
+                incoming[target][source] = via
+        for source in incoming[node]:
+            del outgoing[source][node]
+            contracted_neighbors[source] += 1
+        for target in outgoing[node]:
+            del incoming[target][node]
+            contracted_neighbors[target] += 1
+        incoming[node], outgoing[node] = {}, {}
+        rank[node] = order
+        order += 1
+    return rank, overlay
+
+
+class RoadGraph:
+    def __init__(self, lats, lngs, rank, edge_from, edge_to, edge_middle, edge_duration, edge_distance):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+        self.rank = np.asarray(rank, dtype=np.int64)
+        self.edge_arrays = {
+            "edge_from": np.asarray(edge_from, dtype=np.int64),
+            "edge_to": np.asarray(edge_to, dtype=np.int64),
+            "edge_middle": np.asarray(edge_middle, dtype=np.int64),
+            "edge_duration": np.asarray(edge_duration, dtype=np.float64),
+            "edge_distance": np.asarray(edge_distance, dtype=np.float64),
+        }
+        # Upward edges by lower endpoint: `up` as stored, `down` reversed for searches from the target.
+        self.up = [[] for _ in range(len(self.lats))]
+        self.down = [[] for _ in range(len(self.lats))]
+        self.middle = {}
+        rank = self.rank.tolist()
+        columns = (array.tolist() for array in self.edge_arrays.values())
+        for u, v, middle, duration, distance in zip(*columns, strict=True):
+            self.middle[(u, v)] = middle
+            if rank[u] < rank[v]:
+                self.up[u].append((v, duration, distance))
+            else:
+                self.down[v].append((u, duration, distance))
+
+    @classmethod
+    def from_edges(cls, lats, lngs, edges: dict):
+        rank, overlay = contract_graph(len(lats), edges)
+        pairs = list(overlay)
+        values = [overlay[pair] for pair in pairs]
+        return cls(
+            lats,
+            lngs,
+            rank,
+            [u for u, _ in pairs],
+            [v for _, v in pairs],
+            [middle for _, _, middle in values],
+            [duration for duration, _, _ in values],
+            [distance for _, distance, _ in values],
+        )
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            return cls(**{key: data[key] for key in data.files})
+
+    def save(self, path: str) -> None:
+        # Written next to the target and renamed, so running processes never read a partial file.
+        partial = f"{path}.partial"
+        with open(partial, "wb") as handle:
+            np.savez_compressed(handle, lats=self.lats, lngs=self.lngs, rank=self.rank, **self.edge_arrays)
+        os.replace(partial, path)
+
+    @property
+    def edge_count(self) -> int:
+        return len(self.edge_arrays["edge_from"])
+
+    def snap(self, lat: float, lng: float):
+        """Nearest node and its straight-line distance (km), or None when no node is within MAX_SNAP_KM."""
+        if not len(self.lats):
+            return None
+        distances = distances_from(lat, lng, self.lats, self.lngs)
+        node = int(np.argmin(distances))
+        if distances[node] > MAX_SNAP_KM:
+            return None
+        return node, float(distances[node])
+
+    def _upward(self, node: int, adjacency):
+        """Settled `{node: (seconds, km, parent)}` of a full search over upward edges."""
+        labels = {node: (0.0, 0.0, -1)}
+        heap = [(0.0, node)]
+        settled = {}
+        while heap:
+            duration, current = heappop(heap)
+            if current in settled:
+                continue
+            settled[current] = labels[current]
+            distance = labels[current][1]
+            for neighbor, edge_duration, edge_distance in adjacency[current]:
+                candidate = duration + edge_duration
+                if candidate < labels.get(neighbor, (inf,))[0]:
+                    labels[neighbor] = (candidate, distance + edge_distance, current)
+                    heappush(heap, (candidate, neighbor))
+        return settled
+
+    def _unpack(self, u: int, v: int):
+        """Road nodes of overlay edge u->v after u."""
+        nodes, stack = [], [(u, v)]
+        while stack:
+            first, second = stack.pop()
+            middle = self.middle[(first, second)]
+            if middle < 0:
+                nodes.append(second)
+            else:
+                stack.append((middle, second))
+                stack.append((first, middle))
+        return nodes
+
+    def route(self, source: int, target: int):
+        """`(seconds, km, nodes)` of the fastest path between two nodes, or None when unreachable."""
+        forward = self._upward(source, self.up)
+        backward = self._upward(target, self.down)
+        meeting = min(
+            (node for node in forward if node in backward),
+            key=lambda node: forward[node][0] + backward[node][0],
+            default=None,
+        )
+        if meeting is None:
+            return None
+        overlay_path = [meeting]
+        while forward[overlay_path[0]][2] >= 0:
+            overlay_path.insert(0, forward[overlay_path[0]][2])
+        while backward[overlay_path[-1]][2] >= 0:
+            overlay_path.append(backward[overlay_path[-1]][2])
+        nodes = [source]
+        for u, v in pairwise(overlay_path):
+            nodes.extend(self._unpack(u, v))
+        return (
+            forward[meeting][0] + backward[meeting][0],
+            forward[meeting][1] + backward[meeting][1],
+            nodes,
+        )
+
+    def node_table(self, sources, targets) -> dict:
+        """`{(source, target): (seconds, km)}` for every reachable pair, one upward search per node."""
+        buckets = {}
+        for target in set(targets):
+            for node, (duration, distance, _) in self._upward(target, self.down).items():
+                buckets.setdefault(node, []).append((target, duration, distance))
+        table = {}
+        for source in set(sources):
+            for node, (duration, distance, _) in self._upward(source, self.up).items():
+                for target, to_duration, to_distance in buckets.get(node, ()):
+                    total = duration + to_duration
+                    if total < table.get((source, target), (inf,))[0]:
+                        table[(source, target)] = (total, distance + to_distance)
+        return table
+
+    def travel_matrix(self, origins, targets):
+        """
+        Road distance (km) and duration (minutes) from each origin to each target `(lat, lng)`.
+
+        The legs to and from the nearest nodes are added as straight lines at
+        DEFAULT_SPEED_KMH; pairs off the network or unreachable are NaN.
+        """
+        origin_snaps = [self.snap(lat, lng) for lat, lng in origins]
+        target_snaps = [self.snap(lat, lng) for lat, lng in targets]
+        table = self.node_table(
+            [snap[0] for snap in origin_snaps if snap], [snap[0] for snap in target_snaps if snap]
+        )
+        distances = np.full((len(origins), len(targets)), np.nan)
+        durations = np.full((len(origins), len(targets)), np.nan)
+        for row, origin in enumerate(origin_snaps):
+            for column, target in enumerate(target_snaps):
+                if tuple(origins[row]) == tuple(targets[column]):
+                    distances[row, column] = durations[row, column] = 0.0
+                    continue
+                found = origin and target and table.get((origin[0], target[0]))
+                if not found:
+                    continue
+                access_km = origin[1] + target[1]
+                distances[row, column] = found[1] + access_km
+                durations[row, column] = found[0] / 60 + access_km / DEFAULT_SPEED_KMH * 60
+        return distances, durations
+
+    def path(self, origin, target):
+        """Road polyline `[(lat, lng), ...]` from origin to target, or None when it cannot be routed."""
+        origin_snap, target_snap = self.snap(*origin), self.snap(*target)
+        if not origin_snap or not target_snap:
+            return None
+        found = self.route(origin_snap[0], target_snap[0])
+        if found is None:
+            return None
+        road = [(float(self.lats[node]), float(self.lngs[node])) for node in found[2]]
+        return [tuple(origin), *road, tuple(target)]
+
+
+def build_road_graph(path: str) -> RoadGraph:
+    nodes, ways = read_osm(path)
+    lats, lngs, edges = build_edges(nodes, ways)
+    return RoadGraph.from_edges(lats, lngs, edges)
+
+
+def graph_path(municipality_id: int) -> str:
+    return os.path.join(str(settings.ROAD_GRAPH_DIR), f"{municipality_id}.npz")
+
+
+def load_road_graph(municipality_id: int):
+    """The municipality road graph, loaded once per process and again when its file changes; None without one."""
+    path = graph_path(municipality_id)
+    try:
+        modified = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _graphs.get(municipality_id)
+    if cached and cached[0] == modified:
+        return cached[1]
+    graph = RoadGraph.load(path)
+    _graphs[municipality_id] = (modified, graph)
+    return graph
+
+
+def preload_road_graphs() -> int:
+    """Load every graph in ROAD_GRAPH_DIR so the first routing request does not pay for it."""
+    directory = str(settings.ROAD_GRAPH_DIR)
+    if not os.path.isdir(directory):
+        return 0
+    loaded = 0
+    for name in os.listdir(directory):
+        stem, extension = os.path.splitext(name)
+        if extension == ".npz" and stem.isdigit() and load_road_graph(int(stem)) is not None:
+            loaded += 1
+    return loaded
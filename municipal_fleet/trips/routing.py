@@ -1,4 +1,15 @@
-from math import radians, cos, sin, sqrt, atan2
+import time
+from itertools import pairwise
+from math import atan2, cos, radians, sin, sqrt
+
+import numpy as np
+from django.conf import settings
+
+EARTH_RADIUS_KM = 6371.0
+DEFAULT_SPEED_KMH = 35.0
+ROUTING_BACKEND_HAVERSINE = "haversine"
+ROUTING_BACKEND_ROAD_NETWORK = "road_network"
+OR_OPT_SEGMENT_LENGTHS = (1, 2, 3)
 
 
 def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
@@ -12,46 +23,267 @@ def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
     return radius_km * c
 
 
-def optimize_destinations(destinations):
+def distance_matrix(lats, lngs, to_lats=None, to_lngs=None) -> np.ndarray:
+    """Great-circle distances (km) between points, or from them to a second set, in one vectorized pass."""
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    lng = np.radians(np.asarray(lngs, dtype=np.float64))
+    to_lat = lat if to_lats is None else np.radians(np.asarray(to_lats, dtype=np.float64))
+    to_lng = lng if to_lngs is None else np.radians(np.asarray(to_lngs, dtype=np.float64))
+    dlat = lat[:, None] - to_lat[None, :]
+    dlng = lng[:, None] - to_lng[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(to_lat)[None, :] * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def distances_from(lat: float, lng: float, lats, lngs) -> np.ndarray:
+    """Great-circle distances (km) from one point to many, vectorized."""
+    lat1, lng1 = np.radians(lat), np.radians(lng)
+    lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+    lng2 = np.radians(np.asarray(lngs, dtype=np.float64))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def road_graph_for(municipality_id):
+    """The municipality road graph when ROUTING_BACKEND is "road_network" and one was built; None otherwise."""
+    if municipality_id is None:
+        return None
+    if getattr(settings, "ROUTING_BACKEND", ROUTING_BACKEND_HAVERSINE) != ROUTING_BACKEND_ROAD_NETWORK:
+        return None
+    from trips.road_network import load_road_graph  # local import to avoid cycles
+
+    return load_road_graph(municipality_id)
+
+
+def municipality_of(destinations):
+    """The municipality shared by all destinations, or None (unsaved objects or mixed municipalities)."""
+    municipality_ids = {getattr(dest, "municipality_id", None) for dest in destinations}
+    return municipality_ids.pop() if len(municipality_ids) == 1 else None
+
+
+def destination_points(destinations) -> np.ndarray:
+    return np.array(
+        [(float(dest.latitude), float(dest.longitude)) for dest in destinations], dtype=np.float64
+    ).reshape(len(destinations), 2)
+
+
+def travel_matrices(origins, targets, municipality_id=None):
     """
-    Offline nearest-neighbor heuristic using destination coordinates.
-    Expects a list of objects with latitude/longitude attributes.
+    Distance (km) and duration (minutes) from each origin to each target `(lat, lng)`.
+
+    Pairs are routed on the municipality road graph when the road-network
+    backend has one; the rest are straight lines at DEFAULT_SPEED_KMH.
     """
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 2)
+    targets = np.asarray(targets, dtype=np.float64).reshape(-1, 2)
+    distances = distance_matrix(origins[:, 0], origins[:, 1], targets[:, 0], targets[:, 1])
+    durations = distances / DEFAULT_SPEED_KMH * 60
+    graph = road_graph_for(municipality_id)
+    if graph is not None:
+        road_distances, road_durations = graph.travel_matrix(origins.tolist(), targets.tolist())
+        routed = ~np.isnan(road_distances)
+        distances[routed] = road_distances[routed]
+        durations[routed] = road_durations[routed]
+    return distances, durations
+
+
+def destinations_matrix(destinations) -> np.ndarray:
+    """Distances between destinations, sliced from the municipality matrix when it covers them all."""
+    from trips.matrix import cached_submatrices  # local import to avoid cycles
+
+    cached = cached_submatrices(destinations)
+    if cached is not None:
+        return cached[0]
+    points = destination_points(destinations)
+    return travel_matrices(points, points, municipality_of(destinations))[0]
+
+
+def path_length(order, matrix) -> float:
+    order = np.asarray(order)
+    return float(matrix[order[:-1], order[1:]].sum()) if len(order) > 1 else 0.0
+
+
+def nearest_neighbor_order(matrix, fixed_end=False) -> list:
+    """Greedy path from point 0; with `fixed_end` the last point is kept for the end."""
+    size = len(matrix)
+    visited = np.zeros(size, dtype=bool)
+    visited[0] = True
+    if fixed_end:
+        visited[size - 1] = True
+    order = [0]
+    for _ in range(size - 1 - int(fixed_end)):
+        distances = np.where(visited, np.inf, matrix[order[-1]])
+        nearest = int(np.argmin(distances))
+        visited[nearest] = True
+        order.append(nearest)
+    if fixed_end and size > 1:
+        order.append(size - 1)
+    return order
+
+
+def _two_opt_pass(order, matrix, lo, hi) -> bool:
+    """One sweep of segment reversals between positions lo..hi; deltas for all j are vectorized per i."""
+    improved = False
+    last = len(order) - 1
+    for i in range(lo, hi):
+        path = np.asarray(order)
+        j = np.arange(i + 1, hi + 1)
+        prev_i = path[i - 1] if i > 0 else None
+        next_j = np.where(j < last, path[np.minimum(j + 1, last)], -1)
+        has_next = j < last
+        delta = np.zeros(len(j))
+        if prev_i is not None:
+            delta += matrix[prev_i, path[j]] - matrix[prev_i, path[i]]
+        delta += np.where(has_next, matrix[path[i], next_j] - matrix[path[j], next_j], 0.0)
+        best = int(np.argmin(delta))
+        if delta[best] < -1e-9:
+            k = int(j[best])
+            order[i:k + 1] = order[i:k + 1][::-1]
+            improved = True
+    return improved
+
+
+def _or_opt_pass(order, matrix, fixed_start, fixed_end) -> bool:
+    """Move chains of 1-3 stops (kept in direction) to their cheapest other position."""
+    improved = False
+    lo = 1 if fixed_start else 0
+    for length in OR_OPT_SEGMENT_LENGTHS:
+        start = lo
+        while start + length <= len(order) - int(fixed_end):
+            end = start + length
+            chain = order[start:end]
+            first, tail = chain[0], chain[-1]
+            rest = order[:start] + order[end:]
+            before = rest[start - 1] if start > 0 else None
+            after = rest[start] if start < len(rest) else None
+            old_cost = _link_cost(matrix, before, first, tail, after)
+            best_cost, best_at = old_cost - 1e-9, None
+            # Inserting at k places the chain between rest[k - 1] and rest[k], never outside the depots.
+            for k in range(lo, len(rest) - int(fixed_end) + 1):
+                if k == start:
+                    continue
+                left = rest[k - 1] if k > 0 else None
+                right = rest[k] if k < len(rest) else None
+                cost = _link_cost(matrix, left, first, tail, right)
+                if cost < best_cost:
+                    best_cost, best_at = cost, k
+            if best_at is not None:
+                order[:] = rest[:best_at] + chain + rest[best_at:]
+                improved = True
+            start += 1
+    return improved
+
+
+def _link_cost(matrix, left, first, tail, right) -> float:
+    """Extra length of placing a chain first..tail between left and right (either may be None)."""
+    cost = 0.0
+    if left is not None:
+        cost += matrix[left, first]
+    if right is not None:
+        cost += matrix[tail, right]
+    if left is not None and right is not None:
+        cost -= matrix[left, right]
+    return cost
+
+
+def improve_order(order, matrix, fixed_start=True, fixed_end=False, time_budget_ms=None) -> list:
+    """
+    2-opt and Or-opt local search over a path until no move helps or the time budget runs out.
+
+    Depots marked fixed keep their first/last position. 2-opt assumes symmetric
+    distances; Or-opt keeps chain direction and also works on asymmetric ones.
+    """
+    if time_budget_ms is None:
+        time_budget_ms = getattr(settings, "ROUTE_OPTIMIZATION_TIME_BUDGET_MS", 200)
+    order = list(order)
+    lo = 1 if fixed_start else 0
+    hi = len(order) - 2 if fixed_end else len(order) - 1
+    if hi - lo < 1:
+        return order
+    deadline = time.monotonic() + time_budget_ms / 1000
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = _two_opt_pass(order, matrix, lo, hi)
+        if time.monotonic() < deadline:
+            improved = _or_opt_pass(order, matrix, fixed_start, fixed_end) or improved
+    return order
+
+
+def optimize_destinations(destinations, fixed_start=True, fixed_end=False, time_budget_ms=None, matrix=None):
+    """
+    Shortest visiting order found for objects with latitude/longitude attributes.
+
+    The distance matrix is built once; a nearest-neighbor path from the first
+    destination is then improved with 2-opt/Or-opt. `fixed_start`/`fixed_end`
+    keep the first/last destination in place (depots).
+    """
+    destinations = list(destinations)
     if len(destinations) <= 2:
-        return list(destinations)
-
-    remaining = list(destinations)
-    ordered = [remaining.pop(0)]
-    while remaining:
-        last = ordered[-1]
-        next_idx = min(
-            range(len(remaining)),
-            key=lambda idx: haversine_km(
-                float(last.latitude), float(last.longitude),
-                float(remaining[idx].latitude), float(remaining[idx].longitude)
-            ),
-        )
-        ordered.append(remaining.pop(next_idx))
-    return ordered
+        return destinations
+    if matrix is None:
+        matrix = destinations_matrix(destinations)
+    # One-way streets make road distances asymmetric; 2-opt reverses segments, so it sees the average.
+    matrix = (matrix + matrix.T) / 2
+    order = nearest_neighbor_order(matrix, fixed_end=fixed_end)
+    order = improve_order(
+        order, matrix, fixed_start=fixed_start, fixed_end=fixed_end, time_budget_ms=time_budget_ms
+    )
+    return [destinations[idx] for idx in order]
 
 
 def build_route_geometry(destinations):
-    return [
-        {"lat": float(dest.latitude), "lng": float(dest.longitude)}
-        for dest in destinations
-    ]
-
-
-def route_summary(destinations, average_speed_kmh: float = 35.0):
-    distance_km = 0.0
-    for idx in range(1, len(destinations)):
-        prev = destinations[idx - 1]
-        curr = destinations[idx]
-        distance_km += haversine_km(
-            float(prev.latitude),
-            float(prev.longitude),
-            float(curr.latitude),
-            float(curr.longitude),
-        )
-    duration_minutes = int((distance_km / average_speed_kmh) * 60) if average_speed_kmh else 0
-    return distance_km, duration_minutes
+    """Route polyline: road paths between consecutive destinations when a road graph is available."""
+    points = [{"lat": float(dest.latitude), "lng": float(dest.longitude)} for dest in destinations]
+    graph = road_graph_for(municipality_of(destinations))
+    if graph is None or len(points) < 2:
+        return points
+    geometry = [points[0]]
+    for first, second in pairwise(points):
+        path = graph.path((first["lat"], first["lng"]), (second["lat"], second["lng"]))
+        if path is None:
+            geometry.append(second)
+        else:
+            geometry.extend({"lat": lat, "lng": lng} for lat, lng in path[1:])
+    return geometry
+
+
+def route_summary(destinations, average_speed_kmh: float | None = None):
+    """
+    Distance (km) and duration (minutes) along destinations in the given order.
+
+    Both come from the municipality matrix when it covers every destination,
+    otherwise from the road graph or straight lines (see `travel_matrices`);
+    an explicit `average_speed_kmh` overrides the durations.
+    """
+    from trips.matrix import cached_submatrices  # local import to avoid cycles
+
+    if len(destinations) < 2:
+        return 0.0, 0
+    duration_minutes = None
+    cached = cached_submatrices(destinations)
+    municipality_id = municipality_of(destinations)
+    if cached is not None:
+        distances, durations = cached
+        order = list(range(len(destinations)))
+        distance_km = path_length(order, distances)
+        duration_minutes = path_length(order, durations)
+    elif road_graph_for(municipality_id) is not None:
+        points = destination_points(destinations)
+        distances, durations = travel_matrices(points[:-1], points[1:], municipality_id)
+        distance_km = float(np.trace(distances))
+        duration_minutes = float(np.trace(durations))
+    else:
+        distance_km = 0.0
+        for idx in range(1, len(destinations)):
+            prev = destinations[idx - 1]
+            curr = destinations[idx]
+            distance_km += haversine_km(
+                float(prev.latitude),
+                float(prev.longitude),
+                float(curr.latitude),
+                float(curr.longitude),
+            )
+    if average_speed_kmh is None and duration_minutes is not None:
+        return distance_km, int(duration_minutes)
+    speed = DEFAULT_SPEED_KMH if average_speed_kmh is None else average_speed_kmh
+    return distance_km, int((distance_km / speed) * 60) if speed else 0
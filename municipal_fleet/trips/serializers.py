@@ -26,6 +26,8 @@ from destinations.models import Destination
 from students.models import Student
 from health.models import Patient, Companion
 from tenants.utils import resolve_municipality
+from trips.distance import update_trip_gps_distance
+from trips.stops import close_trip_stops
 
 
 SPECIAL_NEED_CHOICES = {"NONE", "TEA", "ELDERLY", "PCD", "OTHER"}
@@ -35,7 +37,15 @@ class TripSerializer(serializers.ModelSerializer):
     class Meta:
         model = Trip
         fields = "__all__"
-        read_only_fields = ["id", "created_at", "updated_at", "municipality"]
+        read_only_fields = [
+            "id",
+            "created_at",
+            "updated_at",
+            "municipality",
+            "gps_distance_km",
+            "gps_distance_computed_at",
+            "odometer_mismatch",
+        ]
 
     def validate(self, attrs):
         request = self.context.get("request")
@@ -222,8 +232,12 @@ class TripSerializer(serializers.ModelSerializer):
 
     @transaction.atomic
     def update(self, instance, validated_data):
+        was_completed = instance.status == Trip.Status.COMPLETED
         trip = super().update(instance, validated_data)
         self._update_odometer(trip)
+        if trip.status == Trip.Status.COMPLETED and not was_completed:
+            transaction.on_commit(lambda: close_trip_stops(trip.id))
+            transaction.on_commit(lambda: update_trip_gps_distance(trip))
         return trip
 
     def _update_odometer(self, trip: Trip):
@@ -259,6 +273,14 @@ class TripGpsPingSerializer(serializers.ModelSerializer):
         read_only_fields = ["id", "driver", "created_at"]
 
 
+class TripGpsPointSerializer(TripGpsPingSerializer):
+    """Incoming GPS point; the trip is resolved by the caller, so validating it costs no query per point."""
+
+    class Meta(TripGpsPingSerializer.Meta):
+        fields = ["lat", "lng", "accuracy", "speed", "recorded_at"]
+        read_only_fields = []
+
+
 class FreeTripSerializer(serializers.ModelSerializer):
     distance = serializers.SerializerMethodField()
     driver_name = serializers.CharField(source="driver.name", read_only=True)
@@ -0,0 +1,52 @@
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from destinations.models import Destination
+from trips.arrivals import invalidate_itinerary_state
+from trips.matrix import remove_destination_from_matrix, update_destination_matrix
+from trips.models import TripExecution, TripExecutionStop
+
+
+@receiver(post_save, sender=TripExecution)
+def reset_execution_itinerary(sender, instance, **kwargs):
+    invalidate_itinerary_state(instance.driver_id)
+
+
+@receiver([post_save, post_delete], sender=TripExecutionStop)
+def reset_stop_itinerary(sender, instance, **kwargs):
+    invalidate_itinerary_state(instance.trip_execution.driver_id)
+
+
+# Only these fields change a destination's row and column in the matrix.
+MATRIX_FIELDS = ("latitude", "longitude", "active")
+
+
+def _matrix_values(latitude, longitude, active):
+    return Decimal(str(latitude)), Decimal(str(longitude)), bool(active)
+
+
+@receiver(pre_save, sender=Destination)
+def track_destination_matrix_fields(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not set(update_fields) & set(MATRIX_FIELDS):
+        instance._matrix_changed = False
+        return
+    stored = None
+    if instance.pk:
+        stored = Destination.objects.filter(pk=instance.pk).values_list(*MATRIX_FIELDS).first()
+    current = _matrix_values(*(getattr(instance, field) for field in MATRIX_FIELDS))
+    instance._matrix_changed = stored is None or _matrix_values(*stored) != current
+
+
+@receiver(post_save, sender=Destination)
+def refresh_destination_matrix(sender, instance, created, **kwargs):
+    if created or getattr(instance, "_matrix_changed", True):
+        transaction.on_commit(lambda: update_destination_matrix(instance))
+
+
+@receiver(post_delete, sender=Destination)
+def drop_destination_from_matrix(sender, instance, **kwargs):
+    municipality_id, destination_id = instance.municipality_id, instance.pk
+    transaction.on_commit(lambda: remove_destination_from_matrix(municipality_id, destination_id))
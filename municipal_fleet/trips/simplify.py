@@ -0,0 +1,95 @@
+import math
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000.0
+# Web Mercator ground resolution at zoom 0 on the equator (meters per pixel).
+MERCATOR_M_PER_PIXEL = 156543.03392
+MAX_ZOOM = 22
+
+
+def tolerance_for_zoom(zoom: int, latitude: float = 0.0, pixels: float = 1.0) -> float:
+    """Ground distance covered by `pixels` screen pixels at the given map zoom and latitude."""
+    zoom = max(0, min(int(zoom), MAX_ZOOM))
+    return pixels * MERCATOR_M_PER_PIXEL * math.cos(math.radians(latitude)) / (2**zoom)
+
+
+def parse_simplify_params(params):
+    """
+    Read `tolerance` (meters) or `zoom` from query params.
+
+    Returns a (tolerance, zoom) tuple; both are None when simplification was not requested.
+    """
+    tolerance = params.get("tolerance")
+    if tolerance not in (None, ""):
+        try:
+            value = float(tolerance)
+        except (TypeError, ValueError):
+            return None, None
+        return (value, None) if value > 0 else (None, None)
+    zoom = params.get("zoom")
+    if zoom not in (None, ""):
+        try:
+            return None, max(0, min(int(zoom), MAX_ZOOM))
+        except (TypeError, ValueError):
+            return None, None
+    return None, None
+
+
+def _project(lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    lat0 = math.radians(float(lats.mean()))
+    x = np.radians(lngs - lngs[0]) * EARTH_RADIUS_M * math.cos(lat0)
+    y = np.radians(lats - lats[0]) * EARTH_RADIUS_M
+    return np.column_stack((x, y))
+
+
+def douglas_peucker_mask(lats, lngs, tolerance_m: float) -> np.ndarray:
+    """
+    Boolean mask of the points kept by Douglas-Peucker simplification.
+
+    Coordinates are projected to a local equirectangular plane in meters; the
+    distances of each segment's inner points are computed in one NumPy pass.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    count = len(lats)
+    keep = np.zeros(count, dtype=bool)
+    if count <= 2 or tolerance_m <= 0:
+        keep[:] = True
+        return keep
+    xy = _project(lats, lngs)
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        origin = xy[start]
+        direction = xy[end] - origin
+        inner = xy[start + 1 : end] - origin
+        length_sq = float(direction @ direction)
+        if length_sq == 0.0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            t = np.clip((inner @ direction) / length_sq, 0.0, 1.0)
+            offset = inner - t[:, None] * direction
+            distances = np.hypot(offset[:, 0], offset[:, 1])
+        idx = int(np.argmax(distances))
+        if distances[idx] > tolerance_m:
+            split = start + 1 + idx
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return keep
+
+
+def simplify_rows(rows, tolerance=None, zoom=None, lat_index=0, lng_index=1):
+    """Filter a list of row tuples/dicts, keeping only the points retained by the simplifier."""
+    if len(rows) <= 2 or (tolerance is None and zoom is None):
+        return rows
+    lats = np.fromiter((float(row[lat_index]) for row in rows), dtype=np.float64, count=len(rows))
+    lngs = np.fromiter((float(row[lng_index]) for row in rows), dtype=np.float64, count=len(rows))
+    if tolerance is None:
+        tolerance = tolerance_for_zoom(zoom, float(lats.mean()))
+    mask = douglas_peucker_mask(lats, lngs, tolerance)
+    return [row for row, kept in zip(rows, mask) if kept]
@@ -0,0 +1,183 @@
+"""
+Stop (dwell) detection over a trip's GPS pings.
+
+`StopDetector` makes a single pass over time-ordered points: a candidate stop
+grows while points stay within `STOP_RADIUS_M` of its running centroid and is
+confirmed once it lasts `STOP_MIN_SECONDS`. Its state is a small dict, so
+ingestion keeps one per trip in the cache and feeds only the new pings. The
+open stop's row is refreshed once per batch, and `close_trip_stops` closes it
+when the trip is completed.
+"""
+from datetime import UTC, datetime
+from decimal import Decimal
+from itertools import islice
+
+from django.core.cache import cache
+
+from trips.models import Trip, TripGpsPing, TripGpsStop
+from trips.routing import haversine_km
+
+STOP_RADIUS_M = 50
+STOP_MIN_SECONDS = 120
+STOP_STATE_TTL_SECONDS = 12 * 60 * 60
+BACKFILL_CHUNK_SIZE = 5000
+
+STOP_OPENED = "opened"
+STOP_CLOSED = "closed"
+
+
+class StopDetector:
+    def __init__(self, state=None, radius_m=STOP_RADIUS_M, min_seconds=STOP_MIN_SECONDS):
+        self.state = state
+        self.radius_m = radius_m
+        self.min_seconds = min_seconds
+
+    def feed(self, lat: float, lng: float, timestamp: float):
+        """Add one point; returns a list of `(STOP_OPENED | STOP_CLOSED, state)` events."""
+        state = self.state
+        if state is None:
+            self.state = _new_candidate(lat, lng, timestamp)
+            return []
+        if timestamp <= state["last_at"]:
+            # Out-of-order fixes cannot move a streaming detector backwards.
+            return []
+        if haversine_km(state["lat"], state["lng"], lat, lng) * 1000 <= self.radius_m:
+            state["count"] += 1
+            state["lat"] += (lat - state["lat"]) / state["count"]
+            state["lng"] += (lng - state["lng"]) / state["count"]
+            state["last_at"] = timestamp
+            if not state["confirmed"] and timestamp - state["started_at"] >= self.min_seconds:
+                state["confirmed"] = True
+                return [(STOP_OPENED, state)]
+            return []
+        self.state = _new_candidate(lat, lng, timestamp)
+        return [(STOP_CLOSED, state)] if state["confirmed"] else []
+
+    def finish(self):
+        """Close the pending stop at the end of a finished track."""
+        state, self.state = self.state, None
+        return [(STOP_CLOSED, state)] if state and state["confirmed"] else []
+
+
+def _new_candidate(lat, lng, timestamp):
+    return {
+        "lat": lat,
+        "lng": lng,
+        "count": 1,
+        "started_at": timestamp,
+        "last_at": timestamp,
+        "confirmed": False,
+        "stop_id": None,
+    }
+
+
+def _as_datetime(timestamp: float) -> datetime:
+    return datetime.fromtimestamp(timestamp, tz=UTC)
+
+
+def _stop_fields(state, closed: bool):
+    return {
+        "lat": Decimal(f"{state['lat']:.6f}"),
+        "lng": Decimal(f"{state['lng']:.6f}"),
+        "started_at": _as_datetime(state["started_at"]),
+        "ended_at": _as_datetime(state["last_at"]) if closed else None,
+        "duration_seconds": int(state["last_at"] - state["started_at"]),
+        "point_count": state["count"],
+    }
+
+
+def stop_state_key(trip_id: int) -> str:
+    return f"trips:stops:{trip_id}"
+
+
+def _seed_state(trip_id: int):
+    """Resume from the trip's open stop when the cached state was lost."""
+    stop = TripGpsStop.objects.filter(trip_id=trip_id, ended_at__isnull=True).order_by("-started_at").first()
+    if not stop:
+        return None
+    started_at = stop.started_at.timestamp()
+    return {
+        "lat": float(stop.lat),
+        "lng": float(stop.lng),
+        "count": stop.point_count,
+        "started_at": started_at,
+        "last_at": started_at + stop.duration_seconds,
+        "confirmed": True,
+        "stop_id": stop.id,
+        "saved_at": started_at + stop.duration_seconds,
+    }
+
+
+def update_trip_stops(trip_id: int, pings) -> None:
+    """Feed newly stored pings (oldest first) into the trip's streaming detector."""
+    key = stop_state_key(trip_id)
+    state = cache.get(key)
+    detector = StopDetector(state if state is not None else _seed_state(trip_id))
+    for ping in pings:
+        for event, stop_state in detector.feed(float(ping.lat), float(ping.lng), ping.recorded_at.timestamp()):
+            _persist_event(trip_id, event, stop_state)
+    state = detector.state
+    if state and state.get("stop_id") and state["last_at"] > state.get("saved_at", 0):
+        # The vehicle is still stopped: keep the open row's duration current (ended_at stays empty while open).
+        TripGpsStop.objects.filter(id=state["stop_id"]).update(**_stop_fields(state, closed=False))
+        state["saved_at"] = state["last_at"]
+    cache.set(key, state, STOP_STATE_TTL_SECONDS)
+
+
+def close_trip_stops(trip_id: int) -> None:
+    """Close the stop a completed trip ended in and drop its detector state."""
+    key = stop_state_key(trip_id)
+    state = cache.get(key)
+    detector = StopDetector(state if state is not None else _seed_state(trip_id))
+    for event, stop_state in detector.finish():
+        _persist_event(trip_id, event, stop_state)
+    cache.delete(key)
+
+
+def _persist_event(trip_id, event, state):
+    if event == STOP_OPENED:
+        stop = TripGpsStop.objects.create(trip_id=trip_id, **_stop_fields(state, closed=False))
+        state["stop_id"] = stop.id
+        state["saved_at"] = state["last_at"]
+    elif state.get("stop_id"):
+        TripGpsStop.objects.filter(id=state["stop_id"]).update(**_stop_fields(state, closed=True))
+
+
+def backfill_trip_stops(trip: Trip, chunk_size: int = BACKFILL_CHUNK_SIZE) -> int:
+    """
+    Rebuild a trip's stops from its stored pings in one streamed pass.
+
+    The last stop of an in-progress trip is left open and the detector state
+    is cached so ingestion continues from it. Returns the number of stops.
+    """
+    rows = (
+        TripGpsPing.objects.filter(trip_id=trip.id)
+        .order_by("recorded_at", "id")
+        .values_list("lat", "lng", "recorded_at")
+        .iterator(chunk_size=chunk_size)
+    )
+    detector = StopDetector()
+    closed = []
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        for lat, lng, recorded_at in chunk:
+            for event, state in detector.feed(float(lat), float(lng), recorded_at.timestamp()):
+                if event == STOP_CLOSED:
+                    closed.append(TripGpsStop(trip_id=trip.id, **_stop_fields(state, closed=True)))
+    in_progress = trip.status == Trip.Status.IN_PROGRESS
+    if not in_progress:
+        closed.extend(
+            TripGpsStop(trip_id=trip.id, **_stop_fields(state, closed=True)) for _, state in detector.finish()
+        )
+    TripGpsStop.objects.filter(trip_id=trip.id).delete()
+    TripGpsStop.objects.bulk_create(closed, batch_size=1000)
+    count = len(closed)
+    state = detector.state
+    if in_progress and state and state["confirmed"]:
+        state["stop_id"] = TripGpsStop.objects.create(trip_id=trip.id, **_stop_fields(state, closed=False)).id
+        state["saved_at"] = state["last_at"]
+        count += 1
+    cache.set(stop_state_key(trip.id), state, STOP_STATE_TTL_SECONDS)
+    return count
@@ -4,6 +4,8 @@ from trips.views import (
     TripViewSet,
     FreeTripViewSet,
     TripMapStateView,
+    GpsIngestionMetricsView,
+    GpsHeatmapView,
     PlannedTripViewSet,
     TripExecutionViewSet,
     TripManifestViewSet,
@@ -19,6 +21,8 @@ router.register(r"", TripViewSet, basename="trip")
 
 urlpatterns = [
     path("map-state/", TripMapStateView.as_view(), name="trip-map-state"),
+    path("heatmap/", GpsHeatmapView.as_view(), name="gps-heatmap"),
+    path("gps-ingestion/metrics/", GpsIngestionMetricsView.as_view(), name="gps-ingestion-metrics"),
     path("school-monitor/", SchoolMonitorDashboardView.as_view(), name="school-monitor-dashboard"),
 ]
 urlpatterns += router.urls
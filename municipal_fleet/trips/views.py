@@ -1,10 +1,12 @@
 import urllib.parse
-from datetime import timedelta, datetime
+from datetime import date, datetime, timedelta
 from django.utils import timezone
-from rest_framework import viewsets, permissions, response, decorators, filters, status, views
+from rest_framework import viewsets, permissions, response, decorators, filters, status, views, renderers
+from django.core.cache import cache
 from django.db import transaction
-from trips.models import Trip, FreeTrip, TripGpsPing, PlannedTrip, TripExecution, TripManifest, TripExecutionStop
-from drivers.models import DriverGeofence
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from trips.models import Trip, FreeTrip, TripGpsPing, TripGpsStop, PlannedTrip, TripExecution, TripManifest, TripExecutionStop
 from trips.serializers import (
     TripSerializer,
     FreeTripSerializer,
@@ -16,10 +18,43 @@ from trips.serializers import (
 )
 from tenants.mixins import MunicipalityQuerysetMixin
 from accounts.permissions import IsMunicipalityAdminOrReadOnly
-from trips.gps import resolve_status, STATUS_LABELS
+from trips.clustering import CLUSTER_MAX_ZOOM, cell_size_deg, cluster_positions, positions_in_bbox
+from trips.eta import cached_etas
+from trips.heatmap import CELL_DEG, heatmap_cells, parse_hours
+from trips.ingestion import queue_metrics
+from trips.map_state import (
+    MAP_ROLES,
+    active_trips_for,
+    build_driver_payloads,
+    build_map_delta,
+    encode_cursor,
+    load_history,
+    parse_bbox,
+    parse_cursor,
+    payload_etag,
+)
 from trips.services import generate_executions
+from trips.simplify import MAX_ZOOM, parse_simplify_params, simplify_rows
+from trips.partitions import archived_track_rows
+from trips.polyline import encode_track
+from trips.replay import (
+    MAX_REPLAY_SPEED,
+    EventStreamRenderer,
+    NDJSONRenderer,
+    aformat_ndjson,
+    aformat_sse,
+    areplay_events,
+    areplay_rows,
+    format_ndjson,
+    format_sse,
+    parse_speed,
+    replay_events,
+    replay_rows,
+)
 from trips.routing import optimize_destinations, build_route_geometry, route_summary
 
+SIMPLIFIED_TRACK_CACHE_SECONDS = 60 * 60 * 24
+
 
 class TripViewSet(MunicipalityQuerysetMixin, viewsets.ModelViewSet):
     queryset = Trip.objects.select_related("vehicle", "driver", "municipality")
@@ -67,29 +102,109 @@ class TripViewSet(MunicipalityQuerysetMixin, viewsets.ModelViewSet):
         wa_link = f"https://wa.me/{phone_digits}?text={urllib.parse.quote(message)}"
         return response.Response({"message": message, "wa_link": wa_link})
 
+    @decorators.action(
+        detail=True,
+        methods=["get"],
+        url_path="gps/replay",
+        renderer_classes=[renderers.JSONRenderer, NDJSONRenderer, EventStreamRenderer],
+    )
+    def gps_replay(self, request, pk=None):
+        trip = self.get_object()
+        try:
+            speed = parse_speed(request.query_params.get("speed"))
+        except ValueError:
+            return response.Response(
+                {"detail": f"Velocidade inválida; use um valor entre 0 e {MAX_REPLAY_SPEED:g}."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if isinstance(request._request, ASGIRequest):
+            # An async iterator, so pauses between points do not hold a worker thread.
+            events = areplay_events(areplay_rows(trip.id), speed=speed)
+            to_ndjson, to_sse = aformat_ndjson, aformat_sse
+        else:
+            events = replay_events(replay_rows(trip.id), speed=speed)
+            to_ndjson, to_sse = format_ndjson, format_sse
+        if request.accepted_renderer.format == EventStreamRenderer.format:
+            stream = StreamingHttpResponse(to_sse(events, trip.id), content_type=EventStreamRenderer.media_type)
+        else:
+            stream = StreamingHttpResponse(to_ndjson(events), content_type=NDJSONRenderer.media_type)
+        stream["Cache-Control"] = "no-cache"
+        # Keeps reverse proxies from buffering a paced replay.
+        stream["X-Accel-Buffering"] = "no"
+        return stream
+
     @decorators.action(detail=True, methods=["get"], url_path="gps/history")
     def gps_history(self, request, pk=None):
         trip = self.get_object()
-        points_qs = TripGpsPing.objects.filter(trip=trip).order_by("recorded_at", "id")
+        limit_value = None
         limit = request.query_params.get("limit")
         if limit:
             try:
                 limit_value = max(1, min(int(limit), 5000))
             except (TypeError, ValueError):
                 limit_value = 2000
-            points_qs = points_qs.order_by("-recorded_at", "-id")[:limit_value]
-            points_qs = reversed(list(points_qs))
-        payload = [
+        tolerance, zoom = parse_simplify_params(request.query_params)
+        simplify = tolerance is not None or zoom is not None
+        encoding = request.query_params.get("encoding") or None
+        if encoding not in (None, "polyline"):
+            return response.Response({"detail": "Codificação inválida."}, status=status.HTTP_400_BAD_REQUEST)
+        cache_key = None
+        if simplify and trip.status == Trip.Status.COMPLETED:
+            # Completed tracks no longer change, so simplified versions are reusable.
+            cache_key = f"trips:gps-history:{trip.id}:{limit_value}:{tolerance}:{zoom}:{encoding}"
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return response.Response(cached)
+
+        rows = archived_track_rows(trip.id)
+        if rows is not None:
+            # Raw pings of archived trips may already be gone with their partition.
+            if limit_value:
+                rows = rows[-limit_value:]
+        else:
+            points_qs = TripGpsPing.objects.filter(trip=trip).values_list("lat", "lng", "accuracy", "speed", "recorded_at")
+            if limit_value:
+                rows = list(points_qs.order_by("-recorded_at", "-id")[:limit_value])
+                rows.reverse()
+            else:
+                rows = list(points_qs.order_by("recorded_at", "id"))
+        if simplify:
+            rows = simplify_rows(rows, tolerance=tolerance, zoom=zoom)
+        if encoding == "polyline":
+            body = {"trip_id": trip.id, **encode_track(rows, time_index=4)}
+        else:
+            body = {
+                "trip_id": trip.id,
+                "points": [
+                    {"lat": float(lat), "lng": float(lng), "accuracy": accuracy, "speed": speed, "recorded_at": recorded_at}
+                    for lat, lng, accuracy, speed, recorded_at in rows
+                ],
+            }
+        if cache_key:
+            cache.set(cache_key, body, SIMPLIFIED_TRACK_CACHE_SECONDS)
+        return response.Response(body)
+
+    @decorators.action(detail=True, methods=["get"], url_path="gps/stops")
+    def gps_stops(self, request, pk=None):
+        trip = self.get_object()
+        stops = TripGpsStop.objects.filter(trip=trip).order_by("started_at")
+        min_seconds = request.query_params.get("min_seconds")
+        if min_seconds and min_seconds.isdigit():
+            stops = stops.filter(duration_seconds__gte=int(min_seconds))
+        items = [
             {
-                "lat": float(item.lat),
-                "lng": float(item.lng),
-                "accuracy": item.accuracy,
-                "speed": item.speed,
-                "recorded_at": item.recorded_at,
+                "lat": float(stop.lat),
+                "lng": float(stop.lng),
+                "started_at": stop.started_at,
+                "ended_at": stop.ended_at,
+                "duration_seconds": stop.duration_seconds,
+                "point_count": stop.point_count,
             }
-            for item in points_qs
+            for stop in stops
         ]
-        return response.Response({"trip_id": trip.id, "points": payload})
+        return response.Response(
+            {"trip_id": trip.id, "stops": items, "idle_seconds": sum(item["duration_seconds"] for item in items)}
+        )
 
 
 class FreeTripViewSet(MunicipalityQuerysetMixin, viewsets.ModelViewSet):
@@ -165,12 +280,19 @@ class TripMapStateView(views.APIView):
         parameters=[
             OpenApiParameter("include_history", OpenApiTypes.BOOL, description="Include GPS history"),
             OpenApiParameter("history_limit", OpenApiTypes.INT, description="Limit history points"),
+            OpenApiParameter("tolerance", OpenApiTypes.NUMBER, description="Simplify history (meters)"),
+            OpenApiParameter("zoom", OpenApiTypes.INT, description="Simplify history for a map zoom level"),
+            OpenApiParameter("since", OpenApiTypes.STR, description="Cursor from a previous response; returns only changes"),
+            OpenApiParameter(
+                "bbox", OpenApiTypes.STR, description="west,south,east,north; with zoom, returns server-side clusters"
+            ),
+            OpenApiParameter("municipality", OpenApiTypes.INT, description="Municipality (superadmin only)"),
         ],
-        responses={200: OpenApiTypes.OBJECT},
+        responses={200: OpenApiTypes.OBJECT, 304: None},
     )
     def get(self, request):
         user = request.user
-        if user.role not in ("SUPERADMIN", "ADMIN_MUNICIPALITY", "OPERATOR"):
+        if user.role not in MAP_ROLES:
             return response.Response({"detail": "Permissão negada."}, status=status.HTTP_403_FORBIDDEN)
         include_history = request.query_params.get("include_history", "true").lower() != "false"
         history_limit = request.query_params.get("history_limit")
@@ -182,85 +304,140 @@ class TripMapStateView(views.APIView):
         else:
             history_limit = 2000
 
-        trip_qs = Trip.objects.filter(status=Trip.Status.IN_PROGRESS).select_related("driver", "vehicle")
-        if user.role != "SUPERADMIN":
-            trip_qs = trip_qs.filter(municipality=user.municipality)
-        trips = list(trip_qs)
-        if not trips:
-            return response.Response({"drivers": []})
-
-        trip_ids = [trip.id for trip in trips]
-        ping_qs = (
-            TripGpsPing.objects.filter(trip_id__in=trip_ids)
-            .select_related("driver", "trip", "trip__vehicle")
-            .order_by("trip_id", "-recorded_at", "-id")
-        )
-        latest_by_trip = {}
-        for ping in ping_qs:
-            if ping.trip_id not in latest_by_trip:
-                latest_by_trip[ping.trip_id] = ping
-
-        history_by_trip = {}
-        if include_history:
-            history_qs = (
-                TripGpsPing.objects.filter(trip_id__in=trip_ids)
-                .order_by("trip_id", "-recorded_at", "-id")
-            )
-            for ping in history_qs:
-                points = history_by_trip.setdefault(ping.trip_id, [])
-                if len(points) >= history_limit:
-                    continue
-                points.append(
-                    {
-                        "lat": float(ping.lat),
-                        "lng": float(ping.lng),
-                        "accuracy": ping.accuracy,
-                        "speed": ping.speed,
-                        "recorded_at": ping.recorded_at,
-                    }
+        since = request.query_params.get("since")
+        if since:
+            try:
+                since = parse_cursor(since)
+            except (TypeError, ValueError, OverflowError):
+                return response.Response({"detail": "Cursor inválido."}, status=status.HTTP_400_BAD_REQUEST)
+
+        municipality_id = None
+        if user.role == "SUPERADMIN" and request.query_params.get("municipality"):
+            try:
+                municipality_id = int(request.query_params["municipality"])
+            except ValueError:
+                return response.Response({"detail": "Município inválido."}, status=status.HTTP_400_BAD_REQUEST)
+
+        bbox = None
+        zoom = None
+        if request.query_params.get("bbox") and request.query_params.get("zoom"):
+            try:
+                bbox = parse_bbox(request.query_params["bbox"])
+                zoom = max(0, min(int(request.query_params["zoom"]), MAX_ZOOM))
+            except ValueError:
+                return response.Response(
+                    {"detail": "bbox/zoom inválidos; use bbox=oeste,sul,leste,norte e zoom inteiro."},
+                    status=status.HTTP_400_BAD_REQUEST,
                 )
-            for trip_id, points in history_by_trip.items():
-                points.reverse()
 
+        # Taken before reading so changes made while the response is built show up in the next delta.
         now = timezone.now()
-        geofence_qs = DriverGeofence.objects.filter(driver_id__in=[trip.driver_id for trip in trips])
-        geofence_by_driver = {geofence.driver_id: geofence for geofence in geofence_qs}
-        drivers_payload = []
-        for trip in trips:
-            ping = latest_by_trip.get(trip.id)
-            status_code = resolve_status(ping, now=now, offline_after=timedelta(minutes=2))
-            geofence = geofence_by_driver.get(trip.driver_id)
+        if bbox and zoom <= CLUSTER_MAX_ZOOM:
+            positions = positions_in_bbox(user, bbox, municipality_id)
+            clusters = cluster_positions(positions.iterator(chunk_size=2000), zoom, now)
             payload = {
-                "trip_id": trip.id,
-                "driver_id": trip.driver_id,
-                "driver_name": trip.driver.name,
-                "vehicle_id": trip.vehicle_id,
-                "vehicle_plate": trip.vehicle.license_plate,
-                "status": status_code,
-                "status_label": STATUS_LABELS.get(status_code, status_code),
-                "geofence": None,
-                "last_point": None,
-                "history": history_by_trip.get(trip.id, []),
+                "mode": "clusters",
+                "zoom": zoom,
+                "cell_size_deg": cell_size_deg(zoom),
+                "total": sum(cluster["count"] for cluster in clusters),
+                "clusters": clusters,
             }
-            if geofence:
-                payload["geofence"] = {
-                    "center_lat": float(geofence.center_lat),
-                    "center_lng": float(geofence.center_lng),
-                    "radius_m": geofence.radius_m,
-                    "is_active": geofence.is_active,
-                    "alert_active": geofence.alert_active,
-                }
-            if ping:
-                payload["last_point"] = {
-                    "lat": float(ping.lat),
-                    "lng": float(ping.lng),
-                    "accuracy": ping.accuracy,
-                    "speed": ping.speed,
-                    "recorded_at": ping.recorded_at,
-                }
-            drivers_payload.append(payload)
+            return self._respond(request, payload, now)
 
-        return response.Response({"drivers": drivers_payload})
+        trip_qs = active_trips_for(user, municipality_id)
+        if bbox:
+            # Zoomed in past clustering: full payloads, but only for vehicles in view.
+            trip_qs = trip_qs.filter(id__in=positions_in_bbox(user, bbox, municipality_id).values("trip_id"))
+        trips = list(trip_qs)
+        if since:
+            payload = build_map_delta(trips, since, include_history=include_history, now=now)
+        elif trips:
+            history_by_trip = {}
+            if include_history:
+                tolerance, zoom = parse_simplify_params(request.query_params)
+                history_by_trip = load_history([trip.id for trip in trips], history_limit, tolerance=tolerance, zoom=zoom)
+            payload = {"drivers": build_driver_payloads(trips, history_by_trip, now=now)}
+        else:
+            payload = {"drivers": []}
+
+        return self._respond(request, payload, now)
+
+    def _respond(self, request, payload, now):
+        etag = payload_etag(payload)
+        if etag in request.headers.get("If-None-Match", ""):
+            return response.Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        payload["cursor"] = encode_cursor(now)
+        return response.Response(payload, headers={"ETag": etag})
+
+
+class GpsHeatmapView(views.APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter("start_date", OpenApiTypes.DATE, description="Local start date (default: 30 days ago)"),
+            OpenApiParameter("end_date", OpenApiTypes.DATE, description="Local end date (default: today)"),
+            OpenApiParameter("bbox", OpenApiTypes.STR, description="west,south,east,north"),
+            OpenApiParameter("hours", OpenApiTypes.STR, description="Hours of day, e.g. 7-9 or 7,12,18"),
+            OpenApiParameter("municipality", OpenApiTypes.INT, description="Municipality (superadmin only)"),
+        ],
+        responses={200: OpenApiTypes.OBJECT},
+    )
+    def get(self, request):
+        user = request.user
+        if user.role not in MAP_ROLES:
+            return response.Response({"detail": "Permissão negada."}, status=status.HTTP_403_FORBIDDEN)
+        params = request.query_params
+        municipality_id = user.municipality_id
+        if user.role == "SUPERADMIN" and params.get("municipality"):
+            try:
+                municipality_id = int(params["municipality"])
+            except ValueError:
+                return response.Response({"detail": "Município inválido."}, status=status.HTTP_400_BAD_REQUEST)
+        if not municipality_id:
+            return response.Response({"detail": "Informe o município."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            end_date = date.fromisoformat(params["end_date"]) if params.get("end_date") else timezone.localdate()
+            start_date = (
+                date.fromisoformat(params["start_date"]) if params.get("start_date") else end_date - timedelta(days=30)
+            )
+        except ValueError:
+            return response.Response({"detail": "Data inválida; use AAAA-MM-DD."}, status=status.HTTP_400_BAD_REQUEST)
+        bbox = None
+        if params.get("bbox"):
+            try:
+                bbox = parse_bbox(params["bbox"])
+            except ValueError:
+                return response.Response(
+                    {"detail": "bbox inválido; use oeste,sul,leste,norte."}, status=status.HTTP_400_BAD_REQUEST
+                )
+        hours = None
+        if params.get("hours"):
+            try:
+                hours = parse_hours(params["hours"])
+            except ValueError:
+                return response.Response({"detail": "Horas inválidas; use 7-9 ou 7,12,18."}, status=status.HTTP_400_BAD_REQUEST)
+        cells, truncated = heatmap_cells(municipality_id, start_date, end_date, bbox=bbox, hours=hours)
+        return response.Response(
+            {
+                "start_date": start_date,
+                "end_date": end_date,
+                "cell_size_deg": float(CELL_DEG),
+                "max_count": cells[0]["count"] if cells else 0,
+                "truncated": truncated,
+                "cells": cells,
+            }
+        )
+
+
+class GpsIngestionMetricsView(views.APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    @extend_schema(responses={200: OpenApiTypes.OBJECT})
+    def get(self, request):
+        if request.user.role != "SUPERADMIN":
+            return response.Response({"detail": "Permissão negada."}, status=status.HTTP_403_FORBIDDEN)
+        return response.Response(queue_metrics())
 
 
 class PlannedTripViewSet(MunicipalityQuerysetMixin, viewsets.ModelViewSet):
@@ -396,7 +573,12 @@ class TripExecutionViewSet(MunicipalityQuerysetMixin, viewsets.ModelViewSet):
         destinations = [stop.destination for stop in stops]
         if not destinations:
             return response.Response({"detail": "Sem destinos para otimizar."}, status=status.HTTP_400_BAD_REQUEST)
-        ordered = optimize_destinations(destinations)
+        # Depots: the first stop stays put unless fixed_start=false; fixed_end=true keeps the last one (e.g. the garage).
+        ordered = optimize_destinations(
+            destinations,
+            fixed_start=str(request.data.get("fixed_start", True)).lower() != "false",
+            fixed_end=str(request.data.get("fixed_end", False)).lower() == "true",
+        )
         stop_map = {}
         for stop in stops:
             stop_map.setdefault(stop.destination_id, []).append(stop)
@@ -438,6 +620,9 @@ class TripExecutionViewSet(MunicipalityQuerysetMixin, viewsets.ModelViewSet):
         passengers_payload = []
         if manifest:
             passengers_payload = TripManifestPassengerSerializer(manifest.passengers.all(), many=True).data
+        route_geometry = execution.route_geometry
+        if request.query_params.get("encoding") == "polyline":
+            route_geometry = encode_track(route_geometry or [], lat_index="lat", lng_index="lng")
         return response.Response(
             {
                 "execution_id": execution.id,
@@ -449,7 +634,7 @@ class TripExecutionViewSet(MunicipalityQuerysetMixin, viewsets.ModelViewSet):
                 "vehicle_plate": execution.vehicle.license_plate,
                 "driver_id": execution.driver_id,
                 "driver_name": execution.driver.name,
-                "route_geometry": execution.route_geometry,
+                "route_geometry": route_geometry,
                 "route_distance_km": execution.route_distance_km,
                 "route_duration_minutes": execution.route_duration_minutes,
                 "stops": stops_payload,
@@ -457,6 +642,14 @@ class TripExecutionViewSet(MunicipalityQuerysetMixin, viewsets.ModelViewSet):
             }
         )
 
+    @decorators.action(detail=True, methods=["get"], url_path="eta")
+    def eta(self, request, pk=None):
+        execution = self.get_object()
+        payload = cached_etas([execution.id]).get(execution.id)
+        if payload is None:
+            return response.Response({"execution_id": execution.id, "computed_at": None, "position": None, "stops": []})
+        return response.Response(payload)
+
 
 class TripManifestViewSet(MunicipalityQuerysetMixin, viewsets.ModelViewSet):
     queryset = TripManifest.objects.select_related("trip_execution", "trip_execution__municipality").prefetch_related(
@@ -496,8 +689,12 @@ class SchoolMonitorDashboardView(views.APIView):
         if date_param:
             qs = qs.filter(scheduled_departure__date=date_param)
 
+        executions = list(qs.order_by("scheduled_departure"))
+        etas = cached_etas([execution.id for execution in executions])
         executions_payload = []
-        for execution in qs.order_by("scheduled_departure"):
+        for execution in executions:
+            eta_payload = etas.get(execution.id) or {}
+            stop_etas = {item["stop_id"]: item["eta"] for item in eta_payload.get("stops", [])}
             stops = execution.stops.select_related("destination").order_by("order")
             stops_payload = [
                 {
@@ -508,6 +705,9 @@ class SchoolMonitorDashboardView(views.APIView):
                     "address": stop.destination.address if stop.destination else None,
                     "latitude": float(stop.destination.latitude) if stop.destination else None,
                     "longitude": float(stop.destination.longitude) if stop.destination else None,
+                    "arrival_time": stop.arrival_time,
+                    "departure_time": stop.departure_time,
+                    "eta": stop_etas.get(stop.id),
                 }
                 for stop in stops
             ]
@@ -549,6 +749,7 @@ class SchoolMonitorDashboardView(views.APIView):
                     "route_duration_minutes": execution.route_duration_minutes,
                     "itinerary_link": f"/api/trips/executions/{execution.id}/itinerary/",
                     "stops": stops_payload,
+                    "eta_updated_at": eta_payload.get("computed_at"),
                     "students_count": len(passengers),
                     "special_needs_count": special_needs,
                     "students": passengers,
@@ -0,0 +1,66 @@
+from math import floor
+
+MIN_CELL_DEG = 0.01
+MAX_CELLS_PER_ZONE = 256
+
+
+def point_in_polygon(lat: float, lng: float, lats, lngs) -> bool:
+    """Even-odd ray casting; vertices are parallel lat/lng sequences of an implicitly closed ring."""
+    inside = False
+    j = len(lats) - 1
+    for i in range(len(lats)):
+        if (lats[i] > lat) != (lats[j] > lat):
+            crossing = lngs[i] + (lat - lats[i]) * (lngs[j] - lngs[i]) / (lats[j] - lats[i])
+            if lng < crossing:
+                inside = not inside
+        j = i
+    return inside
+
+
+class ZonePolygon:
+    __slots__ = ("bbox", "data", "lats", "lngs", "zone_id")
+
+    def __init__(self, zone_id, vertices, data=None):
+        self.zone_id = zone_id
+        self.lats = tuple(float(lat) for lat, _ in vertices)
+        self.lngs = tuple(float(lng) for _, lng in vertices)
+        self.bbox = (min(self.lats), min(self.lngs), max(self.lats), max(self.lngs))
+        self.data = data or {}
+
+    def contains(self, lat: float, lng: float) -> bool:
+        south, west, north, east = self.bbox
+        if not (south <= lat <= north and west <= lng <= east):
+            return False
+        return point_in_polygon(lat, lng, self.lats, self.lngs)
+
+
+class PolygonIndex:
+    """
+    Uniform lat/lng grid over polygon bounding boxes.
+
+    A lookup reads one cell, then runs bounding-box and ray-casting tests on the
+    few polygons registered there. The cell size grows with the largest polygon
+    so a municipality-wide zone does not fill thousands of cells.
+    """
+
+    def __init__(self, polygons):
+        self.polygons = [polygon for polygon in polygons if len(polygon.lats) >= 3]
+        largest = max(
+            (max(p.bbox[2] - p.bbox[0], p.bbox[3] - p.bbox[1]) for p in self.polygons),
+            default=0.0,
+        )
+        self.cell_deg = max(MIN_CELL_DEG, largest / MAX_CELLS_PER_ZONE**0.5)
+        self.cells = {}
+        for position, polygon in enumerate(self.polygons):
+            south, west, north, east = polygon.bbox
+            for x in range(self._cell(west), self._cell(east) + 1):
+                for y in range(self._cell(south), self._cell(north) + 1):
+                    self.cells.setdefault((x, y), []).append(position)
+
+    def _cell(self, value: float) -> int:
+        return floor(value / self.cell_deg)
+
+    def zones_at(self, lat: float, lng: float):
+        lat, lng = float(lat), float(lng)
+        candidates = self.cells.get((self._cell(lng), self._cell(lat)), ())
+        return [self.polygons[position] for position in candidates if self.polygons[position].contains(lat, lng)]